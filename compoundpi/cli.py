@@ -33,6 +33,7 @@ import sys
 import io
 import os
 import re
+import math
 import logging
 import warnings
 import datetime
@@ -45,7 +46,11 @@ from .ipaddress import IPv4Address, IPv4Network
 from .client import CompoundPiClient
 from .terminal import TerminalApplication
 from .cmdline import Cmd, CmdSyntaxError, CmdError, ENCODING
-from .exc import CompoundPiClientError
+from .exc import (
+    CompoundPiClientError,
+    CompoundPiSendTimeout,
+    CompoundPiSendTruncated,
+    )
 
 
 def service(s):
@@ -89,6 +94,7 @@ def numeric_range(conversion, inclusive=True, min_value=None, max_value=None):
     return test
 
 network_timeout = numeric_range(conversion=int, min_value=1)
+find_quiet = numeric_range(conversion=float, inclusive=False, min_value=0.0)
 capture_count = numeric_range(conversion=int, min_value=1)
 capture_quality = numeric_range(conversion=int, min_value=1, max_value=100)
 time_delay = numeric_range(conversion=float, min_value=0.0)
@@ -96,6 +102,7 @@ time_delta = numeric_range(conversion=float, inclusive=False, min_value=0.0)
 record_quality = numeric_range(conversion=int, min_value=0, max_value=100)
 record_bitrate = numeric_range(conversion=int, min_value=1, max_value=25000000)
 record_intra_period = numeric_range(conversion=int, min_value=0)
+download_retries = numeric_range(conversion=int, min_value=0)
 
 def path(s):
     s = os.path.expanduser(s)
@@ -105,6 +112,10 @@ def path(s):
         raise ValueError('%s is not a directory' % s)
     return s
 
+def cache_file(s):
+    # An empty value disables the server cache
+    return os.path.expanduser(s) if s else ''
+
 def boolean(s):
     s = s.strip().lower()
     if s in {'true', 't', 'yes', 'y', 'on', '1'}:
@@ -158,6 +169,16 @@ class CompoundPiClientApplication(TerminalApplication):
             default='15', metavar='SECS',
             help='specifies the timeout (in seconds) for network '
             'transactions (default: %(default)s)')
+        self.parser.add_argument(
+            '--find-quiet', type=find_quiet, default='2', metavar='SECS',
+            help='specifies how long (in seconds) find waits for further '
+            'servers after the last one responds (default: %(default)s)')
+        self.parser.add_argument(
+            '--cache', type=cache_file, default='~/.cpi_servers.json',
+            metavar='FILE',
+            help='specifies the file that the server list is saved to on exit '
+            'and revalidated from on start; specify an empty value to '
+            'disable the cache (default: %(default)s)')
         self.parser.add_argument(
             '--capture-delay', type=time_delay, default='0.0', metavar='SECS',
             help='specifies the delay (in seconds) used to synchronize '
@@ -196,6 +217,11 @@ class CompoundPiClientApplication(TerminalApplication):
             help='specifies the delay (in seconds) used to synchronize '
             'recordings. This must be less than the network delay '
             '(default: %(default)s)')
+        self.parser.add_argument(
+            '--record-segment', type=time_delay, default='0.0', metavar='SECS',
+            help='specifies the length (in seconds) of the files that h264 '
+            'recordings are split into, or 0 to record a single file '
+            '(default: %(default)s)')
         self.parser.add_argument(
             '--record-intra-period', type=record_intra_period, default='30', metavar='FRAMES',
             help='specifies the number of images in a GOP when recording in '
@@ -204,6 +230,10 @@ class CompoundPiClientApplication(TerminalApplication):
             '--time-delta', type=time_delta, default='0.25', metavar='SECS',
             help='specifies the maximum delta between server timestamps that '
             'the client will tolerate (default: %(default)ss)')
+        self.parser.add_argument(
+            '--download-retries', type=download_retries, default='3', metavar='NUM',
+            help='specifies the number of times an interrupted download will '
+            'be resumed before giving up (default: %(default)s)')
         self.parser.set_defaults(log_level=logging.INFO)
 
     def main(self, args):
@@ -211,6 +241,7 @@ class CompoundPiClientApplication(TerminalApplication):
         proc.client.servers.network = args.network
         proc.client.servers.port = args.port
         proc.client.servers.timeout = args.timeout
+        proc.client.servers.quiet = args.find_quiet
         proc.client.bind = args.bind
         proc.capture_delay = args.capture_delay
         proc.capture_quality = args.capture_quality
@@ -221,9 +252,12 @@ class CompoundPiClientApplication(TerminalApplication):
         proc.record_bitrate = args.record_bitrate
         proc.record_motion = args.record_motion
         proc.record_delay = args.record_delay
+        proc.record_segment = args.record_segment
         proc.record_intra_period = args.record_intra_period
         proc.time_delta = args.time_delta
+        proc.download_retries = args.download_retries
         proc.output = args.output
+        proc.cache = args.cache
         proc.cmdloop()
 
 
@@ -276,9 +310,12 @@ class CompoundPiCmd(Cmd):
         self.record_bitrate = 17000000
         self.record_motion = False
         self.record_delay = 0.0
+        self.record_segment = 0.0
         self.record_intra_period = 30
         self.time_delta = 0.25
+        self.download_retries = 3
         self.output = '/tmp'
+        self.cache = ''
         self.warnings = False
         warnings.simplefilter('always')
 
@@ -290,9 +327,19 @@ class CompoundPiCmd(Cmd):
     def preloop(self):
         assert self.client.bind
         Cmd.preloop(self)
+        if self.cache and os.path.exists(self.cache):
+            self.client.servers.load(self.cache)
+            logging.info(
+                'Restored %d servers from %s' % (
+                    len(self.client.servers), self.cache))
 
     def postloop(self):
         Cmd.postloop(self)
+        if self.cache and len(self.client.servers):
+            try:
+                self.client.servers.save(self.cache)
+            except (IOError, OSError) as e:
+                logging.warning('Failed to write %s: %s', self.cache, e)
         self.client.close()
 
     def onecmd(self, line):
@@ -366,6 +413,7 @@ class CompoundPiCmd(Cmd):
                 ('network',             self.client.servers.network),
                 ('port',                self.client.servers.port),
                 ('timeout',             self.client.servers.timeout),
+                ('find_quiet',          self.client.servers.quiet),
                 ('bind',                '%s:%d' % self.client.bind),
                 ('capture_delay',       self.capture_delay),
                 ('capture_quality',     self.capture_quality),
@@ -376,9 +424,12 @@ class CompoundPiCmd(Cmd):
                 ('record_quality',      self.record_quality),
                 ('record_bitrate',      self.record_bitrate),
                 ('record_motion',       self.record_motion),
+                ('record_segment',      self.record_segment),
                 ('record_intra_period', self.record_intra_period),
                 ('time_delta',          self.time_delta),
+                ('download_retries',    self.download_retries),
                 ('output',              self.output),
+                ('cache',               self.cache),
                 ('warnings',            self.warnings),
                 ]
             )
@@ -411,6 +462,7 @@ class CompoundPiCmd(Cmd):
                 'port':                service,
                 'bind':                address,
                 'timeout':             network_timeout,
+                'find_quiet':          find_quiet,
                 'capture_delay':       time_delay,
                 'capture_count':       capture_count,
                 'capture_quality':     capture_quality,
@@ -419,10 +471,13 @@ class CompoundPiCmd(Cmd):
                 'record_quality':      record_quality,
                 'record_bitrate':      record_bitrate,
                 'record_motion':       boolean,
+                'record_segment':      time_delay,
                 'record_intra_period': record_intra_period,
                 'video_port':          boolean,
                 'time_delta':          time_delta,
+                'download_retries':    download_retries,
                 'output':              path,
+                'cache':               cache_file,
                 'warnings':            boolean,
                 }[name](value)
         except KeyError:
@@ -431,6 +486,8 @@ class CompoundPiCmd(Cmd):
             raise CmdSyntaxError(e)
         if name in ('network', 'port', 'timeout'):
             setattr(self.client.servers, name, value)
+        elif name == 'find_quiet':
+            self.client.servers.quiet = value
         elif name in ('bind',):
             setattr(self.client, name, value)
         else:
@@ -443,7 +500,7 @@ class CompoundPiCmd(Cmd):
         if match.start('value') < finish <= match.end('value'):
             name = match.group('name').strip()
             value = match.group('value').strip()
-            if name.startswith('output'):
+            if name.startswith('output') or name.startswith('cache'):
                 return self.complete_path(text, value, start, finish)
             elif (
                     name.startswith('video_port') or
@@ -462,6 +519,7 @@ class CompoundPiCmd(Cmd):
                 'port',
                 'bind',
                 'timeout',
+                'find_quiet',
                 'capture_delay',
                 'capture_quality',
                 'capture_count',
@@ -471,9 +529,12 @@ class CompoundPiCmd(Cmd):
                 'record_quality',
                 'record_bitrate',
                 'record_motion',
+                'record_segment',
                 'record_intra_period',
                 'time_delta',
+                'download_retries',
                 'output',
+                'cache',
                 'warnings',
                 ]
             return [name + ' ' for name in names if name.startswith(text)]
@@ -506,28 +567,47 @@ class CompoundPiCmd(Cmd):
         """
         Find all servers on the current subnet.
 
-        Syntax: find [count]
+        Syntax: find [count] [networks]
 
         The 'find' command is typically the first command used in a client
         session to locate all Pis on the configured subnet. If a count is
         specified, the command will display an error if the expected number of
-        Pis is not located.
+        Pis is not located. Otherwise, the command finishes once no new Pis
+        have responded for the period given by the 'find_quiet' setting.
+
+        If a comma-separated list of networks is specified, all of them are
+        searched simultaneously instead of the configured network (this is
+        useful when Pis are spread across several subnets or interfaces).
+
+        When the client exits, the list of servers is saved to the file given
+        by the 'cache' setting. On the next start, the servers in this file
+        are revalidated (simultaneously, by unicast) instead, so 'find' is
+        only required to discover new Pis.
 
         See also: add, remove, servers, identify.
 
         cpi> find
         cpi> find 20
+        cpi> find 192.168.0.0/24,192.168.1.0/24
+        cpi> find 40 192.168.0.0/24,192.168.1.0/24
         """
-        if arg:
-            try:
-                count = int(arg)
-            except ValueError:
-                raise CmdSyntaxError('Invalid find count "%s"' % arg)
+        count = 0
+        networks = None
+        args = arg.split()
+        if len(args) > 2:
+            raise CmdSyntaxError('Too many arguments')
+        if args and args[0].isdigit():
+            count = int(args.pop(0))
             if count < 1:
-                raise CmdSyntaxError('Invalid find count "%d"' % arg)
-        else:
-            count = 0
-        self.client.servers.find(count)
+                raise CmdSyntaxError('Invalid find count "%d"' % count)
+        if args:
+            try:
+                networks = [network(s) for s in args.pop(0).split(',')]
+            except ValueError as e:
+                raise CmdSyntaxError(e)
+        if args:
+            raise CmdSyntaxError('Unexpected argument "%s"' % args[0])
+        self.client.servers.find(count, networks=networks)
         if not len(self.client.servers):
             raise CmdError('Failed to find any servers')
         logging.info('Found %d servers' % len(self.client.servers))
@@ -668,6 +748,110 @@ class CompoundPiCmd(Cmd):
         elif match.start('addr') < finish <= match.end('addr'):
             return self.complete_server(text, line, start, finish)
 
+    def do_time(self, arg=''):
+        """
+        Measures the clock offsets of the defined servers.
+
+        Syntax: time [addresses]
+
+        The 'time' command exchanges several timestamped messages with the
+        servers (in the manner of NTP) to estimate the offset of each server's
+        clock from the client's, and the network round-trip time. The
+        estimates are displayed, shown by the 'status' command, and used to
+        adjust the timestamps sent to synchronize captures and recordings
+        (see the capture_delay and record_delay settings). Re-run the command
+        periodically as the servers' clocks drift.
+
+        See also: status, skew, capture.
+
+        cpi> time
+        cpi> time 192.168.0.1-192.168.0.10
+        """
+        responses = self.client.time_sync(addresses=self.parse_addresses(arg))
+        self.pprint_table(
+            [('Address', 'Offset', 'RTT')] + [
+                (
+                    address,
+                    '%+.2fms' % (clock.offset * 1000),
+                    '%.2fms' % (clock.delay * 1000),
+                    )
+                for address in self.client.servers
+                if address in responses
+                for clock in (responses[address],)
+                ])
+
+    def complete_time(self, text, line, start, finish):
+        return self.complete_server(text, line, start, finish)
+
+    def do_skew(self, arg=''):
+        """
+        Reports the accuracy of synchronized captures on the defined servers.
+
+        Syntax: skew [addresses]
+
+        The 'skew' command examines the files stored on the servers and, for
+        each synchronized capture or recording (those made with a non-zero
+        capture_delay or record_delay), reports how far the servers' actual
+        start times strayed from the requested time. The minimum, maximum,
+        and standard deviation of the skew across the servers are shown, in
+        milliseconds, for each capture.
+
+        Note that the skew is measured against each server's own clock; it
+        does not include any difference between the servers' clocks.
+
+        See also: capture, record, status.
+
+        cpi> set capture_delay 0.5
+        cpi> capture
+        cpi> skew
+        """
+        responses = self.client.list(self.parse_addresses(arg))
+        starts = []
+        for address, files in responses.items():
+            # The first file of each synchronized capture carries the start
+            # time; only count it once per server
+            first = {}
+            for f in files:
+                if f.requested is not None:
+                    first[f.requested] = min(
+                        first.get(f.requested, f.timestamp), f.timestamp)
+            # Requested times are adjusted for each server's clock offset (if
+            # measured); convert them back to the client's clock to group them
+            clock = self.client.clocks.get(address)
+            offset = datetime.timedelta(
+                seconds=0.0 if clock is None else clock.offset)
+            for requested, timestamp in first.items():
+                starts.append((
+                    requested - offset,
+                    (timestamp - requested).total_seconds() * 1000))
+        if not starts:
+            self.pprint('No synchronized captures found')
+            return
+        # Allow for rounding in the adjusted times when grouping
+        captures = []
+        for requested, skew in sorted(starts):
+            if captures and (
+                    requested - captures[-1][0] < datetime.timedelta(milliseconds=1)):
+                captures[-1][1].append(skew)
+            else:
+                captures.append((requested, [skew]))
+        rows = []
+        for requested, skews in captures:
+            mean = sum(skews) / len(skews)
+            rows.append((
+                requested.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                len(skews),
+                '%.3f' % min(skews),
+                '%.3f' % max(skews),
+                '%.3f' % math.sqrt(
+                    sum((skew - mean) ** 2 for skew in skews) / len(skews)),
+                ))
+        self.pprint_table(
+            [('Requested', 'Servers', 'Min', 'Max', 'Stddev')] + rows)
+
+    def complete_skew(self, text, line, start, finish):
+        return self.complete_server(text, line, start, finish)
+
     def do_sort(self, arg=''):
         """
         Sorts the list of servers numerically.
@@ -705,9 +889,10 @@ class CompoundPiCmd(Cmd):
 
         The 'status' command is used to retrieve configuration information from
         servers. If no addresses are specified, then all defined servers will
-        be queried.
+        be queried. The Offset and RTT columns show the clock offset and
+        round-trip time last measured by the 'time' command, if any.
 
-        See also: resolution, framerate.
+        See also: resolution, framerate, time.
 
         cpi> status
         """
@@ -724,6 +909,8 @@ class CompoundPiCmd(Cmd):
                     'Meter',
                     'Flip',
                     'Clock',
+                    'Offset',
+                    'RTT',
                     '#',
                     )
             ] + [
@@ -756,11 +943,14 @@ class CompoundPiCmd(Cmd):
                         'none'
                         ),
                     status.timestamp - min_time,
+                    '-' if clock is None else '%+.2fms' % (clock.offset * 1000),
+                    '-' if clock is None else '%.2fms' % (clock.delay * 1000),
                     status.files,
                     )
                 for address in self.client.servers
                 if address in responses
                 for status in (responses[address],)
+                for clock in (self.client.clocks.get(address),)
                 ])
         if len(set(
                 status.resolution
@@ -798,7 +988,14 @@ class CompoundPiCmd(Cmd):
                 )) > 1:
             logging.warning('Warning: multiple orientations configured')
         for address, status in responses.items():
-            if (status.timestamp - min_time).total_seconds() > self.time_delta:
+            # Measured clock offsets exclude network latency, so prefer them
+            # to the difference between the reported timestamps
+            clock = self.client.clocks.get(address)
+            if clock is not None:
+                delta = abs(clock.offset)
+            else:
+                delta = (status.timestamp - min_time).total_seconds()
+            if delta > self.time_delta:
                 logging.warning(
                     'Warning: time delta of %s is >%.2fs',
                     address, self.time_delta)
@@ -1009,7 +1206,9 @@ class CompoundPiCmd(Cmd):
 
         Alternatively you can specify two comma-separated floating-point
         numbers which specify the red and blue gains manually (between 0.0 and
-        8.0).
+        8.0). Finally, the mode 'off' fixes the gains of each server at the
+        values it is currently using (which will differ from server to server
+        if they were previously in an automatic mode).
 
         If no address is specified then all currently defined servers will be
         targetted. Multiple addresses can be specified with dash-separated
@@ -1022,11 +1221,19 @@ class CompoundPiCmd(Cmd):
         cpi> awb sunlight 192.168.0.1-192.168.0.10
         cpi> awb 1.8,1.5
         cpi> awb 1.0,1.0 192.168.0.1
+        cpi> awb off
         """
         if not arg:
             raise CmdSyntaxError('You must specify a mode')
         arg = arg.split(' ', 1)
-        if re.match(r'[a-z]+', arg[0]):
+        if arg[0].lower() == 'off':
+            self.client.awb_many({
+                address: (status.awb_red, status.awb_blue)
+                for address, status in self.client.status(
+                    self.parse_addresses(arg[1] if len(arg) > 1 else None)
+                    ).items()
+                })
+        elif re.match(r'[a-z]+', arg[0]):
             self.client.awb(
                 arg[0].lower(),
                 addresses=self.parse_addresses(arg[1] if len(arg) > 1 else None))
@@ -1053,6 +1260,7 @@ class CompoundPiCmd(Cmd):
                 'fluorescent',
                 'horizon',
                 'incandescent',
+                'off',
                 'shade',
                 'sunlight',
                 'tungsten',
@@ -1072,7 +1280,8 @@ class CompoundPiCmd(Cmd):
         The 'exposure' command is used to set the exposure mode of the camera
         on all or some of the defined servers. The mode can be 'auto' or a
         speed measured in ms. Please note that exposure speed is limited by
-        framerate.
+        framerate. The mode 'off' fixes the exposure speed of each server at
+        the value it is currently using.
 
         If no address is specified then all currently defined servers will be
         targetted. Multiple addresses can be specified with dash-separated
@@ -1083,11 +1292,19 @@ class CompoundPiCmd(Cmd):
         cpi> exposure auto
         cpi> exposure 30 192.168.0.1
         cpi> exposure auto 192.168.0.1-192.168.0.10
+        cpi> exposure off
         """
         if not arg:
             raise CmdSyntaxError('You must specify a mode')
         arg = arg.split(' ', 1)
-        if re.match(r'[a-z]+', arg[0]):
+        if arg[0].lower() == 'off':
+            self.client.exposure_many({
+                address: status.exposure_speed
+                for address, status in self.client.status(
+                    self.parse_addresses(arg[1] if len(arg) > 1 else None)
+                    ).items()
+                })
+        elif re.match(r'[a-z]+', arg[0]):
             self.client.exposure(
                 arg[0].lower(),
                 addresses=self.parse_addresses(arg[1] if len(arg) > 1 else None))
@@ -1109,6 +1326,7 @@ class CompoundPiCmd(Cmd):
         elif match.start('mode') < finish <= match.end('mode'):
             modes = [
                 'auto',
+                'off',
                 ]
             speeds = [
                 '16.666',
@@ -1530,6 +1748,86 @@ class CompoundPiCmd(Cmd):
     def complete_capture(self, text, line, start, finish):
         return self.complete_server(text, line, start, finish)
 
+    def do_arm(self, arg=''):
+        """
+        Prepares a capture on the defined servers.
+
+        Syntax: arm [addresses]
+
+        The 'arm' command causes the servers to prepare a capture which will
+        be taken when the 'fire' command is issued. The servers configure the
+        camera and fix its gains in advance so that the capture is taken with
+        as little delay as possible after the 'fire' command. The capture uses
+        the capture_count, capture_quality, and video_port configuration
+        settings; enabling video_port is recommended for the lowest delay.
+
+        The servers may take a moment to prepare (longer if they are busy with
+        other captures or recordings). Use 'disarm' to cancel the capture.
+
+        See also: fire, disarm, capture.
+
+        cpi> arm
+        cpi> fire
+        """
+        self.client.arm(
+            self.capture_count, self.video_port, self.capture_quality,
+            self.parse_addresses(arg))
+
+    def complete_arm(self, text, line, start, finish):
+        return self.complete_server(text, line, start, finish)
+
+    def do_disarm(self, arg=''):
+        """
+        Cancels a prepared capture on the defined servers.
+
+        Syntax: disarm [addresses]
+
+        The 'disarm' command cancels the capture prepared by the 'arm' command
+        without taking it.
+
+        See also: arm, fire.
+
+        cpi> disarm
+        cpi> disarm 192.168.0.1
+        """
+        self.client.disarm(self.parse_addresses(arg))
+
+    def complete_disarm(self, text, line, start, finish):
+        return self.complete_server(text, line, start, finish)
+
+    def do_fire(self, arg=''):
+        """
+        Takes the prepared capture on the defined servers.
+
+        Syntax: fire [addresses]
+
+        The 'fire' command causes the servers to take the capture prepared by
+        the 'arm' command. Each server reports the delay between receiving the
+        command and capturing the first image, which is displayed along with
+        the spread of delays across the servers. If no addresses are
+        specified, a single broadcast message is used to fire all servers
+        simultaneously.
+
+        See also: arm, disarm, capture.
+
+        cpi> arm
+        cpi> fire
+        """
+        responses = self.client.fire(self.parse_addresses(arg))
+        if not responses:
+            return
+        delays = responses.values()
+        self.pprint_table(
+            [('Address', 'Delay (ms)')] + [
+                (address, '%.1f' % (responses[address] * 1000))
+                for address in self.client.servers
+                if address in responses
+                ] + [('Spread', '%.1f' % ((max(delays) - min(delays)) * 1000))],
+            footer_rows=1)
+
+    def complete_fire(self, text, line, start, finish):
+        return self.complete_server(text, line, start, finish)
+
     def do_record(self, arg):
         """
         Record video from the defined servers.
@@ -1548,6 +1846,11 @@ class CompoundPiCmd(Cmd):
         still reasonably quick there will be a measurable difference between
         the timestamps of the last and first recordings.
 
+        If the record_segment configuration setting is non-zero, h264
+        recordings are split into several files of (approximately) that many
+        seconds each. Completed files can be listed and downloaded by other
+        clients while the recording continues.
+
         See also: capture, download, clear.
 
         cpi> record 5
@@ -1567,7 +1870,8 @@ class CompoundPiCmd(Cmd):
             length, self.record_format, self.record_quality,
             self.record_bitrate, self.record_intra_period, self.record_motion,
             self.record_delay,
-            self.parse_addresses(arg[1] if len(arg) > 1 else None))
+            self.parse_addresses(arg[1] if len(arg) > 1 else None),
+            self.record_segment or None)
 
     def complete_record(self, text, line, start, finish):
         cmd_re = re.compile(r'record(?P<length> +[^ ]+(?P<addr> +.*)?)?')
@@ -1579,6 +1883,91 @@ class CompoundPiCmd(Cmd):
             # No completions for length
             return []
 
+    def do_buffer(self, arg):
+        """
+        Continuously buffer video on the defined servers.
+
+        Syntax: buffer <length> [addresses]
+
+        The 'buffer' command causes the servers to continuously record video
+        into a circular buffer in memory, retaining only the last <length>
+        seconds. The 'trigger' command can then be used to save the content of
+        the buffer, including the period leading up to the trigger. A length
+        of 0 stops buffering and discards the buffers.
+
+        Buffering uses the record_quality, record_bitrate, and
+        record_intra_period configuration settings (video is always encoded as
+        h264), and continues alongside the 'capture' and 'record' commands
+        until stopped.
+
+        See also: trigger, record, download.
+
+        cpi> buffer 10
+        cpi> buffer 30 192.168.0.1
+        cpi> buffer 0
+        """
+        if not arg:
+            raise CmdSyntaxError('You must specify a buffer length')
+        arg = arg.split(' ', 1)
+        try:
+            length = float(arg[0])
+            if length < 0.0:
+                raise ValueError('Out of range')
+        except ValueError:
+            raise CmdSyntaxError('Invalid buffer length "%s"' % arg[0])
+        self.client.buffer(
+            length, self.record_quality, self.record_bitrate,
+            self.record_intra_period,
+            self.parse_addresses(arg[1] if len(arg) > 1 else None))
+
+    def complete_buffer(self, text, line, start, finish):
+        cmd_re = re.compile(r'buffer(?P<length> +[^ ]+(?P<addr> +.*)?)?')
+        match = cmd_re.match(line)
+        assert match
+        if match.start('addr') < finish <= match.end('addr'):
+            return self.complete_server(text, line, start, finish)
+        elif match.start('length') < finish <= match.end('length'):
+            # No completions for length
+            return []
+
+    def do_trigger(self, arg=''):
+        """
+        Save the video buffered on the defined servers.
+
+        Syntax: trigger [length] [addresses]
+
+        The 'trigger' command causes the servers to save the video buffered
+        by the 'buffer' command as a new file. If [length] is given, only the
+        last [length] seconds of the buffer are saved; otherwise the entire
+        buffer is saved. Note that this does not cause the video to be sent
+        to the client. See the 'download' command for more information.
+
+        Buffering continues after the command so it can be repeated for
+        subsequent events.
+
+        See also: buffer, download, clear.
+
+        cpi> trigger
+        cpi> trigger 5
+        cpi> trigger 5 192.168.0.1
+        """
+        length = None
+        if arg:
+            try:
+                length = float(arg.split(' ', 1)[0])
+            except ValueError:
+                # No length; the argument is entirely addresses
+                pass
+            else:
+                if length <= 0.0:
+                    raise CmdSyntaxError(
+                        'Invalid trigger length "%s"' % arg.split(' ', 1)[0])
+                arg = arg.split(' ', 1)[1] if ' ' in arg else ''
+        self.client.trigger(length, self.parse_addresses(arg))
+
+    def complete_trigger(self, text, line, start, finish):
+        return self.complete_server(text, line, start, finish)
+
     def do_download(self, arg=''):
         """
         Downloads captured files from the defined servers.
@@ -1587,8 +1976,15 @@ class CompoundPiCmd(Cmd):
 
         The 'download' command causes each server to send its captured files to
         the client. Servers are contacted consecutively to avoid saturating the
-        network bandwidth. Once all files are successfully downloaded from all
-        servers, all servers are wiped clean.
+        network bandwidth, and each server sends all its files over a single
+        connection. Once all files are successfully downloaded from all
+        servers, the downloaded files are wiped from the servers (files stored
+        after the download started, e.g. by a segmented recording, are kept).
+
+        Interrupted transfers are automatically resumed a few times. If the
+        command still fails, re-running it (even after restarting the client)
+        resumes any partially downloaded files from the data already written
+        to the output directory rather than starting them again.
 
         See also: capture, clear.
 
@@ -1596,20 +1992,66 @@ class CompoundPiCmd(Cmd):
         cpi> download 192.168.0.1
         """
         responses = self.client.list(self.parse_addresses(arg))
+        counts = {}
         for (address, files) in responses.items():
-            for f in files:
-                filename = '{ts:%Y%m%d-%H%M%S%f}-{addr}.{ext}'.format(
+            counts.setdefault(len(files), []).append(address)
+            filenames = {
+                f.index: os.path.join(
+                    self.output, '{ts:%Y%m%d-%H%M%S%f}-{addr}.{ext}'.format(
                         ts=f.timestamp, addr=address, ext={
                             'IMAGE': 'jpg',
                             'VIDEO': 'h264',
                             'MOTION': 'motion',
-                            }[f.filetype])
-                with io.open(os.path.join(self.output, filename), 'wb') as output:
-                    self.client.download(address, f.index, output)
-                    if output.tell() != f.size:
-                        raise CmdError('Wrong size for file %s' % filename)
+                            }[f.filetype]))
+                for f in files
+                }
+            # If none of the files exist, fetch them all in a single batch;
+            # otherwise a prior download failed part way and the remaining
+            # files are resumed individually below
+            if not any(os.path.exists(filename) for filename in filenames.values()):
+                self.download_batch(address, len(files), filenames)
+            for f in files:
+                filename = filenames[f.index]
+                if os.path.exists(filename):
+                    existing = os.path.getsize(filename)
+                else:
+                    existing = None
+                if existing != f.size:
+                    # Open partial files for update so that the download
+                    # resumes from the data already received; anything larger
+                    # than the file can't be a partial download of it
+                    resume = existing is not None and existing < f.size
+                    mode = 'r+b' if resume else 'wb'
+                    with io.open(filename, mode) as output:
+                        self.client.download(
+                            address, f.index, output,
+                            retries=self.download_retries, resume=resume)
+                        if output.tell() != f.size:
+                            raise CmdError('Wrong size for file %s' % filename)
                 logging.info('Downloaded %s' % filename)
-        self.client.clear(self.parse_addresses(arg))
+        # Only clear the files that were listed (and thus downloaded); others
+        # may have been stored since, e.g. by a segmented recording. Servers
+        # with the same number of files are cleared together
+        for count, addresses in counts.items():
+            if count:
+                self.client.clear(addresses, count)
+
+    def download_batch(self, address, count, filenames):
+        outputs = []
+        def factory(f):
+            # Files are received sequentially so the prior output is complete
+            if outputs:
+                outputs[-1].close()
+            outputs.append(io.open(filenames[f.index], 'wb'))
+            return outputs[-1]
+        try:
+            self.client.download_many(address, factory, 0, count)
+        except (CompoundPiSendTimeout, CompoundPiSendTruncated) as e:
+            # Any files not received in full will be fetched individually
+            logging.warning(str(e))
+        finally:
+            if outputs:
+                outputs[-1].close()
 
     def complete_download(self, text, line, start, finish):
         return self.complete_server(text, line, start, finish)
@@ -1672,8 +2114,8 @@ class CompoundPiCmd(Cmd):
         close as possible to the output of the selected reference server.
 
         A single address must be specified, from which settings will be
-        obtained, after which broadcasts will be used to update the settings on
-        all currently defined servers.
+        obtained, after which a single broadcast will be used to update the
+        settings on all currently defined servers.
 
         See also: status, servers.
 
@@ -1681,46 +2123,39 @@ class CompoundPiCmd(Cmd):
         """
         addr = self.parse_address(arg)
         status = self.client.status([addr])[addr]
-        # Before we go setting resolution and framerate (which will reset the
-        # cameras, ensure AGC gains are allowed to float)
-        logging.info('Setting resolution and framerate')
-        self.client.agc('auto')
-        self.client.resolution(*status.resolution)
-        self.client.framerate(status.framerate)
-        logging.info('Setting white balance')
-        if status.awb_mode == 'off':
-            self.client.awb('off', status.awb_red, status.awb_blue)
-        else:
-            self.client.awb(status.awb_mode)
-        logging.info('Setting gain algorithm')
+        # All settings are sent in a single command. If the reference server's
+        # gains are fixed, let the gains float to begin with as setting the
+        # resolution and framerate may reset the cameras
+        logging.info('Configuring servers')
+        self.client.configure(
+            resolution=status.resolution,
+            framerate=status.framerate,
+            awb_mode=status.awb_mode,
+            awb_red=status.awb_red if status.awb_mode == 'off' else None,
+            awb_blue=status.awb_blue if status.awb_mode == 'off' else None,
+            agc_mode='auto' if status.agc_mode == 'off' else status.agc_mode,
+            exposure_mode=status.exposure_mode,
+            exposure_speed=(
+                status.exposure_speed if status.exposure_mode == 'off' else
+                None),
+            ev=status.ev,
+            iso=status.iso,
+            metering_mode=status.metering_mode,
+            brightness=status.brightness,
+            contrast=status.contrast,
+            saturation=status.saturation,
+            denoise=status.denoise,
+            hflip=status.hflip,
+            vflip=status.vflip,
+            )
         if status.agc_mode == 'off':
             logging.info('Pausing for camera gains to settle')
-            # We've just reset the resolution and framerate which has reset all
-            # the cameras. Given we can't directly set the gains we need to
-            # wait a decent number of frames to let the gains settle before we
-            # disable AGC. Here we wait long enough for 30 frames to have
-            # been captured (1 second at "normal" framerates)
+            # Given we can't directly set the gains we need to wait a decent
+            # number of frames to let the gains settle before we disable AGC.
+            # Here we wait long enough for 30 frames to have been captured (1
+            # second at "normal" framerates)
             time.sleep(30.0 / status.framerate)
             self.client.agc('off')
-        else:
-            self.client.agc(status.agc_mode)
-        logging.info('Setting exposure speed')
-        if status.exposure_mode == 'off':
-            self.client.exposure('off', status.exposure_speed)
-        else:
-            self.client.exposure(status.exposure_mode)
-        self.client.ev(status.ev)
-        logging.info('Setting ISO and metering')
-        self.client.iso(status.iso)
-        self.client.metering(status.metering_mode)
-        logging.info('Setting levels')
-        self.client.brightness(status.brightness)
-        self.client.contrast(status.contrast)
-        self.client.saturation(status.saturation)
-        logging.info('Setting denoise')
-        self.client.denoise(status.denoise)
-        logging.info('Setting orientation')
-        self.client.flip(status.hflip, status.vflip)
 
     def complete_reference(self, text, line, start, finish):
         return self.complete_server(text, line, start, finish)
@@ -32,7 +32,11 @@ except ImportError:
     pass
 
 import sys
+import os
+import io
 import re
+import errno
+import json
 import warnings
 import datetime
 import time
@@ -48,6 +52,7 @@ try:
 except ImportError:
     import socketserver
 import inspect
+import numbers
 from functools import wraps, total_ordering
 from fractions import Fraction
 from collections import namedtuple
@@ -59,16 +64,18 @@ except ImportError:
 
 from . import __version__
 from .ipaddress import IPv4Address, IPv4Network
-from .common import NetworkRepeater
+from .common import NetworkRepeater, target_selector
 from .protocol import CompoundPiProtocol
 from .exc import (
     CompoundPiBadResponse,
+    CompoundPiClientError,
     CompoundPiFutureResponse,
     CompoundPiHelloError,
     CompoundPiInvalidResponse,
     CompoundPiMissingResponse,
     CompoundPiMultiResponse,
     CompoundPiNoServers,
+    CompoundPiPacketsDropped,
     CompoundPiRedefinedServer,
     CompoundPiSendTimeout,
     CompoundPiSendTruncated,
@@ -77,6 +84,7 @@ from .exc import (
     CompoundPiTransactionFailed,
     CompoundPiUndefinedServers,
     CompoundPiUnknownAddress,
+    CompoundPiWindowFull,
     CompoundPiWrongPort,
     CompoundPiWrongVersion,
     )
@@ -255,6 +263,7 @@ class CompoundPiFile(namedtuple('CompoundPiFile', (
     'index',
     'timestamp',
     'size',
+    'requested',
     ))):
     """
     This class is a namedtuple derivative used to store information about an
@@ -281,7 +290,225 @@ class CompoundPiFile(namedtuple('CompoundPiFile', (
     .. attribute:: size
 
         Specifies the size of the file as an integer number of bytes.
+
+    .. attribute:: requested
+
+        If the file is the first produced by a synchronized capture or
+        recording (see the *delay* parameter of
+        :meth:`CompoundPiClient.capture`), specifies the timestamp the capture
+        was scheduled for as a :class:`~datetime.datetime` instance. In this
+        case, :attr:`timestamp` is the time the server actually started the
+        capture. Otherwise, this is ``None``.
+    """
+
+    def __new__(cls, filetype, index, timestamp, size, requested=None):
+        return super(CompoundPiFile, cls).__new__(
+            cls, filetype, index, timestamp, size, requested)
+
+
+class CompoundPiTransfer(namedtuple('CompoundPiTransfer', (
+    'id',
+    'state',
+    'message',
+    ))):
+    """
+    This class is a namedtuple derivative used to store the state of a file
+    transfer on a Compound Pi server. It is recommended you access the
+    information stored by this class by attribute name rather than position
+    (for example: ``t.state`` rather than ``t[1]``).
+
+    .. attribute:: id
+
+        Specifies the integer identifier of the transfer on the server.
+
+    .. attribute:: state
+
+        Specifies the state of the transfer. Can be one of ``QUEUED``,
+        ``SENDING``, ``DONE``, or ``FAILED``.
+
+    .. attribute:: message
+
+        If :attr:`state` is ``FAILED``, describes the error that occurred.
+        Otherwise, this is an empty string.
+    """
+
+
+class CompoundPiJobStatus(namedtuple('CompoundPiJobStatus', (
+    'id',
+    'state',
+    'progress',
+    'message',
+    ))):
+    """
+    This class is a namedtuple derivative used to store the state of a capture
+    or recording job on a Compound Pi server. It is recommended you access the
+    information stored by this class by attribute name rather than position
+    (for example: ``j.progress`` rather than ``j[2]``).
+
+    .. attribute:: id
+
+        Specifies the integer identifier of the job on the server.
+
+    .. attribute:: state
+
+        Specifies the state of the job. Can be one of ``QUEUED``,
+        ``RUNNING``, ``DONE``, or ``FAILED``.
+
+    .. attribute:: progress
+
+        Specifies the proportion of the job that is complete as a float
+        between 0.0 and 1.0.
+
+    .. attribute:: message
+
+        If :attr:`state` is ``FAILED``, describes the error that occurred.
+        Otherwise, this is an empty string.
+    """
+
+
+class CompoundPiClock(namedtuple('CompoundPiClock', (
+    'offset',
+    'delay',
+    ))):
+    """
+    This class is a namedtuple derivative used to store the estimated offset
+    of a Compound Pi server's clock from the client's clock, as measured by
+    :meth:`CompoundPiClient.time_sync`. It is recommended you access the
+    information stored by this class by attribute name rather than position
+    (for example: ``c.offset`` rather than ``c[0]``).
+
+    .. attribute:: offset
+
+        Specifies the number of seconds (as a float) which must be added to
+        the client's clock to obtain the server's clock.
+
+    .. attribute:: delay
+
+        Specifies the round-trip time (in seconds, as a float) of the exchange
+        the offset was measured from, excluding the time the server took to
+        respond. The error in :attr:`offset` is at most half this value.
+    """
+
+
+class CompoundPiJob(object):
+    """
+    Represents a capture or recording executing in the background on one or
+    more Compound Pi servers. Instances of this class are returned by
+    :meth:`CompoundPiClient.capture_async` and
+    :meth:`CompoundPiClient.record_async`; they should not be constructed
+    directly.
+
+    The :attr:`jobs` attribute is a mapping of server address to the job's
+    identifier on that server. The :meth:`poll` method queries the servers for
+    the state of their jobs, while :meth:`wait` blocks until all jobs have
+    finished. Files produced by a job can be listed and downloaded while the
+    job is still running.
+    """
+    def __init__(self, client, jobs):
+        self._client = client
+        self.jobs = jobs
+        self.status = {}
+
+    @property
+    def done(self):
+        """
+        Returns ``True`` if the last call to :meth:`poll` found that all jobs
+        had finished (successfully or otherwise).
+        """
+        return all(
+            address in self.status and
+            self.status[address].state in ('DONE', 'FAILED')
+            for address in self.jobs
+            )
+
+    def poll(self):
+        """
+        Queries the servers whose jobs have not yet finished for the state of
+        their jobs, and returns a mapping of server address to
+        :class:`CompoundPiJobStatus` (which is also stored in the
+        :attr:`status` attribute).
+        """
+        addresses = [
+            address for address in self.jobs
+            if address not in self.status
+            or self.status[address].state not in ('DONE', 'FAILED')
+            ]
+        if addresses:
+            responses = self._client.jobs(addresses)
+            for address in addresses:
+                if address not in responses:
+                    # A straggler in quorum mode; poll it again next time
+                    continue
+                for job in responses[address]:
+                    if job.id == self.jobs[address]:
+                        self.status[address] = job
+                        break
+                else:
+                    self.status[address] = CompoundPiJobStatus(
+                        self.jobs[address], 'FAILED', 0.0,
+                        'Unknown job %d' % self.jobs[address])
+        return self.status
+
+    def wait(self, timeout=None, interval=0.5):
+        """
+        Blocks until all jobs have finished, polling the servers every
+        *interval* seconds. If *timeout* is specified and the jobs have not
+        finished after that many seconds, ``False`` is returned. Otherwise,
+        ``True`` is returned. If any jobs failed,
+        :exc:`~compoundpi.exc.CompoundPiTransactionFailed` is raised.
+        """
+        if timeout is not None:
+            timeout = time.time() + timeout
+        while True:
+            self.poll()
+            if self.done:
+                break
+            if timeout is not None and time.time() > timeout:
+                return False
+            time.sleep(interval)
+        errors = [
+            CompoundPiServerError(address, job.message)
+            for address, job in self.status.items()
+            if job.state == 'FAILED'
+            ]
+        if errors:
+            raise CompoundPiTransactionFailed(
+                errors, '%d jobs failed' % len(errors))
+        return True
+
+
+class CompoundPiResponses(dict):
     """
+    A mapping of server address to response data returned by
+    :meth:`CompoundPiServerList.transact`, and by the methods of
+    :class:`CompoundPiClient` which return per-server results.
+
+    In addition to the responses of the servers that succeeded, when a
+    transaction is executed in quorum mode (see
+    :meth:`CompoundPiServerList.transact`) instances record the servers that
+    failed or did not respond in time, instead of raising an exception.
+
+    .. attribute:: failed
+
+        A mapping of server address to the exception describing the error
+        returned by that server (or the invalid response it sent).
+
+    .. attribute:: stragglers
+
+        The set of addresses of the servers which had not responded when the
+        transaction completed.
+    """
+    def __init__(self, responses=(), failed=None, stragglers=None):
+        super(CompoundPiResponses, self).__init__(responses)
+        self.failed = {} if failed is None else failed
+        self.stragglers = set() if stragglers is None else stragglers
+
+    @property
+    def succeeded(self):
+        """
+        The set of addresses of the servers which responded successfully.
+        """
+        return set(self)
 
 
 def client(cls):
@@ -327,6 +554,113 @@ class CompoundPiClientProtocol(CompoundPiProtocol):
     pass
 
 
+class CompoundPiRTTEstimate(object):
+    """
+    Estimates the round-trip time to a Compound Pi server, and from it the
+    retransmission timeout (RTO) to use for commands sent to that server.
+
+    The estimate follows the method of Jacobson and Karels, as specified by
+    :rfc:`6298`. Samples are added with :meth:`update`; following Karn's
+    algorithm, the client only samples the round-trip time of commands that
+    were not retransmitted. The :meth:`backoff` method doubles the RTO and is
+    called when a server fails to respond at all. The RTO is always kept
+    between *min_rto* and *max_rto* seconds, and is *rto* seconds before any
+    samples have been added.
+
+    .. attribute:: srtt
+
+        The smoothed round-trip time in seconds, or ``None`` if no samples
+        have been added.
+
+    .. attribute:: rttvar
+
+        The round-trip time variation in seconds, or ``None`` if no samples
+        have been added.
+
+    .. attribute:: rto
+
+        The current retransmission timeout in seconds.
+
+    .. attribute:: samples
+
+        The number of samples added to the estimate.
+    """
+    alpha = 1 / 8
+    beta = 1 / 4
+    k = 4
+
+    def __init__(self, rto=0.5, min_rto=0.1, max_rto=5.0):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.samples = 0
+
+    def __repr__(self):
+        if self.srtt is None:
+            return '<CompoundPiRTTEstimate rto=%.3f>' % self.rto
+        return '<CompoundPiRTTEstimate srtt=%.3f rttvar=%.3f rto=%.3f>' % (
+            self.srtt, self.rttvar, self.rto)
+
+    def update(self, rtt):
+        """
+        Adds the round-trip time *rtt* (in seconds) to the estimate.
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (
+                (1 - self.beta) * self.rttvar +
+                self.beta * abs(self.srtt - rtt))
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self.samples += 1
+        self.rto = max(self.min_rto, min(self.max_rto,
+            self.srtt + self.k * self.rttvar))
+
+    def backoff(self):
+        """
+        Doubles the retransmission timeout (up to the maximum).
+        """
+        self.rto = min(self.max_rto, self.rto * 2)
+
+
+# Permits the receive loop to drain the socket without blocking; where this
+# isn't available (Windows) a single datagram is read per select()
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+def _udp_drops(sock):
+    # Returns the number of datagrams the kernel has dropped for *sock*
+    # (because its receive buffer was full) from /proc/net/udp, or None if
+    # this isn't available (i.e. on platforms other than Linux)
+    try:
+        inode = os.fstat(sock.fileno()).st_ino
+        with io.open('/proc/net/udp', 'r') as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if int(fields[9]) == inode:
+                    return int(fields[12])
+    except (IOError, OSError, ValueError, IndexError, TypeError):
+        pass
+    return None
+
+
+def _packed_address(address):
+    # Returns the 32-bit integer form of *address*, which may be an
+    # IPv4Address or a dotted-quad string. Strings (as returned by recvfrom)
+    # are converted without constructing an address object
+    if isinstance(address, IPv4Address):
+        return int(address)
+    try:
+        return struct.unpack(
+            native_str('!L'), socket.inet_aton(native_str(address)))[0]
+    except (socket.error, UnicodeError):
+        raise ValueError('%s is not a valid IPv4 address' % address)
+
+
 @total_ordering
 class CompoundPiServerList(object):
     """
@@ -373,19 +707,68 @@ class CompoundPiServerList(object):
 
     The class assumes the servers are listening on UDP port 5647 by default.
     This can be altered via the :attr:`port` attribute.
+
+    By default, transactions wait up to :attr:`timeout` seconds for all
+    servers to respond. If the :attr:`quorum` attribute is set to an integer
+    or the :attr:`deadline` attribute to a number of seconds, transactions are
+    executed in quorum mode instead (see :meth:`transact`), returning once
+    enough servers have responded and reporting the servers that failed or
+    didn't respond rather than raising an exception.
+
+    Commands that differ from server to server can be sent in a single
+    transaction with :meth:`transact_many`.
+
+    The list, along with the time each server was last seen and the version it
+    reported, can be written to a cache file with :meth:`save` and restored
+    (and revalidated) with :meth:`load`, avoiding a broadcast :meth:`find` on
+    start-up.
+
+    Several transactions may be outstanding at once (see :attr:`window` and
+    :meth:`transact_async`); responses are matched to their transactions by
+    sequence number.
+
+    Commands are retransmitted with exponential backoff, starting from a
+    retransmission timeout estimated from the round-trip times of previous
+    commands. The :attr:`rtt` attribute maps server addresses to their
+    :class:`CompoundPiRTTEstimate` for monitoring purposes. Broadcast commands
+    start from the largest timeout of the servers addressed, and are repeated
+    less frequently as the number of servers yet to respond falls.
+
+    Responses are drained from the socket in batches, and the socket's
+    receive buffer is sized according to the number of servers, so that
+    bursts of responses from large numbers of servers aren't lost. Where the
+    platform reports them, any datagrams dropped by the kernel regardless are
+    counted in :attr:`drops` and reported with a
+    :exc:`~compoundpi.exc.CompoundPiPacketsDropped` warning.
     """
+
+    # The maximum number of datagrams read before the clock is checked, and
+    # the minimum interval (in seconds) between progress updates
+    _batch = 256
+    _progress_interval = 0.1
+
     def __init__(self, progress):
         self._protocol = CompoundPiClientProtocol()
         self._seqno = 0
+        self._rcvbuf = 0
         self._items = []
+        self._seen = {}
         self._senders = {}
+        self._pending = {}
+        self._partial = {}
+        self._window = 1
+        self.rtt = {}
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self._drops = _udp_drops(self._socket) or 0
         self._progress = progress
         self.network = '192.168.0.0/16'
         self.port = 5647
         self.timeout = 15
+        self.quiet = 2
+        self.quorum = None
+        self.deadline = None
 
     def __repr__(self):
         return '[%s]' % ', '.join(repr(a) for a in self)
@@ -401,11 +784,9 @@ class CompoundPiServerList(object):
 
     def __contains__(self, address):
         try:
-            self.index(address)
+            return _packed_address(address) in self._index
         except ValueError:
             return False
-        else:
-            return True
 
     def __getitem__(self, index):
         return self._items[index]
@@ -462,10 +843,58 @@ class CompoundPiServerList(object):
             port. Both simply default to 5647 for the sake of simplicity.
         """)
 
+    def _get_items(self):
+        return self._order
+    def _set_items(self, value):
+        # The list of servers is backed by an index keyed by the packed form
+        # of each address (mapping to the address object and its string
+        # form) so that membership tests and the response hot path don't
+        # construct (or search for) address objects. The order of servers
+        # lives only in the list, so index(), remove() and move() still
+        # search it and remain O(n); the index merely validates and
+        # normalizes the address before that search
+        self._order = list(value)
+        self._index = {
+            int(address): (address, str(address))
+            for address in self._order
+            }
+        self._size_buffer(len(self._order))
+    _items = property(_get_items, _set_items)
+
+    def _size_buffer(self, count):
+        # Grow the receive buffer to hold a response from each of *count*
+        # servers. The kernel's accounting of each datagram is much larger
+        # than its content, hence the generous allowance. Linux silently caps
+        # the value at net.core.rmem_max
+        size = min(max(count * 2048, 262144), 8388608)
+        if count and size > self._rcvbuf:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+            self._rcvbuf = size
+
+    def _check_drops(self):
+        drops = _udp_drops(self._socket)
+        if drops is not None:
+            if drops > self._drops:
+                warnings.warn(CompoundPiPacketsDropped(drops - self._drops))
+            self._drops = drops
+
+    @property
+    def drops(self):
+        """
+        Returns the number of response datagrams that the kernel has dropped
+        because the client's receive buffer was full. This is only available
+        on Linux (where it is read from ``/proc/net/udp``); on other
+        platforms it is always 0.
+        """
+        return self._drops
+
     def _get_network(self):
         return self._network
     def _set_network(self, value):
         self._network = IPv4Network(value)
+        self._netmask = int(self._network.netmask)
+        self._netaddr = int(self._network.broadcast_address) & self._netmask
+        self._broadcast = str(self._network.broadcast_address)
         self._items = []
     network = property(_get_network, _set_network, doc="""
         Defines the network that all servers belong to.
@@ -504,9 +933,59 @@ class CompoundPiServerList(object):
         :exc:`CompoundPiTransactionFailed` error will be raised.
         """)
 
+    def _get_quiet(self):
+        return self._quiet
+    def _set_quiet(self, value):
+        value = float(value)
+        if value <= 0:
+            raise ValueError('quiet period must be greater than 0')
+        self._quiet = value
+    quiet = property(_get_quiet, _set_quiet, doc="""
+        Defines the quiet period used by :meth:`find`.
+
+        When :meth:`find` is called without an expected count of servers, it
+        stops waiting for responses once no new server has responded for
+        this number of seconds (2 by default), rather than waiting for the
+        full :attr:`timeout`.
+        """)
+
+    def _get_window(self):
+        return self._window
+    def _set_window(self, value):
+        value = int(value)
+        if not 1 <= value <= self._protocol.window:
+            raise ValueError(
+                'window must be between 1 and %d' % self._protocol.window)
+        self._window = value
+    window = property(_get_window, _set_window, doc="""
+        Defines the number of transactions that may be outstanding at once.
+
+        This attribute defaults to 1, meaning each transaction must complete
+        before the next is started. Setting it to a larger value (up to 32)
+        permits several transactions to be started with
+        :meth:`transact_async` before their responses are collected. For
+        example, to change the brightness of two groups of cameras without
+        waiting for the first group to respond before commanding the second::
+
+            from compoundpi.client import CompoundPiClient
+
+            with CompoundPiClient() as client:
+                client.servers.network = '192.168.0.0/24'
+                client.servers.find(10)
+                client.servers.window = 2
+                left = client.servers.transact_async(
+                    'BRIGHTNESS 40', client.servers[:5])
+                right = client.servers.transact_async(
+                    'BRIGHTNESS 60', client.servers[5:])
+                left.result()
+                right.result()
+        """)
+
     def index(self, address):
-        if not isinstance(address, IPv4Address):
-            address = IPv4Address(address)
+        try:
+            address, name = self._index[_packed_address(address)]
+        except KeyError:
+            raise ValueError('%s is not in the server list' % address)
         return self._items.index(address)
 
     def count(self, address):
@@ -544,6 +1023,8 @@ class CompoundPiServerList(object):
                 CompoundPiMissingResponse(address)
                 ])
         self._items.insert(index, address)
+        self._index[int(address)] = (address, str(address))
+        self._size_buffer(len(self._items))
 
     def append(self, address):
         """
@@ -592,8 +1073,10 @@ class CompoundPiServerList(object):
         Attempting to remove an address that is not present in the client's
         list will raise a :exc:`ValueError`.
         """
-        if not isinstance(address, IPv4Address):
-            address = IPv4Address(address)
+        try:
+            address, name = self._index.pop(_packed_address(address))
+        except KeyError:
+            raise ValueError('%s is not in the server list' % address)
         self._items.remove(address)
 
     def move(self, index, address):
@@ -619,15 +1102,24 @@ class CompoundPiServerList(object):
         """
         self._items.sort(key=key, reverse=reverse)
 
-    def find(self, count=0):
+    def find(self, count=0, quiet=None, networks=None):
         """
         Called to discover servers on the client's network. The :meth:`find`
         method broadcasts a :ref:`protocol_hello` message to the currently
         configured network. If called with no expected *count*, the method then
-        waits for the network :attr:`timeout` (default 15 seconds) and adds all
+        waits until no new server has replied for *quiet* seconds (which
+        defaults to the :attr:`quiet` attribute), or for the network
+        :attr:`timeout` (default 15 seconds) whichever is shorter, and adds all
         servers that replied to the broadcast to the client's list. If called
         with an expected *count* value, the method will terminate as soon as
-        *count* servers have replied.
+        *count* servers have replied (or the timeout elapses; the quiet period
+        only applies if *quiet* is explicitly specified).
+
+        If *networks* is specified, it is a list of networks (in the same
+        format as :attr:`network`) which are all searched simultaneously
+        instead of :attr:`network`; this can be used to discover servers on
+        several subnets or interfaces at once. Servers found outside of
+        :attr:`network` are sent commands by unicast.
 
         .. note::
 
@@ -650,12 +1142,110 @@ class CompoundPiServerList(object):
         This method or the :meth:`append` method are usually the first methods
         called after construction and configuration of the client instance.
         """
+        if quiet is None and not count:
+            quiet = self.quiet
+        if networks is None:
+            networks = [self.network]
+        else:
+            networks = [
+                network if isinstance(network, IPv4Network) else
+                IPv4Network(network)
+                for network in networks
+                ]
         self._items = []
+        self._size_buffer(count or sum(
+            network.num_addresses for network in networks))
         self._seqno += 1
         data = '%d %s' % (self._seqno, self._protocol.do_hello(time.time()))
-        self._send_command(
-            (str(self.network.broadcast_address), self.port), self._seqno, data)
-        self._items = self._parse_ping(self._responses(count=count))
+        for network in networks:
+            self._send_command(
+                (str(network.broadcast_address), self.port), self._seqno, data)
+        self._items = self._parse_ping(dict(self._iter_responses(
+            count=count, quiet=quiet, networks=networks)))
+
+    def save(self, filename):
+        """
+        Called to write the server list to the cache file *filename*. The
+        cache records the configured :attr:`network` and :attr:`port`, and the
+        address of each server in the list along with the time it last
+        responded to a :ref:`protocol_hello` and the version it reported. The
+        list can be restored with :meth:`load`.
+        """
+        servers = []
+        for address in self._items:
+            seen, version = self._seen.get(address, (None, None))
+            servers.append({
+                'address': str(address),
+                'seen': seen,
+                'version': version,
+                })
+        with io.open(filename, 'w', encoding='utf-8') as f:
+            f.write(str(json.dumps({
+                'network': str(self.network),
+                'port': self.port,
+                'servers': servers,
+                })))
+
+    def load(self, filename, count=0):
+        """
+        Called to restore the server list from the cache file *filename*
+        written by :meth:`save`. All servers in the cache are sent a
+        :ref:`protocol_hello` simultaneously by unicast, and those that reply
+        (within the :attr:`quiet` period of the last reply) with the correct
+        version replace the content of the list, in their cached order.
+
+        If the cache cannot be read, or was written for a different
+        :attr:`network` or :attr:`port`, or none of its servers replied, this
+        method falls back to a broadcast :meth:`find`. If an expected *count*
+        is given, and fewer servers than this replied, a broadcast
+        :meth:`find` is used to fill the gaps; servers it discovers are
+        appended to those revalidated. For example::
+
+            from compoundpi.client import CompoundPiClient
+
+            with CompoundPiClient() as client:
+                client.servers.network = '192.168.2.0/24'
+                client.servers.load('servers.json', 10)
+                assert len(client.servers) == 10
+                client.servers.save('servers.json')
+
+        .. note::
+
+            As with :meth:`find`, no exception is raised if *count* servers
+            don't reply. Cached servers that fail to reply are simply omitted
+            from the list.
+        """
+        try:
+            with io.open(filename, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            if (
+                    str(IPv4Network(cache['network'])) != str(self.network) or
+                    int(cache['port']) != self.port):
+                raise ValueError('cache does not match the configuration')
+            addresses = []
+            for entry in cache['servers']:
+                address = IPv4Address(entry['address'])
+                if address not in addresses:
+                    addresses.append(address)
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            self.find(count)
+            return
+        self._items = []
+        if addresses:
+            self._size_buffer(len(addresses))
+            self._seqno += 1
+            data = '%d %s' % (self._seqno, self._protocol.do_hello(time.time()))
+            for address in addresses:
+                self._send_command(
+                    (str(address), self.port), self._seqno, data)
+            found = self._parse_ping(dict(self._iter_responses(
+                set(addresses), quiet=self.quiet)))
+            self._items = [address for address in addresses if address in found]
+        if not self._items or (count and len(self._items) < count):
+            found = self._items
+            self.find(count)
+            self._items = found + [
+                address for address in self._items if address not in found]
 
     def _parse_ping(self, responses):
         addresses = list(responses.keys())
@@ -665,120 +1255,515 @@ class CompoundPiServerList(object):
                 if response != 'VERSION %s' % __version__:
                     warnings.warn(CompoundPiWrongVersion(address, response))
                     addresses.remove(address)
+                else:
+                    self._seen[address] = (time.time(), __version__)
             else:
                 warnings.warn(CompoundPiHelloError(address, response))
                 addresses.remove(address)
         return addresses
 
+    def _rto(self, address):
+        try:
+            return self.rtt[address].rto
+        except KeyError:
+            return CompoundPiRTTEstimate().rto
+
     def _send_command(self, address, seqno, data):
         assert self._protocol.request_re.match(data)
         logging.debug('%s Tx %s', address, data)
         if isinstance(data, str):
             data = data.encode('utf-8')
+        if address[0] == self._broadcast:
+            interval = max(
+                [self._rto(server) for server in self._items] or
+                [self._rto(None)])
+        else:
+            try:
+                interval = self._rto(
+                    self._index[_packed_address(address[0])][0])
+            except KeyError:
+                interval = self._rto(IPv4Address(address[0]))
         self._senders[(address, seqno)] = NetworkRepeater(
-            self._socket, address, data)
+            self._socket, address, data, interval=interval, backoff=2)
+
+    def _sample(self, sender, address):
+        # Karn's algorithm: the round-trip time of a retransmitted command is
+        # ambiguous so only commands sent once are sampled
+        if sender.sends == 1:
+            self.rtt.setdefault(address, CompoundPiRTTEstimate()).update(
+                time.time() - sender.sent)
 
     def _responses(self, servers=None, count=0):
+        return dict(self._iter_responses(servers, count))
+
+    def _iter_responses(self, servers=None, count=0, timeout=None, seqno=None,
+            quiet=None, networks=None):
+        if timeout is None:
+            timeout = self.timeout
+        if seqno is None:
+            seqno = self._seqno
         if servers is None:
             servers = self._items
+        if networks is None:
+            networks = [self.network]
         if not count:
             count = len(servers)
-        if not servers:
-            servers = self.network
+        if servers:
+            space = None
+            targets = {int(address): address for address in servers}
+        else:
+            # Accept responses from any address in the broadcast network(s)
+            space = CompoundPiAddressSpace(networks)
+            targets = {}
             if not count:
-                count = sum(1 for a in self.network)
+                count = sum(network.num_addresses for network in networks)
+        broadcasts = [
+            (
+                (str(network.broadcast_address), self.port),
+                int(network.broadcast_address) & int(network.netmask),
+                int(network.netmask),
+                )
+            for network in networks
+            ]
         self._progress.start(count)
         result = {}
-        start = time.time()
+        start = last = time.time()
+        # The largest retransmission timeout of the servers that have
+        # responded, maintained incrementally to keep each response O(1)
+        max_rto = 0.0
         try:
-            while time.time() - start < self.timeout:
-                self._progress.update(len(result))
+            # Responses to an outstanding transaction may have been received
+            # while collecting the responses of another
+            for address, response in self._pending.pop(seqno, {}).items():
+                result[address] = response
+                max_rto = max(max_rto, self._rto(address))
+                yield address, response
+            now = updated = time.time()
+            while (
+                    len(result) < count and
+                    now - start < timeout and
+                    (quiet is None or now - last < quiet)):
+                if now - updated >= self._progress_interval:
+                    # Progress callbacks are throttled; a burst of hundreds
+                    # of responses needn't produce hundreds of updates
+                    self._progress.update(len(result))
+                    updated = now
                 if select.select([self._socket], [], [], 1)[0]:
-                    data, server_address = self._socket.recvfrom(512)
-                    data = data.decode('utf-8')
-                    logging.debug('%s Rx %s', server_address, data)
-                    match = self._protocol.response_re.match(data)
-                    address, port = server_address
-                    address = IPv4Address(address)
-                    if port != self.port:
-                        warnings.warn(CompoundPiWrongPort(address, port))
-                    elif address in result:
-                        warnings.warn(CompoundPiMultiResponse(address))
-                    elif address not in servers:
-                        warnings.warn(CompoundPiUnknownAddress(address))
-                    elif not match:
-                        warnings.warn(CompoundPiBadResponse(address))
-                    else:
-                        seqno = int(match.group('seqno'))
-                        # Unconditionally send an ACK to silence the responder
-                        # of whatever server sent the message
-                        ack_msg = ('%d ACK' % seqno).encode('utf-8')
-                        self._socket.sendto(ack_msg, server_address)
-                        # Silence the sender that the response corresponds
-                        # to (if any)
-                        sender = self._senders.get((server_address, seqno))
-                        if sender:
-                            sender.terminate = True
-                            # We deliberately don't join() the sender here
-                            # to ensure we don't delay receiving the next
-                            # response
-                        if seqno < self._seqno:
-                            warnings.warn(CompoundPiStaleResponse(address))
-                        elif seqno > self._seqno:
-                            warnings.warn(CompoundPiFutureResponse(address))
-                        else:
-                            result[address] = (
-                                    match.group('result'),
-                                    match.group('data'),
-                                    )
-                            if len(result) == count:
+                    # Drain the socket of all queued datagrams (up to a batch
+                    # limit) before checking the clock again, so that bursts
+                    # of responses don't overflow the receive buffer
+                    for i in range(self._batch if _MSG_DONTWAIT else 1):
+                        if len(result) >= count:
+                            break
+                        try:
+                            data, server_address = self._socket.recvfrom(
+                                self._protocol.max_datagram, _MSG_DONTWAIT)
+                        except socket.error as e:
+                            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
                                 break
+                            raise
+                        data = data.decode('utf-8')
+                        logging.debug('%s Rx %s', server_address, data)
+                        match = self._protocol.response_re.match(data)
+                        host, port = server_address
+                        if port != self.port:
+                            warnings.warn(CompoundPiWrongPort(IPv4Address(host), port))
+                        elif not match:
+                            warnings.warn(CompoundPiBadResponse(IPv4Address(host)))
+                        else:
+                            packed = _packed_address(host)
+                            response_seqno = int(match.group('seqno'))
+                            fragment = match.group('fragment')
+                            # Unconditionally send an ACK to silence the responder
+                            # of whatever server sent the message (or fragment)
+                            if fragment is None:
+                                ack_msg = '%d ACK' % response_seqno
+                            else:
+                                fragment = int(fragment)
+                                ack_msg = '%d.%d ACK' % (response_seqno, fragment)
+                            self._socket.sendto(
+                                ack_msg.encode('utf-8'), server_address)
+                            # Silence the sender that the response corresponds
+                            # to (if any)
+                            sender = self._senders.get(
+                                (server_address, response_seqno))
+                            if sender:
+                                sender.terminate = True
+                                # We deliberately don't join() the sender here
+                                # to ensure we don't delay receiving the next
+                                # response
+                            else:
+                                for broadcast, netaddr, netmask in broadcasts:
+                                    if packed & netmask == netaddr:
+                                        sender = self._senders.get(
+                                            (broadcast, response_seqno))
+                                        break
+                            if response_seqno == seqno:
+                                responses = result
+                                address = targets.get(packed)
+                                if address is None:
+                                    if space is None or packed not in space:
+                                        warnings.warn(CompoundPiUnknownAddress(
+                                            IPv4Address(host)))
+                                        continue
+                                    address = targets[packed] = IPv4Address(host)
+                            elif response_seqno in self._pending:
+                                # Store responses to other outstanding
+                                # transactions until they are collected
+                                responses = self._pending[response_seqno]
+                                try:
+                                    address = self._index[packed][0]
+                                except KeyError:
+                                    warnings.warn(CompoundPiUnknownAddress(
+                                        IPv4Address(host)))
+                                    continue
+                            elif response_seqno > self._seqno:
+                                warnings.warn(CompoundPiFutureResponse(
+                                    IPv4Address(host)))
+                                continue
+                            else:
+                                warnings.warn(CompoundPiStaleResponse(
+                                    IPv4Address(host)))
+                                continue
+                            if address in responses:
+                                warnings.warn(CompoundPiMultiResponse(address))
+                                continue
+                            if fragment is not None:
+                                # Store the fragment and continue receiving until
+                                # all fragments have arrived. Repeats of fragments
+                                # already received are simply overwritten
+                                fragments = self._partial.setdefault(
+                                    (response_seqno, address), {})
+                                fragments[fragment] = match.group('data') or ''
+                                if len(fragments) < int(match.group('fragments')):
+                                    continue
+                                del self._partial[(response_seqno, address)]
+                                data = ''.join(
+                                    fragments[i] for i in sorted(fragments))
+                            else:
+                                data = match.group('data')
+                            responses[address] = (match.group('result'), data)
+                            if sender:
+                                self._sample(sender, address)
+                            if responses is not result:
+                                continue
+                            last = time.time()
+                            max_rto = max(max_rto, self._rto(address))
+                            yield address, result[address]
+                            if sender and sender.address != server_address and (
+                                    len(result) < count):
+                                # Each broadcast repetition is answered by every
+                                # server, including those that have already
+                                # responded, so repeat less often as fewer are
+                                # outstanding
+                                sender.interval = (
+                                    max_rto * count / (count - len(result)))
+                now = time.time()
             self._progress.update(len(result))
-            return result
+            self._check_drops()
         finally:
-            while self._senders:
-                _, sender = self._senders.popitem()
+            # Only silence the senders of this transaction; those of other
+            # outstanding transactions continue until they are collected
+            for key in [key for key in self._senders if key[1] == seqno]:
+                sender = self._senders.pop(key)
                 sender.terminate = True
                 sender.join()
+            for key in [key for key in self._partial if key[0] == seqno]:
+                del self._partial[key]
             self._progress.finish()
 
-    def transact(self, data, addresses=None):
+    def transact(self, data, addresses=None, quorum=None, deadline=None):
+        """
+        Sends the command *data* to the servers at the specified *addresses*
+        (or all defined servers if *addresses* is omitted), and returns a
+        :class:`CompoundPiResponses` mapping of server address to response
+        data. If any server returns an error, or fails to respond within
+        :attr:`timeout` seconds, :exc:`~compoundpi.exc.CompoundPiTransactionFailed`
+        is raised.
+
+        If *quorum* (an integer) or *deadline* (a number of seconds) is
+        specified, the transaction is executed in quorum mode. In this mode
+        the method returns as soon as *quorum* servers have responded
+        successfully, or once *deadline* seconds have elapsed, whichever comes
+        first. Rather than raising an exception, servers that returned an
+        error are recorded in the :attr:`~CompoundPiResponses.failed`
+        attribute of the result, and servers that haven't responded are
+        recorded in its :attr:`~CompoundPiResponses.stragglers` attribute.
+        If fewer than *quorum* servers succeed,
+        :exc:`~compoundpi.exc.CompoundPiTransactionFailed` is still raised.
+        The defaults for *quorum* and *deadline* are taken from the
+        :attr:`quorum` and :attr:`deadline` attributes, which permits quorum
+        mode to be used with all methods of :class:`CompoundPiClient`.
+        """
+        if quorum is None:
+            quorum = self.quorum
+        if deadline is None:
+            deadline = self.deadline
+        if quorum is None and deadline is None:
+            return CompoundPiResponses(self.transact_iter(data, addresses))
+        return self._collect(
+            self._send_transaction(data, addresses), quorum, deadline)
+
+    def transact_many(self, commands, quorum=None, deadline=None):
+        """
+        Sends a different command to each server. The *commands* parameter is
+        a mapping of server address to the command data to send to that
+        server. All commands are sent by unicast under a single sequence
+        number, and the responses are collected together, so the transaction
+        takes a single round trip regardless of the number of servers
+        addressed. The result (and any errors raised) are as for
+        :meth:`transact`, including the handling of *quorum* and *deadline*.
+
+        This is typically used to push individual settings (e.g. white
+        balance gains from a calibration step) to each camera; see
+        :meth:`CompoundPiClient.awb_many` and
+        :meth:`CompoundPiClient.exposure_many`.
+        """
+        if quorum is None:
+            quorum = self.quorum
+        if deadline is None:
+            deadline = self.deadline
+        addresses = self._send_many(commands)
+        if quorum is None and deadline is None:
+            return CompoundPiResponses(self._collect_iter(addresses))
+        return self._collect(addresses, quorum, deadline)
+
+    def _collect(self, addresses, quorum, deadline, seqno=None):
+        result = CompoundPiResponses()
+        responses = self._iter_responses(
+            addresses, timeout=deadline, seqno=seqno)
+        try:
+            for address, (status, response) in responses:
+                if status == 'OK':
+                    result[address] = response
+                elif status == 'ERROR':
+                    result.failed[address] = CompoundPiServerError(address, response)
+                else:
+                    result.failed[address] = CompoundPiInvalidResponse(address)
+                if quorum is not None and (
+                        len(result) >= quorum or
+                        len(addresses) - len(result.failed) < quorum):
+                    break
+            else:
+                for address in addresses - set(result) - set(result.failed):
+                    self.rtt.setdefault(address, CompoundPiRTTEstimate()).backoff()
+        finally:
+            responses.close()
+        result.stragglers = addresses - set(result) - set(result.failed)
+        if quorum is not None and len(result) < quorum:
+            raise CompoundPiTransactionFailed(
+                list(result.failed.values()) + [
+                    CompoundPiMissingResponse(address)
+                    for address in result.stragglers],
+                'quorum of %d servers not reached' % quorum)
+        return result
+
+    def transact_iter(self, data, addresses=None):
+        """
+        Sends the command *data* to the servers at the specified *addresses*
+        (or all defined servers if *addresses* is omitted), yielding
+        ``(address, response)`` tuples as each successful response arrives.
+        The command is sent when iteration begins. Once all servers have
+        responded (or the timeout has elapsed), any errors are raised together
+        in a :exc:`~compoundpi.exc.CompoundPiTransactionFailed` exception.
+
+        This permits callers to start processing the responses of the fastest
+        servers while waiting for the rest; :meth:`transact` is equivalent to
+        collecting the output of this method in a :class:`dict`. No other
+        transaction may be started until iteration is complete (or the
+        iterator is closed) as responses are only received while iterating.
+        """
+        addresses = self._send_transaction(data, addresses)
+        for address, response in self._collect_iter(addresses):
+            yield address, response
+
+    def transact_async(self, data, addresses=None):
+        """
+        Sends the command *data* to the servers at the specified *addresses*
+        (or all defined servers if *addresses* is omitted) and returns a
+        :class:`CompoundPiPendingTransaction` immediately, without waiting
+        for any responses. Call its
+        :meth:`~CompoundPiPendingTransaction.result` method to collect the
+        responses; this returns (or raises) exactly as :meth:`transact` would.
+
+        Up to :attr:`window` transactions (including any started by other
+        methods) may be outstanding at once;
+        :exc:`~compoundpi.exc.CompoundPiWindowFull` is raised if another is
+        attempted. Responses to outstanding transactions which arrive while
+        another transaction is collecting its responses are kept until they
+        are collected. Hence, independent commands can overlap rather than
+        each waiting for a round trip in turn. Note that the :attr:`timeout`
+        of each transaction starts when its result is requested.
+        """
+        addresses = self._send_transaction(data, addresses)
+        self._pending[self._seqno] = {}
+        return CompoundPiPendingTransaction(self, self._seqno, addresses)
+
+    def _collect_iter(self, addresses, seqno=None):
+        errors = []
+        received = set()
+        for address, (result, response) in self._iter_responses(
+                addresses, seqno=seqno):
+            received.add(address)
+            if result == 'ERROR':
+                errors.append(CompoundPiServerError(address, response))
+            elif result != 'OK':
+                errors.append(CompoundPiInvalidResponse(address))
+            else:
+                yield address, response
+        for address in addresses - received:
+            self.rtt.setdefault(address, CompoundPiRTTEstimate()).backoff()
+            errors.append(CompoundPiMissingResponse(address))
+        if errors:
+            raise CompoundPiTransactionFailed(errors)
+
+    def _check_addresses(self, addresses):
         if addresses is None:
             if not self._items:
                 raise CompoundPiNoServers()
-            addresses = set(self._items)
-        else:
-            addresses = set(
-                addr if isinstance(addr, IPv4Address) else IPv4Address(addr)
-                for addr in addresses
-                )
-            if addresses - set(self._items):
-                raise CompoundPiUndefinedServers(addresses - set(self._items))
-        errors = []
+            return set(self._items)
+        result = set()
+        undefined = set()
+        for addr in addresses:
+            try:
+                result.add(self._index[_packed_address(addr)][0])
+            except KeyError:
+                undefined.add(
+                    addr if isinstance(addr, IPv4Address) else IPv4Address(addr))
+        if undefined:
+            raise CompoundPiUndefinedServers(undefined)
+        return result
+
+    def _next_seqno(self):
+        if len(self._pending) >= self.window:
+            raise CompoundPiWindowFull(self.window)
         self._seqno += 1
-        data = '%d %s' % (self._seqno, data)
-        if addresses == set(self._items):
+
+    def _send_many(self, commands):
+        commands = {
+            addr if isinstance(addr, IPv4Address) else IPv4Address(addr): data
+            for addr, data in commands.items()
+            }
+        addresses = self._check_addresses(commands)
+        if not addresses:
+            raise CompoundPiNoServers()
+        self._next_seqno()
+        for address in addresses:
             self._send_command(
-                (str(self.network.broadcast_address), self.port), self._seqno, data)
+                (self._index[int(address)][1], self.port), self._seqno,
+                '%d %s' % (self._seqno, commands[address]))
+        return addresses
+
+    def _send_transaction(self, data, addresses):
+        addresses = self._check_addresses(addresses)
+        self._next_seqno()
+        broadcast = (self._broadcast, self.port)
+        # Servers found on other networks (see find) can only be reached by
+        # unicast
+        local = set(
+            address for address in addresses
+            if int(address) & self._netmask == self._netaddr)
+        remote = addresses - local
+        if local and len(local) == sum(
+                1 for packed in self._index
+                if packed & self._netmask == self._netaddr):
+            self._send_command(
+                broadcast, self._seqno, '%d %s' % (self._seqno, data))
+        elif len(local) > 1:
+            # Where several servers are addressed, broadcast the command with
+            # a target selector (provided it fits in a datagram) so that all
+            # receive it simultaneously
+            message = '%d@%s %s' % (
+                self._seqno, target_selector(local), data)
+            if len(message.encode('utf-8')) <= self._protocol.max_datagram:
+                self._send_command(broadcast, self._seqno, message)
+            else:
+                remote = addresses
         else:
-            for address in addresses:
-                self._send_command(
-                    (str(address), self.port), self._seqno, data)
-        responses = self._responses(addresses)
-        for address in addresses:
+            remote = addresses
+        for address in remote:
+            self._send_command(
+                (self._index[int(address)][1], self.port), self._seqno,
+                '%d %s' % (self._seqno, data))
+        return addresses
+
+
+class CompoundPiAddressSpace(list):
+    """
+    A list of :class:`~ipaddress.IPv4Network` instances which tests whether
+    an address (which may also be given in packed, integer form) belongs to
+    any of them.
+    """
+
+    def __init__(self, networks=()):
+        super(CompoundPiAddressSpace, self).__init__(networks)
+        self._masks = [
+            (int(network.broadcast_address) & int(network.netmask),
+                int(network.netmask))
+            for network in self
+            ]
+
+    def __contains__(self, address):
+        if not isinstance(address, numbers.Integral):
             try:
-                result, response = responses[address]
-            except KeyError:
-                errors.append(CompoundPiMissingResponse(address))
-            else:
-                responses[address] = response
-                if result == 'ERROR':
-                    errors.append(CompoundPiServerError(address, response))
-                elif result != 'OK':
-                    errors.append(CompoundPiInvalidResponse(address))
-        if errors:
-            raise CompoundPiTransactionFailed(errors)
-        return responses
+                address = _packed_address(address)
+            except ValueError:
+                return False
+        return any(
+            address & netmask == netaddr
+            for netaddr, netmask in self._masks)
+
+
+class CompoundPiPendingTransaction(object):
+    """
+    Represents a transaction started by
+    :meth:`CompoundPiServerList.transact_async` whose responses have not yet
+    been collected. The :attr:`seqno` attribute gives the sequence number of
+    the transaction's command and :attr:`addresses` the set of servers it was
+    sent to.
+    """
+
+    def __init__(self, servers, seqno, addresses):
+        self._servers = servers
+        self.seqno = seqno
+        self.addresses = addresses
+
+    def __repr__(self):
+        return '<CompoundPiPendingTransaction seqno=%d>' % self.seqno
+
+    @property
+    def done(self):
+        """
+        Returns ``True`` if all servers have responded to the transaction
+        (as far as the client has received so far). This does not receive any
+        responses itself.
+        """
+        responses = self._servers._pending.get(self.seqno)
+        return responses is not None and len(responses) == len(self.addresses)
+
+    def result(self, quorum=None, deadline=None):
+        """
+        Waits for the responses of the transaction, returning a
+        :class:`CompoundPiResponses` mapping of server address to response
+        data. The *quorum* and *deadline* parameters, the result, and the
+        errors raised are as for :meth:`CompoundPiServerList.transact`.
+        """
+        servers = self._servers
+        if self.seqno not in servers._pending:
+            raise CompoundPiClientError(
+                'responses of transaction %d already collected' % self.seqno)
+        if quorum is None:
+            quorum = servers.quorum
+        if deadline is None:
+            deadline = servers.deadline
+        try:
+            if quorum is None and deadline is None:
+                return CompoundPiResponses(
+                    servers._collect_iter(self.addresses, self.seqno))
+            return servers._collect(
+                self.addresses, quorum, deadline, self.seqno)
+        finally:
+            servers._pending.pop(self.seqno, None)
 
 
 class CompoundPiProgressHandler(object):
@@ -831,6 +1816,12 @@ class CompoundPiClient(object):
     defined manually, or discovered by broadcast. See the
     :class:`CompoundPiServerList` documentation for further information.
 
+    The :attr:`clocks` attribute is a mapping of server address to
+    :class:`CompoundPiClock` estimates of the offset of each server's clock,
+    as measured by :meth:`time_sync`. Where known, these offsets are applied
+    to the timestamps used to synchronize captures and recordings (see the
+    *delay* parameter of :meth:`capture` and :meth:`record`).
+
     Various methods are provided for configuring and controlling the cameras on
     the Compound Pi servers (:meth:`resolution`, :meth:`framerate`,
     :meth:`exposure`, :meth:`capture`, etc). Each method optionally accepts a
@@ -874,6 +1865,8 @@ class CompoundPiClient(object):
         self._server = None
         self._server_thread = None
         self._servers = CompoundPiServerList(CompoundPiProgressHandler(progress))
+        self._journal = {}
+        self.clocks = {}
         self.bind = ('0.0.0.0', 5647)
 
     def close(self):
@@ -953,7 +1946,12 @@ class CompoundPiClient(object):
             self._server.event = threading.Event()
             self._server.source = None
             self._server.output = None
+            self._server.factory = None
+            self._server.received = []
+            self._server.partial = None
             self._server.exception = None
+            self._server.activity = 0
+            self._server.active = None
             self._server.progress = self._servers._progress
             self._server_thread = threading.Thread(target=self._server.serve_forever)
             self._server_thread.start()
@@ -1020,45 +2018,161 @@ class CompoundPiClient(object):
                         status.resolution.height,
                         ))
         """
-        responses = [
-            (address, self.status_re.match(data))
-            for (address, data) in self.servers.transact(
-                self._protocol.do_status(), addresses).items()
-            ]
+        responses = self.servers.transact(self._protocol.do_status(), addresses)
         errors = []
         result = {}
-        for address, match in responses:
-            if match is None:
-                errors.append(CompoundPiInvalidResponse(address))
-            else:
-                result[address] = CompoundPiStatus(
-                    resolution=Resolution(int(match.group('width')), int(match.group('height'))),
-                    framerate=Fraction(match.group('rate')),
-                    awb_mode=match.group('awb_mode'),
-                    awb_red=Fraction(match.group('awb_red')),
-                    awb_blue=Fraction(match.group('awb_blue')),
-                    agc_mode=match.group('agc_mode'),
-                    agc_analog=Fraction(match.group('agc_analog')),
-                    agc_digital=Fraction(match.group('agc_digital')),
-                    exposure_mode=match.group('exp_mode'),
-                    exposure_speed=float(match.group('exp_speed')),
-                    ev=int(match.group('ev')),
-                    iso=int(match.group('iso')),
-                    metering_mode=match.group('metering_mode'),
-                    brightness=int(match.group('brightness')),
-                    contrast=int(match.group('contrast')),
-                    saturation=int(match.group('saturation')),
-                    hflip=bool(int(match.group('hflip'))),
-                    vflip=bool(int(match.group('vflip'))),
-                    denoise=bool(int(match.group('denoise'))),
-                    timestamp=datetime.datetime.fromtimestamp(float(match.group('time'))),
-                    files=int(match.group('files')),
-                    )
+        for address, data in responses.items():
+            status = self._parse_status(address, data, errors)
+            if status is not None:
+                result[address] = status
         if errors:
             raise CompoundPiTransactionFailed(
                 errors, '%d invalid status responses' % len(errors))
+        return self._result(responses, result)
+
+    time_re = re.compile(
+        r'(?P<received>\d+(\.\d+)?),(?P<sent>\d+(\.\d+)?)')
+    def time_sync(self, rounds=5, addresses=None):
+        """
+        Called to measure the offset of the clocks of the servers at the
+        specified *addresses* (or all defined servers if *addresses* is
+        omitted) from the client's clock. Each of the *rounds* (default 5)
+        exchanges of the :ref:`protocol_time` message provides four
+        timestamps: when the client sent the message, when the server received
+        it, when the server responded, and when the client received the
+        response. From these the offset and round-trip time are calculated as
+        in NTP; the sample with the smallest round-trip time is kept for each
+        server as it is the least affected by network queuing.
+
+        The estimates are stored in :attr:`clocks` (replacing any prior
+        estimates for the servers measured) and are applied to the sync
+        timestamps subsequently sent by :meth:`capture` and :meth:`record`.
+        The method returns a mapping of address to :class:`CompoundPiClock`
+        for the servers measured. For example::
+
+            from compoundpi.client import CompoundPiClient
+
+            with CompoundPiClient() as client:
+                client.servers.network = '192.168.0.0/24'
+                client.servers.find(10)
+                for address, clock in client.time_sync().items():
+                    print('%s: %+.2fms (rtt %.2fms)' % (
+                        address, clock.offset * 1000, clock.delay * 1000))
+                client.capture(delay=0.25)
+        """
+        if rounds < 1:
+            raise ValueError('rounds must be at least 1')
+        result = {}
+        errors = []
+        for i in range(rounds):
+            sent = time.time()
+            for address, data in self.servers.transact_iter(
+                    self._protocol.do_time(), addresses):
+                received = time.time()
+                match = self.time_re.match(data or '')
+                if not match:
+                    errors.append(CompoundPiInvalidResponse(address))
+                    continue
+                server_received = float(match.group('received'))
+                server_sent = float(match.group('sent'))
+                clock = CompoundPiClock(
+                    ((server_received - sent) + (server_sent - received)) / 2,
+                    (received - sent) - (server_sent - server_received))
+                if address not in result or clock.delay < result[address].delay:
+                    result[address] = clock
+            if errors:
+                raise CompoundPiTransactionFailed(
+                    errors, '%d invalid responses' % len(errors))
+        self.clocks.update(result)
         return result
 
+    def _transact_sync(self, command, sync, addresses):
+        # Adjusting the sync timestamp for each server's clock offset requires
+        # a separate command per server; these are all sent in one round trip
+        if sync is None or not self.clocks:
+            return self.servers.transact(command(sync), addresses)
+        if addresses is None:
+            addresses = self.servers
+        commands = {}
+        for address in addresses:
+            if not isinstance(address, IPv4Address):
+                address = IPv4Address(address)
+            clock = self.clocks.get(address)
+            commands[address] = command(
+                sync if clock is None else sync + clock.offset)
+        return self.servers.transact_many(commands)
+
+    def _result(self, responses, result):
+        # Preserve the failed and straggling servers of transactions executed
+        # in quorum mode
+        if isinstance(responses, CompoundPiResponses):
+            return CompoundPiResponses(
+                result, responses.failed, responses.stragglers)
+        return result
+
+    def status_iter(self, addresses=None):
+        """
+        Called to determine the status of servers. This is a variant of
+        :meth:`status` which yields ``(address, status)`` tuples as each
+        server responds, instead of waiting for all servers to respond. Any
+        errors (including servers that failed to respond) are raised together
+        in a :exc:`~compoundpi.exc.CompoundPiTransactionFailed` exception once
+        all other responses have been yielded. For example::
+
+            from compoundpi.client import CompoundPiClient
+
+            with CompoundPiClient() as client:
+                client.servers.network = '192.168.0.0/24'
+                client.servers.find(10)
+                for address, status in client.status_iter():
+                    print('%s: %d files' % (address, status.files))
+
+        .. note::
+
+            No other commands may be issued to the servers until iteration
+            is complete (or the iterator is closed).
+        """
+        errors = []
+        try:
+            for address, data in self.servers.transact_iter(
+                    self._protocol.do_status(), addresses):
+                status = self._parse_status(address, data, errors)
+                if status is not None:
+                    yield address, status
+        except CompoundPiTransactionFailed as e:
+            errors = e.errors + errors
+        if errors:
+            raise CompoundPiTransactionFailed(errors)
+
+    def _parse_status(self, address, data, errors):
+        match = self.status_re.match(data)
+        if match is None:
+            errors.append(CompoundPiInvalidResponse(address))
+        else:
+            return CompoundPiStatus(
+                resolution=Resolution(int(match.group('width')), int(match.group('height'))),
+                framerate=Fraction(match.group('rate')),
+                awb_mode=match.group('awb_mode'),
+                awb_red=Fraction(match.group('awb_red')),
+                awb_blue=Fraction(match.group('awb_blue')),
+                agc_mode=match.group('agc_mode'),
+                agc_analog=Fraction(match.group('agc_analog')),
+                agc_digital=Fraction(match.group('agc_digital')),
+                exposure_mode=match.group('exp_mode'),
+                exposure_speed=float(match.group('exp_speed')),
+                ev=int(match.group('ev')),
+                iso=int(match.group('iso')),
+                metering_mode=match.group('metering_mode'),
+                brightness=int(match.group('brightness')),
+                contrast=int(match.group('contrast')),
+                saturation=int(match.group('saturation')),
+                hflip=bool(int(match.group('hflip'))),
+                vflip=bool(int(match.group('vflip'))),
+                denoise=bool(int(match.group('denoise'))),
+                timestamp=datetime.datetime.fromtimestamp(float(match.group('time'))),
+                files=int(match.group('files')),
+                )
+
     def resolution(self, width, height, addresses=None):
         """
         Called to change the camera resolution on the servers at the specified
@@ -1137,6 +2251,34 @@ class CompoundPiClient(object):
         self.servers.transact(
             self._protocol.do_awb(mode, red, blue), addresses)
 
+    def awb_many(self, gains):
+        """
+        Called to fix the white balance of each server individually. The
+        *gains* parameter is a mapping of server address to a ``(red, blue)``
+        tuple of gains. White balance is set to ``'off'`` on each server with
+        its corresponding gains, in a single transaction. This is useful for
+        applying the results of a calibration step, or for freezing the gains
+        that each camera has measured for itself. For example::
+
+            from time import sleep
+            from compoundpi.client import CompoundPiClient
+
+            with CompoundPiClient() as client:
+                client.servers.network = '192.168.0.0/24'
+                client.servers.find(10)
+                client.awb('auto')
+                sleep(2)
+                # Fix each camera's gains at the values it has settled on
+                client.awb_many({
+                    address: (status.awb_red, status.awb_blue)
+                    for address, status in client.status().items()
+                    })
+        """
+        self.servers.transact_many({
+            address: self._protocol.do_awb('off', red, blue)
+            for address, (red, blue) in gains.items()
+            })
+
     def agc(self, mode, addresses=None):
         """
         Called to change the automatic gain control on the servers at the
@@ -1204,6 +2346,19 @@ class CompoundPiClient(object):
         self.servers.transact(
             self._protocol.do_exposure(mode, speed), addresses)
 
+    def exposure_many(self, speeds):
+        """
+        Called to fix the exposure speed of each server individually. The
+        *speeds* parameter is a mapping of server address to an exposure speed
+        measured in milliseconds. Exposure is set to ``'off'`` on each server
+        with its corresponding speed, in a single transaction (see
+        :meth:`awb_many` for an example of a similar method).
+        """
+        self.servers.transact_many({
+            address: self._protocol.do_exposure('off', speed)
+            for address, speed in speeds.items()
+            })
+
     def metering(self, mode, addresses=None):
         """
         Called to change the metering algorithm on the servers at the specified
@@ -1280,6 +2435,80 @@ class CompoundPiClient(object):
         """
         self.servers.transact(self._protocol.do_denoise(value), addresses)
 
+    def configure(self, addresses=None, **settings):
+        """
+        Called to change several settings at once on the servers at the
+        specified *addresses* (or all defined servers if *addresses* is
+        omitted). The settings are given as keyword arguments named after the
+        attributes of :class:`CompoundPiStatus`:
+
+        * *resolution* - a ``(width, height)`` tuple
+        * *framerate*
+        * *awb_mode*, *awb_red*, and *awb_blue*
+        * *agc_mode*
+        * *exposure_mode* and *exposure_speed*
+        * *iso*
+        * *metering_mode*
+        * *brightness*, *contrast*, and *saturation*
+        * *ev*
+        * *hflip* and *vflip*
+        * *denoise*
+
+        The values are as described for the individual methods (:meth:`awb`,
+        :meth:`exposure`, etc). Settings that are omitted (or ``None``) are
+        left unchanged. All settings are applied with a single command, and
+        the servers avoid resetting the camera unless the resolution or
+        framerate actually change. For example, to copy the configuration of
+        one server to all others::
+
+            from compoundpi.client import CompoundPiClient
+
+            with CompoundPiClient() as client:
+                client.servers.network = '192.168.0.0/24'
+                client.servers.find(10)
+                addr = client.servers[0]
+                status = client.status(addresses=[addr])[addr]
+                client.configure(
+                    resolution=status.resolution,
+                    framerate=status.framerate,
+                    awb_mode=status.awb_mode,
+                    awb_red=status.awb_red,
+                    awb_blue=status.awb_blue,
+                    )
+
+        .. note::
+
+            If *agc_mode* is ``'off'`` the gains are fixed at their current
+            values. When the resolution or framerate change (resetting the
+            camera) it is better to configure ``'auto'``, wait for the gains
+            to settle, and then set *agc_mode* to ``'off'`` separately.
+        """
+        self.servers.transact(self._configure(**settings), addresses)
+
+    def configure_many(self, settings):
+        """
+        Called to change several settings at once on each server
+        individually. The *settings* parameter is a mapping of server address
+        to a :class:`dict` of keyword arguments as accepted by
+        :meth:`configure`. All servers are configured in a single transaction.
+        """
+        self.servers.transact_many({
+            address: self._configure(**server_settings)
+            for address, server_settings in settings.items()
+            })
+
+    def _configure(
+            self, resolution=None, framerate=None, awb_mode=None,
+            awb_red=None, awb_blue=None, agc_mode=None, exposure_mode=None,
+            exposure_speed=None, iso=None, metering_mode=None,
+            brightness=None, contrast=None, saturation=None, ev=None,
+            hflip=None, vflip=None, denoise=None):
+        width, height = resolution if resolution is not None else (None, None)
+        return self._protocol.do_configure(
+            width, height, framerate, awb_mode, awb_red, awb_blue, agc_mode,
+            exposure_mode, exposure_speed, iso, metering_mode, brightness,
+            contrast, saturation, ev, hflip, vflip, denoise)
+
     def capture(self, count=1, video_port=False, quality=None, delay=None,
             addresses=None):
         """
@@ -1305,25 +2534,131 @@ class CompoundPiClient(object):
         seconds). This functionality assumes that the servers all have accurate
         clocks which are reasonably in sync with the client's clock; a typical
         configuration is to run an NTP server on the client machine, and an NTP
-        client on each of the Compound Pi servers.
+        client on each of the Compound Pi servers. Alternatively, call
+        :meth:`time_sync` first; the timestamp is then adjusted by each
+        server's measured clock offset (which requires the command to be sent
+        to each server individually, though in a single round trip).
 
         .. note::
 
             Note that this method merely causes the servers to capture images.
             The captured images are stored in RAM on the servers for later
             retrieval with the :meth:`download` method.
+
+        This method blocks until all servers have finished capturing. See
+        :meth:`capture_async` for a variant which returns immediately.
+        """
+        self.capture_async(count, video_port, quality, delay, addresses).wait()
+
+    def capture_async(self, count=1, video_port=False, quality=None,
+            delay=None, addresses=None):
+        """
+        Called to start capturing images on the servers at the specified
+        *addresses* (or all defined servers if *addresses* is omitted). The
+        parameters are the same as for :meth:`capture`, but this method
+        returns a :class:`CompoundPiJob` as soon as the servers have accepted
+        the command, without waiting for the captures to complete. For
+        example::
+
+            from compoundpi.client import CompoundPiClient
+
+            with CompoundPiClient() as client:
+                client.servers.network = '192.168.0.0/24'
+                client.servers.find(10)
+                job = client.capture_async(count=100, video_port=True)
+                while not job.wait(timeout=1):
+                    print('%.1f%% complete' % (100 * min(
+                        status.progress for status in job.status.values())))
         """
         if delay:
             delay = time.time() + delay
         else:
             delay = None
-        self.servers.transact(
-            self._protocol.do_capture(count, video_port, quality, delay),
-            addresses)
+        return self._job(self._transact_sync(
+            lambda sync: self._protocol.do_capture(
+                count, video_port, quality, sync),
+            delay, addresses))
+
+    def arm(self, count=1, video_port=False, quality=None, addresses=None):
+        """
+        Called to prepare a capture on the servers at the specified
+        *addresses* (or all defined servers if *addresses* is omitted) which
+        will be taken when :meth:`fire` is called. The *count*, *video_port*,
+        and *quality* parameters are the same as for :meth:`capture`.
+
+        The servers configure the camera and encoder, and fix the exposure and
+        white balance gains, in advance so that the capture can be taken with
+        minimal (and consistent) delay when fired. Using the video port is
+        recommended for the lowest delay. The method returns a
+        :class:`CompoundPiJob` for the armed captures which completes once
+        they have been fired (or disarmed with :meth:`disarm`)::
+
+            import time
+            from compoundpi.client import CompoundPiClient
+
+            with CompoundPiClient() as client:
+                client.servers.network = '192.168.0.0/24'
+                client.servers.find(10)
+                job = client.arm(video_port=True)
+                # Wait for the servers to prepare
+                time.sleep(1)
+                for address, delay in client.fire().items():
+                    print('%s: captured %.1fms after fire' % (
+                        address, delay * 1000))
+                job.wait()
+        """
+        return self._job(self.servers.transact(
+            self._protocol.do_arm(count, video_port, quality), addresses))
+
+    def disarm(self, addresses=None):
+        """
+        Called to cancel the captures prepared by :meth:`arm` on the servers
+        at the specified *addresses* (or all defined servers if *addresses* is
+        omitted) without taking them.
+        """
+        self.servers.transact(self._protocol.do_arm(0), addresses)
+
+    delay_re = re.compile(r'DELAY (?P<delay>\d+(\.\d+)?)')
+    def fire(self, addresses=None):
+        """
+        Called to take the captures prepared by :meth:`arm` on the servers at
+        the specified *addresses* (or all defined servers if *addresses* is
+        omitted). For the smallest spread between servers, omit *addresses*
+        so that a single broadcast message is sent.
+
+        The servers respond immediately with the job of the armed capture;
+        the method then waits for the jobs to finish and returns a mapping of
+        address to the delay (in seconds) measured by each server between
+        receiving the :ref:`protocol_fire` message and starting to capture its
+        first image. Servers whose captures have not finished preparing
+        respond with an error.
+        """
+        responses = self.servers.transact(self._protocol.do_fire(), addresses)
+        job = self._job(responses)
+        errors = [
+            CompoundPiInvalidResponse(address)
+            for address in responses
+            if address not in job.jobs
+            ]
+        if errors:
+            raise CompoundPiTransactionFailed(
+                errors, '%d invalid responses' % len(errors))
+        job.wait()
+        result = {}
+        for address, status in job.status.items():
+            match = self.delay_re.match(status.message)
+            if match:
+                result[address] = float(match.group('delay'))
+            else:
+                errors.append(CompoundPiInvalidResponse(address))
+        if errors:
+            raise CompoundPiTransactionFailed(
+                errors, '%d invalid responses' % len(errors))
+        return self._result(responses, result)
 
     def record(self, length, format='h264', quality=None, bitrate=None,
             intra_period=None, motion_output=False, delay=None,
-            addresses=None):
+            addresses=None, segment=None):
         """
         Called to record video on the servers at the specified *addresses* (or
         all defined servers if *addresses* is omitted). The *length* parameter
@@ -1350,33 +2685,154 @@ class CompoundPiClient(object):
         data as well as video data. This will be stored in a separate file on
         the Compound Pi server.
 
+        The optional *segment* parameter is only valid with the ``h264``
+        format. If specified, each server splits the recording (at keyframes)
+        into consecutive files approximately *segment* seconds long. Completed
+        segments appear in :meth:`list` while the recording continues, so they
+        can be downloaded and cleared (see the *count* parameter of
+        :meth:`clear`) during lengthy recordings started with
+        :meth:`record_async`, bounding the memory used on the servers.
+
         The optional *delay* parameter defaults to ``None`` which indicates
         that all servers should record video immediately upon receipt of the
         :ref:`protocol_capture` message. When using broadcast messages (when
         *addresses* is omitted) this typically results in near simultaneous
         recording, especially with fast, low latency networks like ethernet.
+        If set to a small floating point value measured in seconds, the servers
+        synchronize the start of their recordings to a timestamp as described
+        for :meth:`capture` (including the adjustment for clock offsets
+        measured by :meth:`time_sync`).
 
         .. note::
 
             Note that this method merely causes the servers to record video.
             The captured video is stored in RAM on the servers for later
             retrieval with the :meth:`download` method.
+
+        This method blocks until all servers have finished recording. See
+        :meth:`record_async` for a variant which returns immediately.
+        """
+        self.record_async(
+            length, format, quality, bitrate, intra_period, motion_output,
+            delay, addresses, segment).wait()
+
+    def record_async(self, length, format='h264', quality=None, bitrate=None,
+            intra_period=None, motion_output=False, delay=None,
+            addresses=None, segment=None):
+        """
+        Called to start recording video on the servers at the specified
+        *addresses* (or all defined servers if *addresses* is omitted). The
+        parameters are the same as for :meth:`record`, but this method returns
+        a :class:`CompoundPiJob` as soon as the servers have accepted the
+        command, without waiting for the recordings to complete. This permits
+        the servers to be queried (with :meth:`status` or :meth:`list`, for
+        example) during lengthy recordings.
         """
         if delay:
             delay = time.time() + delay
         else:
             delay = None
-        self.servers.transact(
-            self._protocol.do_record(
+        return self._job(self._transact_sync(
+            lambda sync: self._protocol.do_record(
                 length, format, quality, bitrate, intra_period,
-                motion_output, delay),
+                motion_output, sync, segment),
+            delay, addresses))
+
+    def buffer(self, length, quality=None, bitrate=None, intra_period=None,
+            addresses=None):
+        """
+        Called to start continuous recording of ``h264`` video into a circular
+        buffer on the servers at the specified *addresses* (or all defined
+        servers if *addresses* is omitted). The *length* parameter specifies
+        the number of seconds of video that each server should retain; older
+        video is discarded as new video is recorded. If *length* is 0,
+        buffering is stopped and the buffers discarded.
+
+        The optional *quality*, *bitrate*, and *intra_period* parameters are
+        the same as for :meth:`record`. Note that the memory occupied by the
+        buffer on each server is proportional to *bitrate* and *length*.
+
+        Buffering continues in the background (alongside any other captures or
+        recordings) until stopped. Use :meth:`trigger` to save the content of
+        the buffers as files.
+        """
+        self.servers.transact(
+            self._protocol.do_buffer(length, quality, bitrate, intra_period),
             addresses)
 
+    def trigger(self, length=None, addresses=None):
+        """
+        Called to save the video buffered (by :meth:`buffer`) on the servers
+        at the specified *addresses* (or all defined servers if *addresses* is
+        omitted). If specified, *length* limits the saved video to the last
+        *length* seconds of each buffer; by default the whole buffer is saved.
+
+        This is intended to be called just after an event of interest has
+        occurred; the video saved includes the period leading up to the event.
+        Each server stores the video as a new file which can be retrieved with
+        :meth:`download` in the usual manner. The servers save the video in the
+        background, so the file may take a moment to appear in :meth:`list`.
+        Buffering continues afterward so this method can be called for
+        subsequent events.
+        """
+        self.servers.transact(self._protocol.do_trigger(length), addresses)
+
+    job_re = re.compile(r'JOB (?P<id>\d+)')
+    def _job(self, responses):
+        jobs = {}
+        for address, data in responses.items():
+            match = self.job_re.match(data or '')
+            if match:
+                jobs[address] = int(match.group('id'))
+        return CompoundPiJob(self, jobs)
+
+    job_line_re = re.compile(
+            r'(?P<id>\d+),'
+            r'(?P<state>QUEUED|RUNNING|DONE|FAILED),'
+            r'(?P<progress>\d+(\.\d+)?),'
+            r'(?P<message>.*)')
+    def jobs(self, addresses=None, job_id=None):
+        """
+        Called to query the state of recent capture and recording jobs on the
+        servers at the specified *addresses* (or all defined servers if
+        *addresses* is omitted). The method returns a mapping of address to
+        sequences of :class:`CompoundPiJobStatus` instances. If *job_id* is
+        specified, only the state of that job is returned.
+        """
+        transaction = self.servers.transact(
+            self._protocol.do_jobs(job_id), addresses)
+        responses = {
+            address: [
+                self.job_line_re.match(line)
+                for line in (data or '').splitlines()
+                ]
+            for (address, data) in transaction.items()
+            }
+        errors = []
+        result = {}
+        for address, matches in responses.items():
+            result[address] = []
+            for match in matches:
+                if match is None:
+                    errors.append(CompoundPiInvalidResponse(address))
+                else:
+                    result[address].append(CompoundPiJobStatus(
+                        int(match.group('id')),
+                        match.group('state'),
+                        float(match.group('progress')),
+                        match.group('message'),
+                        ))
+        if errors:
+            raise CompoundPiTransactionFailed(
+                errors, '%d invalid lines in responses' % len(errors))
+        return self._result(transaction, result)
+
     list_line_re = re.compile(
             r'(?P<filetype>IMAGE|VIDEO|MOTION),'
             r'(?P<index>\d+),'
             r'(?P<time>\d+(\.\d+)?),'
-            r'(?P<size>\d+)')
+            r'(?P<size>\d+)'
+            r'(,(?P<requested>\d+(\.\d+)?))?')
     def list(self, addresses=None):
         """
         Called to list files available for download from the servers at the
@@ -1399,13 +2855,94 @@ class CompoundPiClient(object):
                     )
                 print('%d bytes available for download' % size)
         """
+        responses = self.servers.transact(self._protocol.do_list(), addresses)
+        errors = []
+        result = {
+            address: self._parse_list(address, data, errors)
+            for (address, data) in responses.items()
+            }
+        if errors:
+            raise CompoundPiTransactionFailed(
+                errors, '%d invalid lines in responses' % len(errors))
+        return self._result(responses, result)
+
+    def list_iter(self, addresses=None):
+        """
+        Called to list files available for download from the servers. This is
+        a variant of :meth:`list` which yields ``(address, files)`` tuples as
+        each server responds, instead of waiting for all servers to respond.
+        Any errors (including servers that failed to respond) are raised
+        together in a :exc:`~compoundpi.exc.CompoundPiTransactionFailed`
+        exception once all other responses have been yielded. For example::
+
+            from compoundpi.client import CompoundPiClient
+
+            with CompoundPiClient() as client:
+                client.servers.network = '192.168.0.0/24'
+                client.servers.find(10)
+                client.capture()
+                for address, files in client.list_iter():
+                    print('%s: %d bytes' % (address, sum(f.size for f in files)))
+
+        .. note::
+
+            No other commands may be issued to the servers until iteration
+            is complete (or the iterator is closed).
+        """
+        errors = []
+        try:
+            for address, data in self.servers.transact_iter(
+                    self._protocol.do_list(), addresses):
+                yield address, self._parse_list(address, data, errors)
+        except CompoundPiTransactionFailed as e:
+            errors = e.errors + errors
+        if errors:
+            raise CompoundPiTransactionFailed(errors)
+
+    def _parse_list(self, address, data, errors):
+        result = []
+        for line in (data or '').splitlines():
+            match = self.list_line_re.match(line)
+            if match is None:
+                errors.append(CompoundPiInvalidResponse(address))
+            else:
+                result.append(CompoundPiFile(
+                    match.group('filetype'),
+                    int(match.group('index')),
+                    datetime.datetime.fromtimestamp(float(match.group('time'))),
+                    int(match.group('size')),
+                    datetime.datetime.fromtimestamp(
+                        float(match.group('requested')))
+                    if match.group('requested') else None,
+                    ))
+        return result
+
+    transfer_line_re = re.compile(
+            r'(?P<id>\d+),'
+            r'(?P<state>QUEUED|SENDING|DONE|FAILED),'
+            r'(?P<message>.*)')
+    def transfers(self, addresses=None, transfer_id=None):
+        """
+        Called to query the state of recent file transfers on the servers at
+        the specified *addresses* (or all defined servers if *addresses* is
+        omitted). The method returns a mapping of address to sequences of
+        :class:`CompoundPiTransfer` instances. If *transfer_id* is specified,
+        only the state of that transfer is returned.
+
+        Servers send files to the client in the background, replying to the
+        :ref:`protocol_send` command as soon as the transfer is queued. The
+        :meth:`download` and :meth:`download_many` methods use this method to
+        determine whether a transfer which has stalled has failed on the
+        server.
+        """
+        transaction = self.servers.transact(
+            self._protocol.do_transfers(transfer_id), addresses)
         responses = {
             address: [
-                self.list_line_re.match(line)
+                self.transfer_line_re.match(line)
                 for line in (data or '').splitlines()
                 ]
-            for (address, data) in self.servers.transact(
-                self._protocol.do_list(), addresses).items()
+            for (address, data) in transaction.items()
             }
         errors = []
         result = {}
@@ -1415,26 +2952,43 @@ class CompoundPiClient(object):
                 if match is None:
                     errors.append(CompoundPiInvalidResponse(address))
                 else:
-                    result[address].append(CompoundPiFile(
-                        match.group('filetype'),
-                        int(match.group('index')),
-                        datetime.datetime.fromtimestamp(float(match.group('time'))),
-                        int(match.group('size')),
+                    result[address].append(CompoundPiTransfer(
+                        int(match.group('id')),
+                        match.group('state'),
+                        match.group('message'),
                         ))
         if errors:
             raise CompoundPiTransactionFailed(
                 errors, '%d invalid lines in responses' % len(errors))
-        return result
+        return self._result(transaction, result)
 
-    def clear(self, addresses=None):
+    def clear(self, addresses=None, count=None):
         """
         Called to clear captured files from the RAM of the servers at the
         specified *addresses* (or all defined servers if *addresses* is
         omitted). Currently the protocol for the :ref:`protocol_clear` message
-        is fairly crude: it simply clears all captured files on the server;
-        there is no method for specifying a subset of files to wipe.
+        is fairly crude: it simply clears all captured files on the server
+        or, if *count* is specified, the first *count* files (as returned by
+        :meth:`list`). The latter permits files to be cleared after download
+        without losing files stored in the meantime, e.g. by a segmented
+        :meth:`record`. The remaining files are renumbered from 0.
+
+        Servers refuse to clear their files while transfers to the client are
+        still in progress (see :meth:`transfers`). Any partial transfers
+        recorded in the transfer journal (see :meth:`download`) for the
+        cleared servers are forgotten.
         """
-        self.servers.transact(self._protocol.do_clear(), addresses)
+        self.servers.transact(self._protocol.do_clear(count), addresses)
+        if addresses is None:
+            self._journal.clear()
+        else:
+            addresses = set(
+                a if isinstance(a, IPv4Address) else IPv4Address(a)
+                for a in addresses
+                )
+            for key in list(self._journal):
+                if key[0] in addresses:
+                    del self._journal[key]
 
     def identify(self, addresses=None):
         """
@@ -1445,7 +2999,7 @@ class CompoundPiClient(object):
         """
         self.servers.transact(self._protocol.do_blink(), addresses)
 
-    def download(self, address, index, output):
+    def download(self, address, index, output, retries=0, resume=False):
         """
         Called to download the image with the specified *index* from the server
         at *address*, writing the content to the file-like object provided by
@@ -1479,7 +3033,51 @@ class CompoundPiClient(object):
                             client.download(addr, f.index, f)
                 # Wipe all files on all servers
                 client.clear()
+
+        If a transfer fails part way through, the number of bytes received is
+        recorded in the client's transfer journal. A later call to download
+        the same file into an *output* which still contains the received bytes
+        (for example, a file re-opened in ``r+b`` mode) resumes the transfer
+        from that point rather than starting again. If *retries* is greater
+        than zero, a failed transfer is automatically resumed up to that many
+        times before the error is raised. Journal entries are discarded when
+        the transfer completes or when the server's files are cleared with
+        :meth:`clear`.
+
+        The journal is only held in memory. To resume a transfer begun by
+        another client (for example, before the application was restarted),
+        set *resume* to ``True``; in the absence of a journal entry the
+        existing content of *output* is then assumed to be the start of the
+        file and the transfer continues from its end.
         """
+        key = (
+            address if isinstance(address, IPv4Address) else
+            IPv4Address(address), index)
+        while True:
+            # Only resume if the output still contains everything the journal
+            # says we received; otherwise start from scratch
+            output.seek(0, io.SEEK_END)
+            available = output.tell()
+            offset = min(
+                self._journal.get(key, available if resume else 0), available)
+            output.seek(offset)
+            try:
+                self._download_range(address, index, output, offset)
+            except (CompoundPiSendTimeout, CompoundPiSendTruncated):
+                received = output.tell()
+                if received > offset:
+                    self._journal[key] = received
+                if retries < 1:
+                    raise
+                retries -= 1
+                logging.warning(
+                    'Resuming download of file %d from %s at byte %d',
+                    index, address, self._journal.get(key, 0))
+            else:
+                self._journal.pop(key, None)
+                break
+
+    def _download_range(self, address, index, output, offset):
         self._server.source = address
         self._server.output = output
         self._server.event.clear()
@@ -1489,44 +3087,206 @@ class CompoundPiClient(object):
         save_progress = self._servers._progress
         self._servers._progress = CompoundPiProgressHandler()
         try:
-            self.servers.transact(
-                self._protocol.do_send(index, self.bind[1]), [address])
-            if not self._server.event.wait(self.servers.timeout):
-                raise CompoundPiSendTimeout(address)
-            elif self._server.exception:
-                raise self._server.exception
+            response = self.servers.transact(
+                self._protocol.do_send(index, self.bind[1], offset), [address])
+            self._wait_transfer(address, response)
         finally:
+            self._stop_transfer()
             self._server.source = None
             self._server.output = None
             self._server.exception = None
             self._servers._progress = save_progress
 
 
+    def download_many(self, address, factory, start=0, count=None):
+        """
+        Called to download several files from the server at *address* over a
+        single connection. This is considerably more efficient than calling
+        :meth:`download` for each file when a server holds many small files
+        (for example, after a burst capture).
+
+        The files downloaded are those with indexes *start* onward (defaulting
+        to all files), limited to *count* files if specified. For each file
+        received, *factory* is called with a :class:`CompoundPiFile` describing
+        the file and must return a file-like object that the content of the
+        file will be written to. Files are received sequentially; *factory*
+        will not be called for the next file until the content of the prior
+        file has been completely written. The caller is responsible for
+        closing the objects returned by *factory*. For example::
+
+            import io
+            from compoundpi.client import CompoundPiClient
+
+            with CompoundPiClient() as client:
+                client.servers.network = '192.168.0.0/24'
+                client.capture(count=10, video_port=True)
+                for addr in client.servers:
+                    images = {}
+                    def factory(f):
+                        images[f.index] = io.BytesIO()
+                        return images[f.index]
+                    client.download_many(addr, factory)
+                client.clear()
+
+        The method returns the list of :class:`CompoundPiFile` instances
+        received. If the transfer fails part way through a file, the bytes of
+        that file that were received are recorded in the transfer journal so
+        that a subsequent :meth:`download` of the file can resume it.
+        """
+        self._server.source = address
+        self._server.factory = factory
+        self._server.received = []
+        self._server.partial = None
+        self._server.event.clear()
+        save_progress = self._servers._progress
+        self._servers._progress = CompoundPiProgressHandler()
+        try:
+            response = self.servers.transact(
+                self._protocol.do_sendall(self.bind[1], start, count), [address])
+            self._wait_transfer(address, response)
+            return self._server.received
+        except (CompoundPiSendTimeout, CompoundPiSendTruncated):
+            if self._server.partial:
+                f, received = self._server.partial
+                self._journal[(
+                    address if isinstance(address, IPv4Address) else
+                    IPv4Address(address), f.index)] = received
+            raise
+        finally:
+            self._stop_transfer()
+            self._server.source = None
+            self._server.factory = None
+            self._server.received = []
+            self._server.partial = None
+            self._server.exception = None
+            self._servers._progress = save_progress
+
+
+    def _stop_transfer(self):
+        # Abort any handler still receiving a transfer we've given up on, and
+        # wait for it to finish, so that it can't write to an output which is
+        # about to be reused (e.g. by a retry)
+        handler = self._server.active
+        if handler is not None:
+            try:
+                handler.connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            handler.finished.wait()
+
+    transfer_re = re.compile(r'TRANSFER (?P<id>\d+)')
+    def _wait_transfer(self, address, response):
+        # Servers send files in the background after responding, so rather
+        # than limiting the whole transfer to the network timeout we wait for
+        # as long as data continues to arrive. If the transfer stalls, ask the
+        # server why
+        if not isinstance(address, IPv4Address):
+            address = IPv4Address(address)
+        match = self.transfer_re.match(response.get(address) or '')
+        while True:
+            activity = self._server.activity
+            if self._server.event.wait(self.servers.timeout):
+                break
+            if self._server.activity != activity:
+                continue
+            if match:
+                try:
+                    state = self.transfers(
+                        [address], int(match.group('id')))[address][0]
+                except (CompoundPiTransactionFailed, KeyError, IndexError):
+                    raise CompoundPiSendTimeout(address)
+                if state.state == 'FAILED':
+                    raise CompoundPiServerError(address, state.message)
+                elif state.state == 'QUEUED':
+                    continue
+            raise CompoundPiSendTimeout(address)
+        if self._server.exception:
+            raise self._server.exception
+
+
 class CompoundPiDownloadHandler(socketserver.StreamRequestHandler):
     def handle(self):
         if self.client_address[0] != str(self.server.source):
             warnings.warn(CompoundPiUnknownAddress(self.client_address[0]))
-        else:
-            size, = struct.unpack(
-                native_str('>L'),
-                self.rfile.read(struct.calcsize(native_str('>L'))))
-            self.server.output.truncate(size)
-            self.server.output.seek(0)
+            return
+        # Register as the active handler so the client can abort the
+        # transfer if it times out
+        self.finished = threading.Event()
+        self.server.active = self
+        try:
+            if self.server.output is not None:
+                self.handle_one()
+            else:
+                self.handle_many()
+        finally:
+            if self.server.active is self:
+                self.server.active = None
+            self.finished.set()
+
+    def handle_one(self):
+        try:
+            size, = self.read_struct('>Q')
+            # Discard anything beyond the resume point so that an interrupted
+            # transfer leaves the output exactly as long as the data received
+            start = self.server.output.tell()
+            self.server.output.truncate(start)
             self.server.progress.start(size)
-            try:
-                while self.server.output.tell() < size:
-                    data = self.rfile.read(16384)
+            while self.server.output.tell() < start + size:
+                data = self.rfile.read(16384)
+                if not data:
+                    raise CompoundPiSendTruncated(self.server.source)
+                self.server.output.write(data)
+                self.server.activity += 1
+                self.server.progress.update(
+                    self.server.output.tell() - start)
+        except Exception as e:
+            self.server.exception = e
+        else:
+            self.server.exception = None
+        finally:
+            self.server.progress.finish()
+            self.server.event.set()
+
+    def read_struct(self, fmt):
+        size = struct.calcsize(native_str(fmt))
+        data = self.rfile.read(size)
+        if len(data) < size:
+            raise CompoundPiSendTruncated(self.server.source)
+        return struct.unpack(native_str(fmt), data)
+
+    def handle_many(self):
+        try:
+            count, total = self.read_struct('>LQ')
+            self.server.progress.start(total)
+            position = 0
+            for i in range(count):
+                index, filetype, timestamp, size = self.read_struct('>L8sdQ')
+                f = CompoundPiFile(
+                    filetype.decode('ascii').strip(),
+                    index,
+                    datetime.datetime.fromtimestamp(timestamp),
+                    size,
+                    )
+                output = self.server.factory(f)
+                received = 0
+                while received < size:
+                    data = self.rfile.read(min(16384, size - received))
                     if not data:
+                        self.server.partial = (f, received)
                         raise CompoundPiSendTruncated(self.server.source)
-                    self.server.output.write(data)
-                    self.server.progress.update(self.server.output.tell())
-            except Exception as e:
-                self.server.exception = e
-            else:
-                self.server.exception = None
-            finally:
-                self.server.progress.finish()
-                self.server.event.set()
+                    output.write(data)
+                    received += len(data)
+                    self.server.activity += 1
+                    self.server.progress.update(position + received)
+                position += size
+                self.server.received.append(f)
+        except Exception as e:
+            self.server.exception = e
+        else:
+            self.server.exception = None
+        finally:
+            self.server.progress.finish()
+            self.server.event.set()
 
 
 class CompoundPiDownloadServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
@@ -28,9 +28,44 @@ str = type('')
 
 
 import threading
+import logging
+import heapq
+import itertools
 import time
 import random
 
+from .ipaddress import IPv4Address
+
+
+def target_selector(addresses):
+    """
+    Returns a compact selector matching the IPv4 *addresses* given, for
+    inclusion in a broadcast command.
+
+    The selector consists of the lowest address, a forward slash, and a
+    bitmap (in hexadecimal) in which bit *n* is set if the address *n*
+    above the lowest address is selected.
+    """
+    addresses = sorted(
+        int(address if isinstance(address, IPv4Address) else
+            IPv4Address(address))
+        for address in addresses)
+    base = addresses[0]
+    bitmap = 0
+    for address in addresses:
+        bitmap |= 1 << (address - base)
+    return '%s/%x' % (IPv4Address(base), bitmap)
+
+
+def target_selected(selector, address):
+    """
+    Returns True if the IPv4 *address* is matched by the *selector* (as
+    generated by :func:`target_selector`).
+    """
+    base, bitmap = selector.split('/')
+    offset = int(IPv4Address(address)) - int(IPv4Address(base))
+    return offset >= 0 and bool(int(bitmap, 16) >> offset & 1)
+
 
 class NetworkRepeater(threading.Thread):
     """
@@ -49,9 +84,18 @@ class NetworkRepeater(threading.Thread):
     before the repeater will cease repeating its tranmissions. The optional
     *interval* parameter specifies the largest possible interval between
     re-transmissions. The actual interval is randomly selected from a uniform
-    distribution to reduce the likelihood of colliding transmissions causing
-    dropped packets. Prior to use of this class the random number generator
-    should be randomly seeded with :func:`random.seed`.
+    distribution between half *interval* and *interval* to reduce the
+    likelihood of colliding transmissions causing dropped packets. Prior to use
+    of this class the random number generator should be randomly seeded with
+    :func:`random.seed`.
+
+    The optional *backoff* parameter specifies the factor by which the
+    interval is multiplied after each re-transmission, up to a limit of
+    *max_interval* seconds. The :attr:`interval` attribute may be altered
+    while the repeater is running; the change takes effect from the next
+    re-transmission. The :attr:`sent` attribute records the time of the first
+    transmission and the :attr:`sends` attribute counts the transmissions made
+    so far.
 
     To terminate re-transmission early (e.g. in the event of receiving a
     response), set the :attr:`terminate` attribute to True then
@@ -60,21 +104,197 @@ class NetworkRepeater(threading.Thread):
     class.
     """
 
-    def __init__(self, socket, address, data, timeout=5, interval=0.5):
+    def __init__(self, socket, address, data, timeout=5, interval=0.5,
+            backoff=1, max_interval=5):
         super(NetworkRepeater, self).__init__()
         self.socket = socket
         self.address = address
         self.data = data
         self.timeout = timeout
         self.interval = interval
+        self.backoff = backoff
+        self.max_interval = max_interval
         self.terminate = False
+        self.sent = time.time()
+        self.sends = 0
         self.daemon = True
         self.start()
 
     def run(self):
-        start = time.time()
-        while not self.terminate and time.time() < start + self.timeout:
+        while not self.terminate and time.time() < self.sent + self.timeout:
             self.socket.sendto(self.data, self.address)
-            time.sleep(random.uniform(0.0, self.interval))
+            self.sends += 1
+            delay = min(
+                self.max_interval,
+                self.interval * self.backoff ** (self.sends - 1))
+            time.sleep(random.uniform(delay / 2, delay))
+
+
+class NetworkTransmission(object):
+    """
+    A network transmission to be repeated by a :class:`NetworkScheduler`.
+
+    The *socket*, *address*, *data*, *timeout* and *interval* parameters have
+    the same meaning as for :class:`NetworkRepeater`. Setting the
+    :attr:`terminate` attribute to True cancels any further re-transmissions,
+    although removing the transmission from its scheduler is preferred.
+    """
+
+    def __init__(self, socket, address, data, timeout=5, interval=0.5):
+        self.socket = socket
+        self.address = address
+        self.data = data
+        self.timeout = timeout
+        self.interval = interval
+        self.terminate = False
+        self.expires = None
+
+
+class NetworkScheduler(object):
+    """
+    Repeats many network transmissions from a single background thread.
+
+    Instances of this class act as a mapping of keys (typically a tuple of
+    address and sequence number) to :class:`NetworkTransmission` instances.
+    Assigning a transmission to a key sends it immediately and schedules its
+    re-transmission at random intervals (between half the transmission's
+    *interval* and its *interval*, as for :class:`NetworkRepeater`) until it is removed (with
+    :meth:`pop` or ``del``) or its timeout elapses, at which point it is
+    dropped. Assigning a transmission to a key that is already present
+    replaces the earlier transmission.
+
+    The :attr:`retransmits`, :attr:`acked`, and :attr:`expired` attributes
+    count the number of re-transmissions sent, the number of transmissions
+    removed before their timeout, and the number of transmissions that timed
+    out respectively.
+
+    The background thread is started when the first transmission is added and
+    is stopped by :meth:`close`.
+    """
+
+    def __init__(self):
+        self.retransmits = 0
+        self.acked = 0
+        self.expired = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._transmissions = {}
+        self._heap = []
+        self._order = itertools.count()
+        self._closed = False
+        self._thread = None
+
+    def close(self):
+        with self._wakeup:
+            self._closed = True
+            self._transmissions.clear()
+            del self._heap[:]
+            self._wakeup.notify()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._transmissions)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._transmissions
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._transmissions[key]
+
+    def __setitem__(self, key, transmission):
+        transmission.expires = time.time() + transmission.timeout
+        self._send(transmission)
+        with self._wakeup:
+            if self._closed:
+                return
+            self._transmissions[key] = transmission
+            self._schedule(key, transmission, time.time())
+            self._wakeup.notify()
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def __delitem__(self, key):
+        with self._lock:
+            transmission = self._transmissions.pop(key)
+            transmission.terminate = True
+            self.acked += 1
+
+    def pop(self, key, *default):
+        """
+        Remove the transmission associated with *key* and return it, cancelling
+        any further re-transmissions. If *key* is not present, *default* is
+        returned if given, otherwise :exc:`KeyError` is raised.
+        """
+        try:
+            transmission = self[key]
+            del self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        return transmission
+
+    def _schedule(self, key, transmission, now):
+        # The order counter ensures heap entries never compare their keys or
+        # transmissions. Entries for transmissions that have since been
+        # removed or replaced are discarded when they reach the top of the heap
+        heapq.heappush(self._heap, (
+            now + random.uniform(
+                transmission.interval / 2, transmission.interval),
+            next(self._order), key, transmission))
+
+    def _send(self, transmission):
+        try:
+            transmission.socket.sendto(transmission.data, transmission.address)
+        except IOError as e:
+            logging.warning(
+                'Failed to send to %s:%d: %s',
+                transmission.address[0], transmission.address[1], e)
 
+    def _run(self):
+        with self._wakeup:
+            while not self._closed:
+                now = time.time()
+                when = self._process(now)
+                if when is None:
+                    self._wakeup.wait()
+                else:
+                    self._wakeup.wait(when - now)
 
+    def _process(self, now):
+        # Must be called with the lock held. Sends the re-transmissions due at
+        # *now* and returns the time the next is due (or None if none are
+        # scheduled). Due entries are collected before any are re-scheduled
+        # so that each is sent at most once per call
+        due = []
+        while self._heap:
+            when, order, key, transmission = self._heap[0]
+            if (
+                    transmission.terminate or
+                    self._transmissions.get(key) is not transmission):
+                heapq.heappop(self._heap)
+                if self._transmissions.get(key) is transmission:
+                    del self._transmissions[key]
+            elif when <= now:
+                heapq.heappop(self._heap)
+                due.append((key, transmission))
+            else:
+                break
+        for key, transmission in due:
+            if now >= transmission.expires:
+                del self._transmissions[key]
+                self.expired += 1
+                continue
+            self._send(transmission)
+            self.retransmits += 1
+            self._schedule(key, transmission, now)
+        if self._heap:
+            return self._heap[0][0]
+        return None
@@ -114,6 +114,15 @@ class CompoundPiHelloError(CompoundPiServerWarning):
         self.error = error
 
 
+class CompoundPiPacketsDropped(CompoundPiWarning):
+    "Warning raised when the kernel drops responses as the buffer is full"
+
+    def __init__(self, count):
+        super(CompoundPiPacketsDropped, self).__init__(
+            '%d response(s) dropped by the receive buffer' % count)
+        self.count = count
+
+
 class CompoundPiStaleSequence(CompoundPiClientWarning):
     def __init__(self, address, seqno):
         super(CompoundPiStaleSequence, self).__init__(
@@ -183,6 +192,14 @@ class CompoundPiRedefinedServer(CompoundPiClientError):
                 'server already defined: %s' % address)
 
 
+class CompoundPiWindowFull(CompoundPiClientError):
+    "Exception raised when too many transactions are outstanding"
+
+    def __init__(self, window):
+        super(CompoundPiWindowFull, self).__init__(
+                'too many outstanding transactions (window is %d)' % window)
+
+
 class CompoundPiInvalidResponse(CompoundPiServerError):
     "Exception raised when a server returns an unexpected response"
 
@@ -46,5 +46,9 @@ if sys.version_info < (3, 3):
         @property
         def broadcast_address(self):
             return self.broadcast
+
+        @property
+        def num_addresses(self):
+            return self.numhosts
 else:
     from ipaddress import IPv4Address, IPv4Network
@@ -127,6 +127,14 @@ a client command permits servers to ignore repeated commands that they have
 already seen. Likewise, the sequence number of the server response permits
 clients to ignore repeated responses they have already seen.
 
+Clients may have several commands outstanding at once, so commands may arrive
+out of order. Servers must execute each sequence number at most once, and
+must accept any sequence number that has not been executed and lies within a
+window of 32 below the highest sequence number executed so far. Sequence
+numbers older than the window are rejected as stale. Clients must not have
+more than 32 commands outstanding, and match responses to commands by their
+sequence number.
+
 Commands are repeated by the client until it has received a response from the
 targetted server(s) (all located servers on the subnet in the case of broadcast
 messages), or until a timeout has elapsed (5 seconds by default).
@@ -135,6 +143,41 @@ Responses are repeated by a server until it receives an ACK from the client
 with a corresponding sequence number, or until a timeout has elapsed (5 seconds
 by default).
 
+Servers should remember the responses they have recently sent (the current
+implementation retains up to 100 responses for up to 30 seconds). When a
+repeated command arrives whose response is remembered, the server should send
+that response again immediately without re-executing the command. This saves
+the client from waiting for the next repetition of a response that was lost.
+
+Responses must fit within a single 512 byte datagram. Longer responses (for
+example, the response to :ref:`protocol_list` when many files are stored) are
+split into several fragments, each of which is sent as a separate datagram.
+The sequence number of each fragment is followed by a period, the zero-based
+index of the fragment, a forward slash, and the number of fragments in the
+response::
+
+    <sequence-number>.<fragment>/<fragments> OK
+    <data>
+
+The client reassembles the response by concatenating the data of the
+fragments in order. Each fragment is repeated by the server until the client
+acknowledges it with an ACK command that includes the fragment's index::
+
+    <sequence-number>.<fragment> ACK
+
+Commands intended for a subset of the servers may still be broadcast (ensuring
+all targetted servers receive the command simultaneously) by following the
+sequence number with an at-sign and a target selector. The selector consists
+of the lowest targetted address, a forward slash, and a hexadecimal bitmap in
+which bit *n* (counting from the least significant bit) is set if the address
+*n* above the lowest address is targetted. For example, the following command
+targets 192.168.0.10, 192.168.0.11, and 192.168.0.14::
+
+    8@192.168.0.10/13 CAPTURE 1,0
+
+Servers whose address is not selected must ignore the command entirely,
+sending no response.
+
 An exception to the above is the :ref:`protocol_hello` command. Because this
 command sets a new sequence number, servers cannot use the sequence number to
 detect repeated packets. Hence, the :ref:`protocol_hello` command includes the
@@ -223,11 +266,14 @@ def handler(command, *params):
 
 
 class CompoundPiProtocol(object):
+    max_datagram = 512
+    window = 32
     request_re = re.compile(
-            r'(?P<seqno>\d+) '
+            r'(?P<seqno>\d+)(\.(?P<fragment>\d+))?'
+            r'(@(?P<targets>[0-9.]+/[0-9a-f]+))? '
             r'(?P<command>[A-Z]+)( (?P<params>.+))?')
     response_re = re.compile(
-            r'(?P<seqno>\d+) '
+            r'(?P<seqno>\d+)(\.(?P<fragment>\d+)/(?P<fragments>\d+))? '
             r'(?P<result>[A-Z]+)(\n(?P<data>.+))?', flags=re.DOTALL)
 
     """
@@ -281,6 +327,34 @@ class CompoundPiProtocol(object):
         """
         raise NotImplementedError
 
+    @handler('TIME')
+    def do_time(self):
+        """
+        The :ref:`protocol_time` command is used by the client to estimate the
+        offset of the server's clock from its own, and the network round-trip
+        time, in the manner of NTP. The server must respond with the time at
+        which it received the command, and the time at which it sent the
+        response, in the data portion of the OK response::
+
+            <received>,<sent>
+
+        Both timestamps are in UNIX-time format: a dotted-decimal value of the
+        number of seconds since the UNIX epoch. The received timestamp should
+        be taken as early as possible after the command's datagram arrives,
+        and the sent timestamp as late as possible before the response is
+        sent.
+
+        Together with the times at which the client sent the command and
+        received the response, this gives the four timestamps of an NTP
+        exchange. The client typically repeats the exchange several times and
+        keeps the sample with the smallest round-trip time.
+
+        Unlike other commands, a retransmitted :ref:`protocol_time` command
+        must not be answered with a replay of the original response (whose
+        timestamps would be stale); the server must execute it again.
+        """
+        raise NotImplementedError
+
     @handler('STATUS')
     def do_status(self):
         """
@@ -552,6 +626,45 @@ class CompoundPiProtocol(object):
         """
         raise NotImplementedError
 
+    @handler(
+        'CONFIGURE', int, int, limitedfrac, lowerstr, limitedfrac,
+        limitedfrac, lowerstr, lowerstr, float, int, lowerstr, int, int, int,
+        int, boolstr, boolstr, boolstr)
+    def do_configure(
+            self, width=None, height=None, framerate=None, awb_mode=None,
+            awb_red=None, awb_blue=None, agc_mode=None, exposure_mode=None,
+            exposure_speed=None, iso=None, metering_mode=None,
+            brightness=None, contrast=None, saturation=None, ev=None,
+            hflip=None, vflip=None, denoise=None):
+        """
+        The :ref:`protocol_configure` command changes any subset of the
+        camera's settings at once. Each parameter has the same meaning as the
+        corresponding parameter of the individual commands
+        (:ref:`protocol_resolution`, :ref:`protocol_framerate`,
+        :ref:`protocol_awb`, :ref:`protocol_agc`, :ref:`protocol_exposure`,
+        :ref:`protocol_iso`, :ref:`protocol_metering`,
+        :ref:`protocol_brightness`, :ref:`protocol_contrast`,
+        :ref:`protocol_saturation`, :ref:`protocol_ev`,
+        :ref:`protocol_flip`, and :ref:`protocol_denoise`). Parameters which
+        are left empty leave the corresponding setting unchanged. For
+        example, the following command changes the resolution and framerate,
+        and fixes the white balance gains, leaving all other settings alone::
+
+            9 CONFIGURE 1920,1080,30,off,3/2,5/4
+
+        The width and height must be specified together, as must the
+        horizontal and vertical flips. The server should apply the settings
+        with as few camera reconfigurations as possible: the resolution and
+        framerate (which reset the camera) should only be changed if they
+        differ from the current values. If the AGC mode is ``'off'`` it should
+        be applied last so that the gains are fixed at the values resulting
+        from the other settings; any other AGC mode should be applied first
+        so that the gains can float while the camera is reset.
+
+        An OK response is expected with no data.
+        """
+        raise NotImplementedError
+
     @handler('CAPTURE', int, boolstr, int, float)
     def do_capture(self, count=1, use_video_port=False, quality=None, sync=None):
         """
@@ -589,13 +702,72 @@ class CompoundPiProtocol(object):
         RAM, but implementations are free to use any storage medium they see
         fit.
 
-        An OK response is expected with no data.
+        The capture should take place in the background; the server must
+        validate the parameters and send an OK response as soon as the capture
+        is queued, with data in the following format::
+
+            JOB <id>
+
+        Where :samp:`<id>` is an integer identifying the job which can be used
+        with the :ref:`protocol_jobs` command to query its progress. If the
+        parameters are invalid (for example, *sync* is in the past), an ERROR
+        response must be sent instead.
+        """
+        raise NotImplementedError
+
+    @handler('ARM', int, boolstr, int)
+    def do_arm(self, count=1, use_video_port=False, quality=None):
+        """
+        The :ref:`protocol_arm` command should cause the server to prepare a
+        capture which will be taken as soon as possible after receipt of the
+        :ref:`protocol_fire` command. The *count*, *video-port*, and *quality*
+        parameters are as for :ref:`protocol_capture`, except that a *count*
+        of 0 disarms a previously armed capture.
+
+        The server should do as much of the work of the capture as possible in
+        advance: configuring the camera port and encoder, and fixing the
+        exposure and white balance gains at their current values (the prior
+        settings are restored once the capture is complete). The video port
+        is recommended for the lowest latency as the still port may still
+        require a mode switch when fired.
+
+        Like :ref:`protocol_capture`, the armed capture is run as a job; the
+        server must send an OK response with data in the format ``JOB <id>``.
+        Jobs queued after the armed capture do not start until it has been
+        fired or disarmed. If a capture is already armed, an ERROR response
+        must be sent.
+        """
+        raise NotImplementedError
+
+    @handler('FIRE')
+    def do_fire(self):
+        """
+        The :ref:`protocol_fire` command should cause the server to take the
+        capture prepared by :ref:`protocol_arm`. The command is deliberately
+        minimal so that it can be broadcast, and acted upon, with as little
+        delay as possible.
+
+        The server must not wait for the capture to be taken; it must
+        immediately send an OK response with the identifier of the armed
+        capture's job, in the format ``JOB <id>``. When the job completes, the
+        message of its state (see :ref:`protocol_jobs`) gives the delay (in
+        seconds) between the receipt of the command and the start of the
+        capture of the first image, in the following format::
+
+            DELAY <seconds>
+
+        The first file of the capture also reports the time at which the
+        command was received as its *requested* time in response to
+        :ref:`protocol_list`.
+
+        If no capture is armed, or the armed capture is still waiting for
+        earlier jobs to complete, an ERROR response must be sent.
         """
         raise NotImplementedError
 
-    @handler('RECORD', float, lowerstr, int, int, int, boolstr, float)
+    @handler('RECORD', float, lowerstr, int, int, int, boolstr, float, float)
     def do_record(self, length, format='h264', quality=0, bitrate=17000000,
-            intra_period=None, motion_output=False, sync=None):
+            intra_period=None, motion_output=False, sync=None, segment=None):
         """
         The :ref:`protocol_record` command should cause the server to record a
         video for *length* seconds from the camera. The parameters are as
@@ -639,22 +811,128 @@ class CompoundPiProtocol(object):
             recorded as a separate file with an equivalent timestamp to the
             corresponding video data.
 
+        *segment*
+            Only valid if format is ``h264``. If specified, the recording is
+            split into consecutive files approximately *segment* seconds long.
+            Splits occur at the first keyframe after each *segment* seconds
+            has elapsed so no frames are lost between files. If unspecified,
+            the recording is stored as a single file.
+
         The video recorded in response to the command should be stored locally
         on the server until its retrieval is requested by the
         :ref:`protocol_send` command.  The timestamp at which the recording was
-        started must be stored. Storage in this implementation is simply in
+        started must be stored. When *segment* is specified, each completed
+        segment (and its motion data, if any) must be stored, with the
+        timestamp at which it started, as soon as the following segment
+        begins. Completed segments can therefore be listed, retrieved, and
+        cleared while the recording continues. Storage in this implementation is simply in
         RAM, but implementations are free to use any storage medium they see
         fit.
 
-        An OK response is expected with no data.
+        As with :ref:`protocol_capture`, the recording takes place in the
+        background and the server must send an OK response as soon as the
+        recording is queued, with data in the format ``JOB <id>``.
+        """
+        raise NotImplementedError
+
+    @handler('BUFFER', float, int, int, int)
+    def do_buffer(self, length, quality=0, bitrate=17000000, intra_period=None):
+        """
+        The :ref:`protocol_buffer` command should cause the server to start
+        recording ``h264`` video continuously into a fixed-size circular
+        buffer in memory which retains only the most recent *length* seconds
+        of video. The stored video can then be saved with the
+        :ref:`protocol_trigger` command. The parameters are as follows:
+
+        *length*
+            Specifies the number of seconds of video to retain as a floating
+            point number. If zero, buffering stops and the buffer is
+            discarded.
+
+        *quality*
+            Specifies the quality of the encoding, as for
+            :ref:`protocol_record`.
+
+        *bitrate*
+            Specifies the bitrate limit for the video encoder. Defaults to
+            17000000 if unspecified. The buffer is sized according to this
+            limit so the memory it occupies remains constant regardless of
+            how long buffering continues.
+
+        *intra-period*
+            Specifies the number of frames in a GOP (group of pictures), as for
+            :ref:`protocol_record`. The video saved by :ref:`protocol_trigger`
+            always starts with a keyframe, so shorter periods permit the saved
+            video to be trimmed more precisely. Defaults to 30 if unspecified.
+
+        If the server is already buffering, the existing buffer is discarded
+        and a new one started. Buffering runs independently of the jobs
+        started by :ref:`protocol_capture` and :ref:`protocol_record`. An OK
+        response is expected with no data.
+        """
+        raise NotImplementedError
+
+    @handler('TRIGGER', float)
+    def do_trigger(self, length=None):
+        """
+        The :ref:`protocol_trigger` command should cause the server to save
+        the content of the buffer started by :ref:`protocol_buffer` as a
+        ``VIDEO`` file (which can then be retrieved with :ref:`protocol_send`).
+        If *length* is specified, only the last *length* seconds of the
+        buffer are saved; otherwise the whole buffer is saved. The timestamp
+        of the file is the time at which the saved video begins.
+
+        The command is intended to be broadcast when an event of interest has
+        just occurred; the saved video therefore includes the period before
+        the command was received, and ends at the last frame buffered when it
+        arrived. Buffering continues after the command so the command may be
+        repeated for subsequent events. If the server is not buffering, an
+        ERROR response must be sent. Otherwise, an OK response is expected
+        with no data. The response need not wait for the video to be saved;
+        the server saves it in the background (independently of jobs and
+        transfers) and the file appears in the response to
+        :ref:`protocol_list` once saved.
         """
         raise NotImplementedError
 
-    @handler('SEND', int, int)
-    def do_send(self, file_num, port):
+    @handler('JOBS', int)
+    def do_jobs(self, job_id=None):
         """
-        The :ref:`protocol_send` command causes the specified file to be sent
-        from the server to the client. The parameters are as follows:
+        The :ref:`protocol_jobs` command causes the server to respond with a
+        new-line separated list of the states of recent jobs started by the
+        :ref:`protocol_capture` and :ref:`protocol_record` commands. If *id*
+        is specified, only the state of that job is returned. Each line in the
+        data portion of the response has the following format::
+
+            <id>,<state>,<progress>,<message>
+
+        The :samp:`state` is one of ``QUEUED`` (the job is waiting for the
+        camera), ``RUNNING`` (the job is in progress), ``DONE`` (the job
+        completed successfully), or ``FAILED`` (the job failed). The
+        :samp:`progress` is a dotted-decimal value between 0.0 and 1.0
+        indicating the proportion of the job that is complete. If the job has
+        failed, :samp:`message` describes the error. Otherwise it is empty,
+        except for armed captures which report their delay (see
+        :ref:`protocol_fire`). For example::
+
+            1,DONE,1.000,
+            2,RUNNING,0.250,
+
+        Jobs are executed one at a time in the order they were received. Files
+        produced by a job are available from the :ref:`protocol_list` command
+        as soon as they are complete, even while the job is still running.
+        Servers only need to retain the states of a limited number of recent
+        jobs. If *id* refers to a job which is unknown, the server must send
+        an ERROR response.
+        """
+        raise NotImplementedError
+
+    @handler('SEND', int, int, int, int)
+    def do_send(self, file_num, port, offset=0, length=None):
+        """
+        The :ref:`protocol_send` command causes the specified file (or a range
+        of bytes within it) to be sent from the server to the client. The
+        parameters are as follows:
 
         *index*
             Specifies the zero-based index of the file that the client wants
@@ -666,10 +944,104 @@ class CompoundPiProtocol(object):
             to in order to transmit the data. This is given as an integer
             number (never a service name).
 
-        Assuming *index* refers to a valid image file, the server must connect
-        to the specified TCP port on the client, send the bytes of the file,
-        and finally close the connection. The server must also send an OK
-        response with no data.
+        *offset*
+            Specifies the byte offset within the file at which transmission
+            should start. If unspecified, defaults to 0. This must not exceed
+            the size of the file.
+
+        *length*
+            Specifies the maximum number of bytes to send. If unspecified, all
+            bytes from *offset* to the end of the file are sent.
+
+        Assuming *index* refers to a valid file, the server must connect to
+        the specified TCP port on the client, send the number of bytes that
+        will follow as an unsigned 64-bit big-endian integer, then send the
+        requested bytes of the file, and finally close the connection.
+
+        The transfer should take place in the background; the server must
+        send an OK response as soon as the transfer is queued, with data in
+        the following format::
+
+            TRANSFER <id>
+
+        Where :samp:`<id>` is an integer identifying the transfer which can be
+        used with the :ref:`protocol_transfers` command to query the progress
+        of the transfer.
+
+        Clients can use *offset* to resume a transfer which was interrupted,
+        requesting only the bytes that were not received by the failed
+        transfer.
+        """
+        raise NotImplementedError
+
+    @handler('SENDALL', int, int, int)
+    def do_sendall(self, port, start=0, count=None):
+        """
+        The :ref:`protocol_sendall` command causes a range of files to be sent
+        from the server to the client over a single connection. The parameters
+        are as follows:
+
+        *port*
+            Specifies the TCP port on the client that the server should connect
+            to in order to transmit the data. This is given as an integer
+            number (never a service name).
+
+        *start*
+            Specifies the zero-based index of the first file to send. If
+            unspecified, defaults to 0.
+
+        *count*
+            Specifies the number of files to send. If unspecified, all files
+            from *start* onward are sent.
+
+        The server must connect to the specified TCP port on the client and
+        send a header consisting of the number of files that will follow as an
+        unsigned 32-bit big-endian integer, and the total number of bytes of
+        file data that will follow as an unsigned 64-bit big-endian integer.
+        Each file is then sent as a record consisting of the following fields
+        (all big-endian), immediately followed by the bytes of the file:
+
+        ============ ====================================================
+        Size (bytes) Content
+        ============ ====================================================
+        4            The file's index as an unsigned integer
+        8            The filetype (as in :ref:`protocol_list`) in ASCII,
+                     padded with spaces
+        8            The file's timestamp as a double precision float
+        8            The size of the file as an unsigned integer
+        ============ ====================================================
+
+        Once all records have been sent, the server closes the connection. As
+        with :ref:`protocol_send`, the transfer takes place in the background
+        and the server must send an OK response as soon as the transfer is
+        queued, with data in the format ``TRANSFER <id>``.
+        """
+        raise NotImplementedError
+
+    @handler('TRANSFERS', int)
+    def do_transfers(self, transfer_id=None):
+        """
+        The :ref:`protocol_transfers` command causes the server to respond with
+        a new-line separated list of the states of recent transfers initiated
+        by the :ref:`protocol_send` and :ref:`protocol_sendall` commands. If
+        *id* is specified, only the state of that transfer is returned. Each
+        line in the data portion of the response has the following format::
+
+            <id>,<state>,<message>
+
+        The :samp:`state` is one of ``QUEUED`` (the transfer is waiting for a
+        free worker), ``SENDING`` (the transfer is in progress), ``DONE`` (the
+        transfer completed successfully), or ``FAILED`` (the transfer failed).
+        In the last case, :samp:`message` describes the error; it is empty
+        otherwise. For example::
+
+            1,DONE,
+            2,FAILED,[Errno 111] Connection refused
+            3,SENDING,
+
+        Servers only need to retain the states of a limited number of recent
+        transfers. If *id* refers to a transfer which is unknown, the server
+        must send an ERROR response.
         """
         raise NotImplementedError
 
@@ -680,14 +1052,14 @@ class CompoundPiProtocol(object):
         new-line separated list detailing all locally stored files. Each line
         in the data portion of the response has the following format::
 
-            <filetype>,<number>,<timestamp>,<size>
+            <filetype>,<number>,<timestamp>,<size>[,<requested>]
 
         For example, if four images and one video are stored on the server the
         data portion of the OK response may look like this::
 
             IMAGE,0,1398618927.307944,8083879
             IMAGE,1,1398619000.53127,7960423
-            IMAGE,2,1398619013.658935,7996156
+            IMAGE,2,1398619013.500215,7996156,1398619013.5
             IMAGE,3,1398619014.122921,8061197
             VIDEO,4,1398619014.314919,28053651
 
@@ -698,19 +1070,40 @@ class CompoundPiProtocol(object):
         for the image which can be used with the :ref:`protocol_send` command
         to retrieve the image data. The :samp:`timestamp` portion is in
         UNIX-time format: a dotted-decimal value of the number of seconds since
-        the UNIX epoch. Finally, the :samp:`size` portion is an integer number
+        the UNIX epoch. The :samp:`size` portion is an integer number
         indicating the number of bytes in the image.
+
+        Finally, the optional :samp:`requested` portion is only present if
+        the file is the first produced by a capture or recording synchronized
+        with the *sync* parameter of :ref:`protocol_capture` or
+        :ref:`protocol_record`, in which case it is the requested sync
+        timestamp (in the same format as :samp:`timestamp`), or of an armed
+        capture, in which case it is the time at which :ref:`protocol_fire`
+        was received. For such files, :samp:`timestamp` is the time at which
+        the camera delivered the first frame of the capture, so the difference
+        between the two indicates how accurately the server kept to the
+        schedule.
         """
         raise NotImplementedError
 
-    @handler('CLEAR')
-    def do_clear(self):
+    @handler('CLEAR', int)
+    def do_clear(self, count=None):
         """
         The :ref:`protocol_clear` command deletes all images from the server's
         local storage.  As noted above in :ref:`protocol_capture`,
         implementations are free to use any storage medium, but the current
         implementation simply uses a list in RAM.
 
+        If *count* is specified, only the first *count* files (in the order
+        reported by :ref:`protocol_list`) are deleted and the remaining files
+        are renumbered from 0. This permits a client to clear the files it has
+        retrieved without losing files stored since they were listed (for
+        example, by a segmented :ref:`protocol_record`).
+
+        If any transfers (see :ref:`protocol_transfers`) are still queued or
+        in progress, the server may wait briefly for them to complete but must
+        send an ERROR response if they do not, leaving the files intact.
+
         An OK response is expected with no data.
         """
         raise NotImplementedError
@@ -43,6 +43,12 @@ import grp
 import time
 import random
 import logging
+try:
+    from time import monotonic
+except ImportError:
+    # Py2 compat
+    monotonic = time.time
+import tempfile
 import threading
 import struct
 import socket
@@ -51,10 +57,16 @@ try:
     import SocketServer as socketserver
 except ImportError:
     import socketserver
-import shutil
+try:
+    # Py2 compat
+    import Queue as queue
+except ImportError:
+    import queue
 import signal
 import warnings
 import inspect
+import itertools
+from collections import OrderedDict
 from functools import wraps
 
 import daemon
@@ -64,7 +76,7 @@ import RPi.GPIO as GPIO
 
 from . import __version__
 from .terminal import TerminalApplication
-from .common import NetworkRepeater
+from .common import NetworkScheduler, NetworkTransmission, target_selected
 from .protocol import CompoundPiProtocol
 from .exc import (
     CompoundPiInvalidClient,
@@ -94,23 +106,49 @@ def group(s):
     except ValueError:
         return grp.getgrnam(s).gr_gid
 
+def size(s):
+    s = s.strip().upper()
+    for suffix, multiplier in (('K', 1024), ('M', 1024 ** 2), ('G', 1024 ** 3)):
+        if s.endswith(suffix):
+            return int(s[:-1]) * multiplier
+    return int(s)
+
 
 class CompoundPiFile(object):
     """
-    Represents a file stored in memory on the Compound Pi Server. The
-    *filetype* attribute is ``IMAGE``, ``VIDEO``, or ``MOTION`` depending on
-    the content of the stream. The *timestamp* attribute is the UNIX epoch
-    timestamp immediately prior to capture/record start. The *stream* attribute
-    contains the file data, and the *size* attribute returns the size of the
-    stream (note: this seeks to the end of the stream).
+    Represents a file stored on the Compound Pi Server. The *filetype*
+    attribute is ``IMAGE``, ``VIDEO``, or ``MOTION`` depending on the content
+    of the stream. The *timestamp* attribute is the UNIX epoch timestamp
+    immediately prior to capture/record start. If the capture/record was
+    synchronized, the *requested* attribute is the UNIX epoch timestamp it was
+    scheduled for (otherwise it is ``None``) and the *timestamp* is updated
+    when the camera delivers the first frame (see
+    :class:`CompoundPiStampedOutput`). The *stream* attribute contains the
+    file data, and the *size* attribute returns the size of the stream.
+
+    Files are initially held in memory. The :meth:`spool` method moves the
+    content of the file to a temporary file in a specified directory, after
+    which the *stream* attribute refers to a read-only file object and the
+    *spooled* attribute is True. The :meth:`send` method transmits the file's
+    content to a connected socket without copying it through Python, and the
+    :meth:`close` method must be called to release the storage associated
+    with the file.
     """
-    def __init__(self, filetype, timestamp=None):
+    def __init__(self, filetype, timestamp=None, requested=None):
         self._filetype = filetype
         if timestamp is None:
             self._timestamp = time.time()
         else:
             self._timestamp = timestamp
+        self._requested = requested
         self._stream = io.BytesIO()
+        self._path = None
+        self._spooled_size = None
+        # _lock is held while the file is sent or spooled; _state_lock is only
+        # held briefly while the file switches between memory and the spool
+        # so that the size can be read while either is in progress
+        self._lock = threading.Lock()
+        self._state_lock = threading.Lock()
 
     @property
     def filetype(self):
@@ -120,13 +158,522 @@ class CompoundPiFile(object):
     def timestamp(self):
         return self._timestamp
 
+    @timestamp.setter
+    def timestamp(self, value):
+        self._timestamp = value
+
+    @property
+    def requested(self):
+        return self._requested
+
     @property
     def stream(self):
+        if self._stream is None:
+            # Spooled files are only opened on demand to avoid holding a file
+            # descriptor open for every file in the spool
+            self._stream = io.open(self._path, 'rb')
         return self._stream
 
+    @property
+    def spooled(self):
+        return self._path is not None
+
+    @property
+    def path(self):
+        return self._path
+
     @property
     def size(self):
-        return self._stream.seek(0, io.SEEK_END)
+        # Seeking to find the size would move the position that spool (and
+        # any writer) relies on, so the size is read from the buffer instead
+        with self._state_lock:
+            if self._path is not None:
+                return self._spooled_size
+            try:
+                buf = self._stream.getbuffer()
+            except AttributeError:
+                # Py2 compat: no BytesIO.getbuffer
+                return len(self._stream.getvalue())
+            try:
+                return buf.nbytes
+            finally:
+                buf.release()
+
+    def spool(self, path, blocking=True):
+        # The lock prevents spooling while a background transfer is sending
+        # the in-memory buffer. When not *blocking*, return False immediately
+        # if the file is busy
+        if not self._lock.acquire(blocking):
+            return False
+        try:
+            if self._stream is None:
+                # The file was closed (or spooled) while waiting for the lock
+                return False
+            assert not self.spooled
+            fd, filename = tempfile.mkstemp(prefix='cpid-', dir=path)
+            try:
+                with io.open(fd, 'wb') as spool_file:
+                    # Write from the buffer rather than reading the stream
+                    # so that the stream's position is irrelevant
+                    try:
+                        buf = self._stream.getbuffer()
+                    except AttributeError:
+                        # Py2 compat: no BytesIO.getbuffer
+                        spool_file.write(self._stream.getvalue())
+                    else:
+                        try:
+                            spool_file.write(buf)
+                        finally:
+                            buf.release()
+                    size = spool_file.tell()
+            except:
+                os.unlink(filename)
+                raise
+            with self._state_lock:
+                self._stream.close()
+                self._stream = None
+                self._path = filename
+                self._spooled_size = size
+            return True
+        finally:
+            self._lock.release()
+
+    def send(self, sock, offset=0, length=None):
+        with self._lock:
+            self._send(sock, offset, length)
+
+    def _send(self, sock, offset, length):
+        if length is None:
+            length = self.size - offset
+        if length <= 0:
+            # Nothing to send; note that sendfile treats a count of 0 as "to
+            # the end of the file"
+            return
+        if self.spooled:
+            with io.open(self._path, 'rb') as source:
+                if hasattr(sock, 'sendfile'):
+                    sock.sendfile(source, offset, length)
+                else:
+                    # Py2 compat: no socket.sendfile
+                    source.seek(offset)
+                    while length > 0:
+                        chunk = source.read(min(length, 65536))
+                        if not chunk:
+                            break
+                        sock.sendall(chunk)
+                        length -= len(chunk)
+        else:
+            try:
+                buf = self._stream.getbuffer()
+            except AttributeError:
+                # Py2 compat: no BytesIO.getbuffer
+                sock.sendall(self._stream.getvalue()[offset:offset + length])
+            else:
+                try:
+                    with buf[offset:offset + length] as view:
+                        sock.sendall(view)
+                finally:
+                    # Release the buffer so the stream can be resized or
+                    # closed later
+                    buf.release()
+
+    def close(self):
+        # Wait for any spool in progress to finish before removing the file
+        with self._lock, self._state_lock:
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
+            if self._path is not None:
+                try:
+                    os.unlink(self._path)
+                except OSError as e:
+                    logging.warning('Unable to remove %s: %s', self._path, e)
+                self._path = None
+
+
+class CompoundPiStampedOutput(object):
+    """
+    Output for the camera which writes to the stream of the
+    :class:`CompoundPiFile` *f*, setting the file's timestamp to the time of
+    the first write. The camera only writes once it has captured the first
+    frame, so this measures when a capture or recording actually started
+    rather than when the server asked for it. If *callback* is specified, it
+    is called with the new timestamp.
+    """
+
+    def __init__(self, f, callback=None):
+        self.file = f
+        self.callback = callback
+        self._stamped = False
+
+    def write(self, data):
+        if not self._stamped:
+            self._stamped = True
+            self.file.timestamp = time.time()
+            if self.callback:
+                self.callback(self.file.timestamp)
+        return self.file.stream.write(data)
+
+    def flush(self):
+        self.file.stream.flush()
+
+
+class CompoundPiFileStore(object):
+    """
+    Stores the files captured by the Compound Pi Server. The store can be
+    treated as a list of :class:`CompoundPiFile` instances which supports
+    :meth:`append`, indexing, iteration, and deletion (``del store[:]`` closes
+    and removes all files).
+
+    If *ram_limit* is non-zero, it specifies the number of bytes of file data
+    that may be held in memory. Whenever a file is appended and the total size
+    of all in-memory files exceeds this limit, the least recently used files
+    are spooled to temporary files in *spool_dir* until the in-memory total
+    fits within the limit once more. Files are "used" when appended or
+    retrieved by index (as the SEND command does).
+
+    The store may be used from several threads (the server, jobs, and
+    transfers). The list of files is protected by a lock, but files are
+    spooled outside it so that spooling doesn't block the server.
+    """
+    def __init__(self, ram_limit=0, spool_dir=None):
+        self.ram_limit = ram_limit
+        self.spool_dir = spool_dir
+        self._files = []
+        self._lru = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._files)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._files))
+
+    def __getitem__(self, index):
+        with self._lock:
+            f = self._files[index]
+            self._touch(f)
+            return f
+
+    def __delitem__(self, index):
+        with self._lock:
+            files = self._files[index]
+            if not isinstance(index, slice):
+                files = [files]
+            del self._files[index]
+            for f in files:
+                self._lru.remove(f)
+        for f in files:
+            f.close()
+
+    @property
+    def ram_size(self):
+        return sum(f.size for f in self if not f.spooled)
+
+    def append(self, f):
+        with self._lock:
+            self._files.append(f)
+            self._lru.append(f)
+        self._evict()
+
+    def _touch(self, f):
+        # Must be called with the lock held
+        self._lru.remove(f)
+        self._lru.append(f)
+
+    def _evict(self):
+        if self.ram_limit:
+            with self._lock:
+                lru = list(self._lru)
+            ram_size = sum(f.size for f in lru if not f.spooled)
+            for f in lru:
+                if ram_size <= self.ram_limit:
+                    break
+                if not f.spooled:
+                    size = f.size
+                    # Files which are being transferred are skipped
+                    if f.spool(self.spool_dir, blocking=False):
+                        logging.info(
+                            'Spooled %d byte %s file to %s',
+                            size, f.filetype, self.spool_dir)
+                        ram_size -= size
+
+
+def send_files(update, address, header, files):
+    """
+    Connects to the TCP *address* and sends the *header* bytes followed by
+    each of the *files*. Each item of *files* is a (prefix, file, offset,
+    length) tuple; the *prefix* bytes are sent, followed by *length* bytes of
+    the :class:`CompoundPiFile` starting at *offset*. The *update* function
+    is called with the proportion of the files sent after each file.
+    """
+    client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        client_sock.connect(address)
+        client_sock.sendall(header)
+        for count, (prefix, f, offset, length) in enumerate(files, start=1):
+            if prefix:
+                client_sock.sendall(prefix)
+            f.send(client_sock, offset, length)
+            update(count / len(files))
+    finally:
+        client_sock.close()
+
+
+class CompoundPiWorkerPool(object):
+    """
+    Runs tasks on a bounded pool of background threads so that the server can
+    continue to respond to commands while they execute.
+
+    Tasks are queued with :meth:`submit` which returns an integer identifier.
+    Each task is a callable which is passed a function that it may call to
+    report its progress (as a float between 0.0 and 1.0), followed by the
+    arguments given to :meth:`submit`. If the task returns a string, it is
+    reported as the message of the completed task. The state of a task (``QUEUED``, the
+    pool's :attr:`running_state`, ``DONE``, or ``FAILED``) and its progress
+    can be queried with :meth:`status`. The states of the most recent
+    *history* tasks are retained. Up to *workers* threads are started as tasks
+    are submitted, and are shut down by :meth:`close`.
+    """
+    running_state = 'RUNNING'
+    task_name = 'task'
+
+    def __init__(self, workers=1, history=100):
+        self.workers = workers
+        self.history = history
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._ids = itertools.count(1)
+        self._tasks = OrderedDict()
+        self._threads = []
+
+    def close(self, wait=True):
+        for thread in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def _pending(self):
+        # Must be called with the lock held. Running tasks which have reported
+        # full progress are only finishing up (e.g. a transfer closing its
+        # connection after sending everything) so aren't counted
+        return [
+            task_id
+            for task_id, (state, progress, message) in self._tasks.items()
+            if state == 'QUEUED'
+            or (state == self.running_state and progress < 1.0)
+            ]
+
+    @property
+    def pending(self):
+        with self._lock:
+            return len(self._pending())
+
+    def wait(self, timeout):
+        """
+        Wait up to *timeout* seconds for all pending tasks to complete (a
+        *timeout* of 0 checks without blocking). Returns True if no tasks are
+        pending, or False otherwise.
+        """
+        deadline = time.time() + timeout
+        with self._idle:
+            while True:
+                pending = self._pending()
+                remaining = deadline - time.time()
+                if not pending or remaining <= 0:
+                    return not pending
+                self._idle.wait(remaining)
+
+    def submit(self, fn, *args):
+        with self._lock:
+            task_id = next(self._ids)
+            self._tasks[task_id] = ('QUEUED', 0.0, '')
+            # Forget the oldest finished tasks beyond the history limit
+            for old_id, (state, progress, message) in list(self._tasks.items()):
+                if len(self._tasks) <= self.history:
+                    break
+                if state in ('DONE', 'FAILED'):
+                    del self._tasks[old_id]
+        self._queue.put((task_id, fn, args))
+        if len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return task_id
+
+    def status(self, task_id=None):
+        """
+        Returns a list of (id, state, progress, message) tuples for all
+        retained tasks, or just the one specified by *task_id*.
+        """
+        with self._lock:
+            if task_id is None:
+                return [
+                    (task_id, state, progress, message)
+                    for task_id, (state, progress, message) in self._tasks.items()
+                    ]
+            try:
+                state, progress, message = self._tasks[task_id]
+            except KeyError:
+                raise ValueError('Unknown %s %d' % (self.task_name, task_id))
+            return [(task_id, state, progress, message)]
+
+    def _set_state(self, task_id, state, progress, message=''):
+        with self._idle:
+            self._tasks[task_id] = (state, progress, message)
+            self._idle.notify_all()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            task_id, fn, args = item
+            def update(progress):
+                self._set_state(task_id, self.running_state, progress)
+            update(0.0)
+            try:
+                message = fn(update, *args)
+            except Exception as e:
+                logging.warning(
+                    '%s %d failed: %s', self.task_name.capitalize(), task_id, e)
+                self._set_state(
+                    task_id, 'FAILED', self._tasks[task_id][1], str(e))
+            else:
+                logging.info(
+                    '%s %d complete', self.task_name.capitalize(), task_id)
+                self._set_state(task_id, 'DONE', 1.0, message or '')
+
+
+class CompoundPiTransferPool(CompoundPiWorkerPool):
+    """
+    Runs file transfers on a bounded pool of background threads. Running
+    transfers are in the ``SENDING`` state.
+    """
+    running_state = 'SENDING'
+    task_name = 'transfer'
+
+    def __init__(self, workers=2, history=100):
+        super(CompoundPiTransferPool, self).__init__(workers, history)
+
+
+class CompoundPiJobQueue(CompoundPiWorkerPool):
+    """
+    Runs camera jobs (captures and recordings) in the background. A single
+    thread is used so that jobs execute in the order they were submitted and
+    never compete for the camera.
+    """
+    task_name = 'job'
+
+    def __init__(self, history=100):
+        super(CompoundPiJobQueue, self).__init__(1, history)
+
+
+class CompoundPiSaveQueue(CompoundPiWorkerPool):
+    """
+    Saves video triggered from the buffer in the background. This is kept
+    apart from the job queue so that saves don't wait behind camera jobs while
+    the buffer is overwritten, and apart from the transfer pool so that saves
+    neither appear as transfers nor hold up the CLEAR command.
+    """
+    task_name = 'save'
+
+    def __init__(self, history=100):
+        super(CompoundPiSaveQueue, self).__init__(1, history)
+
+
+class CompoundPiResponseCache(object):
+    """
+    Bounded cache of recently sent responses.
+
+    Keys are (address, seqno, request) tuples and values are the encoded
+    responses sent for them. Entries are discarded when more than *age*
+    seconds old, or when more than *count* entries are stored (the oldest are
+    discarded first). This permits the server to answer a retransmitted
+    command by replaying its response instead of executing it again.
+    """
+
+    def __init__(self, count=100, age=30):
+        self.count = count
+        self.age = age
+        self._entries = OrderedDict()
+
+    def _expire(self):
+        limit = time.time() - self.age
+        while self._entries:
+            key, (timestamp, response) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.count and timestamp > limit:
+                break
+            del self._entries[key]
+
+    def __len__(self):
+        self._expire()
+        return len(self._entries)
+
+    def __contains__(self, key):
+        self._expire()
+        return key in self._entries
+
+    def __getitem__(self, key):
+        self._expire()
+        return self._entries[key][1]
+
+    def __setitem__(self, key, response):
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time(), response)
+        self._expire()
+
+    def clear(self):
+        self._entries.clear()
+
+
+class CompoundPiArmedCapture(object):
+    """
+    Coordinates an armed capture between the job thread and the server.
+
+    The job thread calls :meth:`wait` once the camera is prepared; this
+    marks the capture as ready and blocks until :meth:`fire` (or
+    :meth:`cancel`) is called by the server. The server passes the time at
+    which the FIRE command arrived to :meth:`fire`, and does not wait for the
+    capture. When the camera delivers the first image, the job thread calls
+    :meth:`captured` which records the delay since the command arrived.
+    The *job_id* attribute is the identifier of the job running the capture.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.job_id = None
+        self.fired_at = None
+        self.delay = None
+        self.cancelled = False
+        self._ready = threading.Event()
+        self._fired = threading.Event()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def wait(self):
+        self._ready.set()
+        self._fired.wait()
+        return not self.cancelled
+
+    def fire(self, fired_at):
+        self.fired_at = fired_at
+        self._fired.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self._fired.set()
+
+    def captured(self, started):
+        self.delay = started - self.fired_at
 
 
 class CompoundPiUDPServer(socketserver.UDPServer):
@@ -176,6 +723,19 @@ class CompoundPiServer(TerminalApplication):
             '--pidfile', metavar='FILE', default='/var/run/cpid.pid',
             help='specifies the location of the pid lock file '
             '(default: %(default)s)')
+        self.parser.add_argument(
+            '--ram-limit', type=size, default='0', metavar='BYTES',
+            help='specifies the amount of RAM that captured files may occupy '
+            'before the least recently used are spooled to disk. Suffixes K, '
+            'M, and G may be used. 0 means no limit (default: %(default)s)')
+        self.parser.add_argument(
+            '--spool-dir', metavar='PATH', default='/var/tmp',
+            help='specifies the directory that files will be spooled to when '
+            'the RAM limit is exceeded (default: %(default)s)')
+        self.parser.add_argument(
+            '--transfer-threads', type=int, default='2', metavar='NUM',
+            help='specifies the number of background threads used to send '
+            'files to clients (default: %(default)s)')
 
     def main(self, args):
         warnings.showwarning = self.showwarning
@@ -223,6 +783,10 @@ class CompoundPiServer(TerminalApplication):
             args.bind, args.port, 0, socket.SOCK_DGRAM)[0][-1]
         logging.info('Listening on %s:%d', address[0], address[1])
         self.server = CompoundPiUDPServer(address, CompoundPiServerProtocol)
+        self.server.files = CompoundPiFileStore(args.ram_limit, args.spool_dir)
+        self.server.transfers = CompoundPiTransferPool(args.transfer_threads)
+        self.server.jobs = CompoundPiJobQueue()
+        self.server.saves = CompoundPiSaveQueue()
         # Test GPIO before entering the daemon context (GPIO access usually
         # requires root privileges for access to /dev/mem - better to bomb out
         # earlier than later)
@@ -234,11 +798,15 @@ class CompoundPiServer(TerminalApplication):
         random.seed()
         logging.info('Initializing camera')
         self.server.seqno = 0
+        self.server.skipped = set()
         self.server.client_address = None
         self.server.client_timestamp = None
-        self.server.responders = {}
-        self.server.files = []
+        self.server.responders = NetworkScheduler()
+        self.server.responses = CompoundPiResponseCache()
         self.server.camera = picamera.PiCamera()
+        self.server.buffer = None
+        self.server.buffer_length = 0.0
+        self.server.armed = None
         try:
             logging.info('Starting server thread')
             thread = threading.Thread(target=self.server.serve_forever)
@@ -247,8 +815,25 @@ class CompoundPiServer(TerminalApplication):
                 thread.join(1)
             logging.info('Server thread ended')
         finally:
+            logging.info('Stopping response scheduler')
+            self.server.responders.close()
+            logging.info(
+                'Responses: %d retransmits, %d acknowledged, %d expired',
+                self.server.responders.retransmits,
+                self.server.responders.acked,
+                self.server.responders.expired)
+            logging.info('Stopping job and transfer threads')
+            # Don't wait for the current job; it may be a lengthy recording
+            # which will be aborted when the camera is closed
+            if self.server.armed is not None:
+                self.server.armed.cancel()
+            self.server.jobs.close(wait=False)
+            self.server.saves.close()
+            self.server.transfers.close()
             logging.info('Closing camera')
             self.server.camera.close()
+            logging.info('Removing stored files')
+            del self.server.files[:]
 
     def showwarning(self, message, category, filename, lineno, file=None,
             line=None):
@@ -302,6 +887,8 @@ def server(protocol):
         cls.handlers = handlers
         cls.request_re = protocol.request_re
         cls.response_re = protocol.response_re
+        cls.max_datagram = protocol.max_datagram
+        cls.window = protocol.window
         return cls
 
     return class_decorator
@@ -309,60 +896,160 @@ def server(protocol):
 
 @server(CompoundPiProtocol)
 class CompoundPiServerProtocol(socketserver.DatagramRequestHandler):
+    # Synchronized captures sleep until this many seconds before the sync time
+    # then spin for the remainder as sleep can overshoot by several ms
+    sync_spin = 0.005
+
     def handle(self):
+        # Note the arrival time as early as possible for TIME
+        self.received = time.time()
         data = self.rfile.read().decode('utf-8').strip()
         logging.debug(
                 '%s:%d Rx %r',
                 self.client_address[0], self.client_address[1], data)
         seqno = 0
+        key = None
         try:
             match = self.request_re.match(data)
             if not match:
                 raise ValueError('Unable to parse request')
             seqno = int(match.group('seqno'))
             command = match.group('command')
+            # Silently ignore broadcast commands targetted at other servers
+            targets = match.group('targets')
+            if targets and not target_selected(targets, self.local_address()):
+                logging.debug('Ignoring command for other servers')
+                return
             # Implement special handling for ACK and HELLO. ACK sends no
             # response and has no handler. HELLO doesn't check the sequence
             # number and can come from a new client
             if command == 'ACK':
-                self.ack_response(seqno)
+                fragment = match.group('fragment')
+                self.ack_response(
+                    seqno, None if fragment is None else int(fragment))
                 return
             if command != 'HELLO':
+                # If this is a retransmission of a command we've already
+                # answered (because our response was lost), replay the
+                # response rather than executing the command again. TIME is
+                # the exception: a replayed response would carry stale
+                # timestamps, and as it changes nothing it is simply
+                # executed again
+                if command != 'TIME':
+                    key = (self.client_address, seqno, data)
+                    if key in self.server.responses:
+                        self.replay_response(key)
+                        return
                 if self.client_address != self.server.client_address:
                     raise CompoundPiInvalidClient(self.client_address[0])
-                elif seqno <= self.server.seqno:
+                elif (
+                        command != 'TIME' and
+                        seqno <= self.server.seqno and
+                        seqno not in self.server.skipped):
                     raise CompoundPiStaleSequence(self.client_address[0], seqno)
             if match.group('params'):
                 params = (p.strip() for p in match.group('params').split(','))
             else:
                 params = ()
             response = self.dispatch(command, *params)
-            self.server.seqno = seqno
+            self.executed(seqno, command == 'HELLO')
             if not response:
                 response = ''
-            self.send_response(seqno, 'OK\n%s' % response)
+            self.send_response(seqno, 'OK\n%s' % response, key)
         except Exception as e:
             # Otherwise, send an ERROR response. Note: we use the client's
             # sequence number here in case it's stale (otherwise the client
             # will ignore the response or associate it with the wrong call)
             logging.error(str(e))
-            self.send_response(seqno, 'ERROR\n%s' % e)
+            self.send_response(seqno, 'ERROR\n%s' % e, key)
+
+    def executed(self, seqno, reset=False):
+        # Rather than remembering every sequence number executed in the
+        # window, track the high-water mark and the (usually few) sequence
+        # numbers below it that haven't been executed yet; these may still
+        # arrive if the client has several commands outstanding
+        if reset:
+            self.server.skipped.clear()
+        elif seqno > self.server.seqno:
+            self.server.skipped.update(range(
+                max(self.server.seqno + 1, seqno - self.window), seqno))
+        else:
+            self.server.skipped.discard(seqno)
+        if reset or seqno > self.server.seqno:
+            self.server.seqno = seqno
+            self.server.skipped.difference_update([
+                s for s in self.server.skipped if s <= seqno - self.window])
 
-    def send_response(self, seqno, data):
-        data = '%d %s' % (seqno, data)
-        assert self.response_re.match(data)
+    def local_address(self):
+        # Determine our address on the interface that routes to the client.
+        # Connecting a UDP socket sends nothing; it just selects the route
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect(self.client_address)
+            return sock.getsockname()[0]
+        finally:
+            sock.close()
+
+    def send_response(self, seqno, data, key=None):
         logging.debug(
                 '%s:%d Tx %r',
-                self.client_address[0], self.client_address[1], data)
-        data = data.encode('utf-8')
-        self.server.responders[(self.client_address, seqno)] = NetworkRepeater(
-                self.socket, self.client_address, data)
-
-    def ack_response(self, seqno):
-        responder = self.server.responders.pop((self.client_address, seqno), None)
+                self.client_address[0], self.client_address[1],
+                '%d %s' % (seqno, data))
+        datagrams = self.fragment_response(seqno, data)
+        for fragment, datagram in datagrams:
+            if fragment is None:
+                responder_key = (self.client_address, seqno)
+            else:
+                responder_key = (self.client_address, seqno, fragment)
+            self.server.responders[responder_key] = NetworkTransmission(
+                    self.socket, self.client_address, datagram)
+        if key:
+            self.server.responses[key] = [
+                datagram for fragment, datagram in datagrams]
+
+    def fragment_response(self, seqno, data):
+        # Returns a list of (fragment, datagram) tuples. If the response fits
+        # in a single datagram it is sent unfragmented (with a fragment of
+        # None). Otherwise the response data is split into chunks small enough
+        # to leave room for the fragment header
+        message = ('%d %s' % (seqno, data)).encode('utf-8')
+        assert self.response_re.match(message.decode('utf-8'))
+        if len(message) <= self.max_datagram:
+            return [(None, message)]
+        result, _, body = data.partition('\n')
+        body = bytearray(body.encode('utf-8'))
+        size = self.max_datagram - 64
+        chunks = []
+        start = 0
+        while start < len(body):
+            end = min(start + size, len(body))
+            # Don't split multi-byte UTF-8 sequences across fragments
+            while end < len(body) and body[end] & 0xC0 == 0x80:
+                end -= 1
+            chunks.append(bytes(body[start:end]))
+            start = end
+        return [
+            (fragment, (
+                '%d.%d/%d %s\n' % (seqno, fragment, len(chunks), result)
+                ).encode('utf-8') + chunk)
+            for fragment, chunk in enumerate(chunks)
+            ]
+
+    def replay_response(self, key):
+        for datagram in self.server.responses[key]:
+            logging.debug(
+                    '%s:%d Tx %r (replay)',
+                    self.client_address[0], self.client_address[1], datagram)
+            self.socket.sendto(datagram, self.client_address)
+
+    def ack_response(self, seqno, fragment=None):
+        if fragment is None:
+            key = (self.client_address, seqno)
+        else:
+            key = (self.client_address, seqno, fragment)
+        responder = self.server.responders.pop(key, None)
         if responder:
             responder.terminate = True
-            responder.join()
 
     def dispatch(self, command, *params):
         # Look up the handler in self.handlers (this dict is defined by the
@@ -386,6 +1073,9 @@ class CompoundPiServerProtocol(socketserver.DatagramRequestHandler):
                 raise CompoundPiStaleClientTime(self.client_address[0], timestamp)
         self.server.client_address = self.client_address
         self.server.client_timestamp = timestamp
+        # Sequence numbers from a new client session must not match responses
+        # to the previous one
+        self.server.responses.clear()
         return 'VERSION %s' % __version__
 
     def blink_led(self, timeout):
@@ -410,6 +1100,9 @@ class CompoundPiServerProtocol(socketserver.DatagramRequestHandler):
         thread.daemon = True
         thread.start()
 
+    def do_time(self):
+        return '%f,%f' % (self.received, time.time())
+
     def do_status(self):
         return (
             'RESOLUTION {width},{height}\n'
@@ -514,26 +1207,131 @@ class CompoundPiServerProtocol(socketserver.DatagramRequestHandler):
         logging.info('Changing camera vertical flip to %s', vertical)
         self.server.camera.vflip = vertical
 
-    def image_stream_generator(self, count):
+    def do_configure(
+            self, width=None, height=None, framerate=None, awb_mode=None,
+            awb_red=None, awb_blue=None, agc_mode=None, exposure_mode=None,
+            exposure_speed=None, iso=None, metering_mode=None,
+            brightness=None, contrast=None, saturation=None, ev=None,
+            hflip=None, vflip=None, denoise=None):
+        # Validate what we can before touching the camera so that a bad
+        # command doesn't leave it half-configured
+        if (width is None) != (height is None):
+            raise ValueError('Width and height must be specified together')
+        if (awb_red is None) != (awb_blue is None):
+            raise ValueError('Red and blue gains must be specified together')
+        if (hflip is None) != (vflip is None):
+            raise ValueError('Horizontal and vertical flip must be specified together')
+        camera = self.server.camera
+        # Let the gains float while the camera is (potentially) reset
+        if agc_mode is not None and agc_mode != 'off':
+            logging.info('Changing camera AGC mode to %s', agc_mode)
+            camera.exposure_mode = agc_mode
+        # Changing the resolution or framerate resets the camera so only do
+        # so when they actually change
+        if width is not None and (width, height) != tuple(camera.resolution):
+            logging.info('Changing camera resolution to %dx%d', width, height)
+            camera.resolution = (width, height)
+        if framerate is not None and framerate != camera.framerate:
+            logging.info('Changing camera framerate to %.2ffps', framerate)
+            camera.framerate = framerate
+        if awb_mode is not None:
+            logging.info('Changing camera AWB mode to %s', awb_mode)
+            camera.awb_mode = awb_mode
+        if awb_red is not None:
+            logging.info(
+                'Changing camera AWB gains to %.2f, %.2f', awb_red, awb_blue)
+            camera.awb_gains = (awb_red, awb_blue)
+        if exposure_mode == 'auto':
+            logging.info('Changing camera exposure speed mode to auto')
+            camera.shutter_speed = 0
+        elif exposure_mode is not None or exposure_speed is not None:
+            if exposure_speed is None:
+                speed = camera.exposure_speed
+            else:
+                speed = int(exposure_speed * 1000)
+            logging.info(
+                'Changing camera exposure speed to %.4fms', speed / 1000.0)
+            camera.shutter_speed = speed
+        if iso is not None:
+            logging.info('Changing camera ISO to %d', iso)
+            camera.iso = iso
+        if metering_mode is not None:
+            logging.info('Changing camera metering mode to %s', metering_mode)
+            camera.meter_mode = metering_mode
+        if brightness is not None:
+            logging.info('Changing camera brightness to %d', brightness)
+            camera.brightness = brightness
+        if contrast is not None:
+            logging.info('Changing camera contrast to %d', contrast)
+            camera.contrast = contrast
+        if saturation is not None:
+            logging.info('Changing camera saturation to %d', saturation)
+            camera.saturation = saturation
+        if ev is not None:
+            logging.info('Changing camera EV to %d', ev)
+            camera.exposure_compensation = ev
+        if hflip is not None:
+            logging.info(
+                'Changing camera flip to %s, %s', hflip, vflip)
+            camera.hflip = hflip
+            camera.vflip = vflip
+        if denoise is not None:
+            logging.info('Changing camera denoise to %s', denoise)
+            camera.image_denoise = denoise
+            camera.video_denoise = denoise
+        # Fix the gains last so they reflect all the settings above
+        if agc_mode == 'off':
+            logging.info('Changing camera AGC mode to off')
+            camera.exposure_mode = agc_mode
+
+    def image_stream_generator(self, count, update=None, requested=None):
         for i in range(count):
-            f = CompoundPiFile('IMAGE')
-            yield f.stream
+            if i == 0 and requested is not None:
+                f = CompoundPiFile('IMAGE', requested=requested)
+                yield CompoundPiStampedOutput(f)
+            else:
+                f = CompoundPiFile('IMAGE')
+                yield f.stream
             self.server.files.append(f)
+            if update:
+                update((i + 1) / count)
 
     def wait_until(self, sync):
-        if sync is not None:
-            delay = sync - time.time()
-            if delay <= 0.0:
-                raise ValueError('Sync time in past')
-            time.sleep(delay)
+        # The deadline is measured against the monotonic clock so that
+        # adjustments to the system clock during the wait don't move it. The
+        # time the capture actually starts is measured by the output (see
+        # CompoundPiStampedOutput), not here
+        if sync is None:
+            return
+        delay = sync - time.time()
+        if delay <= 0.0:
+            raise ValueError('Sync time in past')
+        deadline = monotonic() + delay
+        if delay > self.sync_spin:
+            time.sleep(delay - self.sync_spin)
+        while monotonic() < deadline:
+            pass
+
+    def check_sync(self, sync):
+        if sync is not None and sync <= time.time():
+            raise ValueError('Sync time in past')
 
     def do_capture(self, count=1, use_video_port=False, quality=85, sync=None):
+        # Validate what we can before queueing the job so errors are reported
+        # in the response
+        self.check_sync(sync)
+        job_id = self.server.jobs.submit(
+            self.capture_job, count, use_video_port, quality, sync)
+        logging.info('Queued capture job %d', job_id)
+        return 'JOB %d' % job_id
+
+    def capture_job(self, update, count, use_video_port, quality, sync):
         self.server.camera.led = False
         try:
             self.wait_until(sync)
             self.server.camera.capture_sequence(
-                self.image_stream_generator(count), format='jpeg',
-                quality=quality, use_video_port=use_video_port,
+                self.image_stream_generator(count, update, sync),
+                format='jpeg', quality=quality, use_video_port=use_video_port,
                 burst=not use_video_port)
             logging.info(
                     'Captured %d images from %s port',
@@ -541,58 +1339,336 @@ class CompoundPiServerProtocol(socketserver.DatagramRequestHandler):
         finally:
             self.server.camera.led = True
 
+    def do_arm(self, count=1, use_video_port=False, quality=85):
+        if count < 0:
+            raise ValueError('Invalid capture count %d' % count)
+        if count == 0:
+            if self.server.armed is not None:
+                self.server.armed.cancel()
+                self.server.armed = None
+                logging.info('Disarmed capture')
+            return
+        if self.server.armed is not None:
+            raise ValueError('Capture already armed')
+        armed = CompoundPiArmedCapture(count)
+        self.server.armed = armed
+        job_id = self.server.jobs.submit(
+            self.arm_job, armed, use_video_port, quality)
+        armed.job_id = job_id
+        logging.info('Queued armed capture job %d', job_id)
+        return 'JOB %d' % job_id
+
+    def armed_stream_generator(self, armed, update):
+        if not armed.wait():
+            return
+        for i in range(armed.count):
+            if i == 0:
+                # The first file records when FIRE arrived as its requested
+                # time, so the delay is also visible in LIST
+                f = CompoundPiFile('IMAGE', requested=armed.fired_at)
+                yield CompoundPiStampedOutput(f, armed.captured)
+            else:
+                f = CompoundPiFile('IMAGE')
+                yield f.stream
+            self.server.files.append(f)
+            update((i + 1) / armed.count)
+
+    def arm_job(self, update, armed, use_video_port, quality):
+        camera = self.server.camera
+        # Fix the gains so that FIRE doesn't wait for them to settle; the
+        # prior settings are restored afterward
+        exposure_mode = camera.exposure_mode
+        shutter_speed = camera.shutter_speed
+        awb_mode = camera.awb_mode
+        camera.shutter_speed = camera.exposure_speed
+        camera.exposure_mode = 'off'
+        awb_gains = camera.awb_gains
+        camera.awb_mode = 'off'
+        camera.awb_gains = awb_gains
+        camera.led = False
+        try:
+            # capture_sequence prepares the port and encoder before asking
+            # the generator for the first output, which blocks until FIRE
+            camera.capture_sequence(
+                self.armed_stream_generator(armed, update), format='jpeg',
+                quality=quality, use_video_port=use_video_port,
+                burst=not use_video_port)
+            if armed.cancelled:
+                logging.info('Armed capture cancelled')
+                return
+            logging.info(
+                'Captured %d armed images from %s port, %.4fs after fire',
+                armed.count, 'video' if use_video_port else 'still',
+                armed.delay)
+            # The delay is reported as the job's message
+            return 'DELAY %f' % armed.delay
+        finally:
+            camera.led = True
+            camera.awb_mode = awb_mode
+            camera.shutter_speed = shutter_speed
+            camera.exposure_mode = exposure_mode
+            if self.server.armed is armed:
+                self.server.armed = None
+
+    def do_fire(self):
+        armed = self.server.armed
+        if armed is None or not armed.ready:
+            raise ValueError('Capture not armed')
+        # Respond immediately rather than blocking the server until the
+        # capture is taken; the delay from the command's arrival to the
+        # capture is reported by the job's status
+        armed.fire(self.received)
+        return 'JOB %d' % armed.job_id
+
     def do_record(self, length, format='h264', quality=0, bitrate=17000000,
-            intra_period=None, motion_output=False, sync=None):
+            intra_period=None, motion_output=False, sync=None, segment=None):
+        if motion_output and format != 'h264':
+            raise ValueError('Format must be h264 for motion output')
+        if segment is not None:
+            if format != 'h264':
+                raise ValueError('Format must be h264 for segmented recording')
+            if segment <= 0:
+                raise ValueError('Invalid segment length %.1f' % segment)
+        self.check_sync(sync)
+        job_id = self.server.jobs.submit(
+            self.record_job, length, format, quality, bitrate, intra_period,
+            motion_output, sync, segment)
+        logging.info('Queued record job %d', job_id)
+        return 'JOB %d' % job_id
+
+    def record_files(self, motion_output, requested=None):
+        # Ensure video and motion streams have equivalent timestamps
+        video_file = CompoundPiFile('VIDEO', requested=requested)
+        if motion_output:
+            motion_file = CompoundPiFile(
+                'MOTION', video_file.timestamp, requested)
+        else:
+            motion_file = None
+        return video_file, motion_file
+
+    def store_files(self, video_file, motion_file):
+        if motion_file:
+            # The video's timestamp may have been updated by its output
+            motion_file.timestamp = video_file.timestamp
+        for f in (video_file, motion_file):
+            if f:
+                self.server.files.append(f)
+
+    def record_job(self, update, length, format, quality, bitrate,
+            intra_period, motion_output, sync, segment):
         self.server.camera.led = False
         try:
-            # Ensure video and motion streams have equivalent timestamps
-            video_file = CompoundPiFile('VIDEO')
-            if motion_output:
-                if format != 'h264':
-                    raise ValueError('Format must be h264 for motion output')
-                motion_file = CompoundPiFile('MOTION', video_file.timestamp)
-            else:
-                motion_file = None
             self.wait_until(sync)
+            video_file, motion_file = self.record_files(motion_output, sync)
             self.server.camera.start_recording(
-                    video_file.stream, format=format, quality=quality,
+                    CompoundPiStampedOutput(video_file)
+                    if sync is not None else video_file.stream,
+                    format=format, quality=quality,
                     bitrate=bitrate, intra_period=intra_period,
                     motion_output=motion_file.stream if motion_file else None)
-            self.server.camera.wait_recording(length)
-            self.server.camera.stop_recording()
-            self.server.files.append(video_file)
-            if motion_file:
-                self.server.files.append(motion_file)
+            try:
+                # Wait in short steps so that progress can be reported, and
+                # so that segments are split on time
+                elapsed = 0.0
+                split = min(segment or length, length)
+                while elapsed < length:
+                    step = min(1.0, split - elapsed)
+                    self.server.camera.wait_recording(step)
+                    if step == split - elapsed:
+                        elapsed = split
+                    else:
+                        elapsed += step
+                    if elapsed == split and elapsed < length:
+                        # The camera switches outputs at the next keyframe;
+                        # the completed segment can be listed and retrieved
+                        # while the recording continues
+                        next_video, next_motion = self.record_files(
+                            motion_output)
+                        self.server.camera.split_recording(
+                            next_video.stream,
+                            motion_output=next_motion.stream
+                            if next_motion else None)
+                        self.store_files(video_file, motion_file)
+                        video_file, motion_file = next_video, next_motion
+                        split = min(split + segment, length)
+                    update(elapsed / length)
+            finally:
+                self.server.camera.stop_recording()
+            self.store_files(video_file, motion_file)
             logging.info(
                 'Recorded %.1f seconds of %s video%s', length, format,
                 ' with motion' if motion_output else '')
         finally:
             self.server.camera.led = True
 
-    def do_send(self, file_num, port):
+    def do_buffer(self, length, quality=0, bitrate=17000000,
+            intra_period=None):
+        if length < 0:
+            raise ValueError('Invalid buffer length %.1f' % length)
+        camera = self.server.camera
+        if self.server.buffer is not None:
+            # The buffer records on its own splitter port so that it can run
+            # alongside the capture and record jobs
+            camera.stop_recording(splitter_port=2)
+            self.server.buffer = None
+            self.server.buffer_length = 0.0
+            logging.info('Stopped buffering')
+        if length > 0:
+            buf = picamera.PiCameraCircularIO(
+                camera, seconds=length, bitrate=bitrate, splitter_port=2)
+            camera.start_recording(
+                buf, format='h264', quality=quality, bitrate=bitrate,
+                intra_period=intra_period, splitter_port=2)
+            self.server.buffer = buf
+            self.server.buffer_length = length
+            logging.info('Buffering last %.1f seconds of video', length)
+
+    def do_trigger(self, length=None):
+        if self.server.buffer is None:
+            raise ValueError('Not buffering')
+        if length is None:
+            length = self.server.buffer_length
+        elif not 0 < length <= self.server.buffer_length:
+            raise ValueError('Invalid trigger length %.1f' % length)
+        # Note the last frame buffered when the command arrived so the saved
+        # video ends there, however long the copy waits for a worker. The copy
+        # runs on its own queue to avoid blocking the server (see
+        # CompoundPiSaveQueue)
+        buf = self.server.buffer
+        with buf.lock:
+            last = None
+            for last in buf.frames:
+                pass
+        if last is None:
+            raise ValueError('Buffer is empty')
+        save_id = self.server.saves.submit(
+            self.trigger_job, buf, last.index, length, self.received)
+        logging.info(
+            'Queued save %d of last %.1f seconds of buffered video',
+            save_id, length)
+
+    def trigger_job(self, update, buf, last_index, length, triggered):
+        with buf.lock:
+            frames = [frame for frame in buf.frames if frame.index <= last_index]
+            # Header frames have no timestamp; they take the timestamp of the
+            # frame that follows them
+            timestamps = []
+            timestamp = None
+            for frame in reversed(frames):
+                if frame.timestamp is not None:
+                    timestamp = frame.timestamp
+                timestamps.append(timestamp)
+            timestamps.reverse()
+            end = timestamps[-1] if timestamps else None
+            for frame, timestamp in zip(frames, timestamps):
+                # Start at the earliest keyframe header within length seconds
+                # of the trigger
+                if (
+                        frame.frame_type == picamera.PiVideoFrameType.sps_header
+                        and timestamp is not None
+                        and end - timestamp <= length * 1000000):
+                    start = frame
+                    break
+            else:
+                raise ValueError(
+                    'No buffered keyframe in the last %.1f seconds' % length)
+            # Frame timestamps are in microseconds from the camera's clock;
+            # the clip starts that long before the command arrived
+            f = CompoundPiFile('VIDEO', triggered - (end - timestamp) / 1000000)
+            # The encoder writes to the buffer at its current position, so
+            # that must be restored after copying the frames out
+            pos = buf.tell()
+            try:
+                buf.seek(start.position)
+                f.stream.write(buf.read(
+                    frames[-1].position + frames[-1].frame_size -
+                    start.position))
+            finally:
+                buf.seek(pos)
+        self.server.files.append(f)
+        logging.info(
+            'Saved %.1f seconds of buffered video',
+            (end - timestamp) / 1000000)
+
+    def do_send(self, file_num, port, offset=0, length=None):
         f = self.server.files[file_num]
-        logging.info('Sending file %d', file_num)
-        client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_sock.connect((self.client_address[0], port))
-        client_file = client_sock.makefile('wb')
-        try:
-            client_file.write(struct.pack(native_str('>L'), f.size))
-            client_file.flush()
-            f.stream.seek(0)
-            shutil.copyfileobj(f.stream, client_file)
-        finally:
-            client_file.close()
-            client_sock.close()
+        size = f.size
+        if not 0 <= offset <= size:
+            raise ValueError('Invalid offset %d for file %d' % (offset, file_num))
+        if length is None or length > size - offset:
+            length = size - offset
+        elif length < 0:
+            raise ValueError('Invalid length %d' % length)
+        transfer_id = self.server.transfers.submit(
+            send_files, (self.client_address[0], port),
+            struct.pack(native_str('>Q'), length),
+            [(b'', f, offset, length)])
+        logging.info(
+            'Queued transfer %d of file %d (%d bytes from offset %d)',
+            transfer_id, file_num, length, offset)
+        return 'TRANSFER %d' % transfer_id
+
+    def do_sendall(self, port, start=0, count=None):
+        if not 0 <= start <= len(self.server.files):
+            raise ValueError('Invalid start %d' % start)
+        if count is None or count > len(self.server.files) - start:
+            count = len(self.server.files) - start
+        elif count < 0:
+            raise ValueError('Invalid count %d' % count)
+        files = []
+        for index in range(start, start + count):
+            f = self.server.files[index]
+            size = f.size
+            files.append((
+                struct.pack(
+                    native_str('>L8sdQ'), index,
+                    f.filetype.ljust(8).encode('ascii'), f.timestamp, size),
+                f, 0, size))
+        total = sum(length for prefix, f, offset, length in files)
+        transfer_id = self.server.transfers.submit(
+            send_files, (self.client_address[0], port),
+            struct.pack(native_str('>LQ'), count, total), files)
+        logging.info(
+            'Queued transfer %d of %d files (%d bytes) from index %d',
+            transfer_id, count, total, start)
+        return 'TRANSFER %d' % transfer_id
+
+    def do_transfers(self, transfer_id=None):
+        return '\n'.join(
+            '%d,%s,%s' % (transfer_id, state, message)
+            for (transfer_id, state, progress, message) in
+            self.server.transfers.status(transfer_id)
+            )
+
+    def do_jobs(self, job_id=None):
+        return '\n'.join(
+            '%d,%s,%.3f,%s' % (job_id, state, progress, message)
+            for (job_id, state, progress, message) in
+            self.server.jobs.status(job_id)
+            )
 
     def do_list(self):
         return '\n'.join(
-            '%s,%d,%f,%d' % (f.filetype, index, f.timestamp, f.size)
+            '%s,%d,%f,%d%s' % (
+                f.filetype, index, f.timestamp, f.size,
+                '' if f.requested is None else ',%f' % f.requested)
             for index, f in enumerate(self.server.files)
             )
 
-    def do_clear(self):
-        logging.info('Clearing files')
-        del self.server.files[:]
+    def do_clear(self, count=None):
+        if count is not None and count < 0:
+            raise ValueError('Invalid file count %d' % count)
+        # Refuse to remove files that are still being sent; this mustn't
+        # block as it would stall every other command
+        if not self.server.transfers.wait(0):
+            raise ValueError(
+                'Cannot clear files with %d transfers pending' %
+                self.server.transfers.pending)
+        if count is None:
+            logging.info('Clearing files')
+        else:
+            logging.info('Clearing first %d files', count)
+        del self.server.files[:count]
 
 
 main = CompoundPiServer()
@@ -37,6 +37,7 @@ import netifaces
 
 from . import get_icon, get_ui_file
 from ..client import CompoundPiClient
+from ..exc import CompoundPiTransactionFailed
 from ..qt import QtCore, QtGui, loadUi
 from .find_dialog import FindDialog
 from .configure_dialog import ConfigureDialog
@@ -134,6 +135,8 @@ class MainWindow(QtGui.QMainWindow):
         model.selectionChanged.connect(self.image_list_selection_changed)
         self.ui.image_list.customContextMenuRequested.connect(
             self.image_list_context_menu)
+        # Revalidate the servers found in the last session (if any)
+        self.servers_restore()
 
     @property
     def selected_images(self):
@@ -193,9 +196,45 @@ class MainWindow(QtGui.QMainWindow):
             self.settings.setValue('position', self.pos())
         finally:
             self.settings.endGroup()
+        self.settings.beginGroup('network')
+        try:
+            cache = self.settings.value('cache', self.default_cache)
+            if cache and len(self.client.servers):
+                self.client.servers.save(cache)
+        finally:
+            self.settings.endGroup()
         self.client.close()
         super(MainWindow, self).closeEvent(event)
 
+    default_cache = os.path.expanduser('~/.cpigui_servers.json')
+
+    def servers_restore(self):
+        self.settings.beginGroup('network')
+        try:
+            cache = self.settings.value('cache', self.default_cache)
+            interface = self.settings.value('interface', '')
+            if cache and interface and os.path.exists(cache):
+                try:
+                    iface = netifaces.ifaddresses(interface)[netifaces.AF_INET][0]
+                except (ValueError, KeyError, IndexError):
+                    # The interface has gone or lost its address; leave the
+                    # user to find servers afresh
+                    return
+                self.client.servers.network = '%s/%s' % (
+                    iface['addr'], iface['netmask'])
+                self.client.servers.port = int(self.settings.value('port', 5647))
+                self.client.servers.timeout = int(self.settings.value('timeout', 15))
+                dropped = self.ui.server_list.model().load(cache)
+                self.servers_resize_columns()
+                if dropped:
+                    QtGui.QMessageBox.warning(
+                        self, 'Missing servers',
+                        'The following cached servers did not respond and '
+                        'have been removed:\n\n%s' %
+                        '\n'.join(str(address) for address in dropped))
+        finally:
+            self.settings.endGroup()
+
     def help_about(self):
         QtGui.QMessageBox.about(self,
             'About {}'.format(
@@ -240,9 +279,9 @@ The project homepage and documentation is at
                 self.settings.setValue('port', dialog.port)
                 self.settings.setValue('timeout', dialog.timeout)
                 self.settings.setValue('expected_count', dialog.expected_count)
-                self.client.network = '%s/%s' % (iface['addr'], iface['netmask'])
-                self.client.port = dialog.port
-                self.client.timeout = dialog.timeout
+                self.client.servers.network = '%s/%s' % (iface['addr'], iface['netmask'])
+                self.client.servers.port = dialog.port
+                self.client.servers.timeout = dialog.timeout
                 self.ui.server_list.model().find(count=dialog.expected_count)
                 self.servers_resize_columns()
         finally:
@@ -301,14 +340,33 @@ The project homepage and documentation is at
                         delay=dialog.capture_delay,
                         addresses=self.selected_addresses)
                 responses = self.client.list(self.selected_addresses)
+                missing = []
                 for (address, files) in responses.items():
-                    for f in files:
+                    streams = {}
+                    def factory(f):
+                        streams[f.index] = io.BytesIO()
+                        return streams[f.index]
+                    received = self.client.download_many(
+                        address, factory, 0, len(files))
+                    # The server may have dropped files since they were
+                    # listed; keep whatever was received
+                    received_indexes = set(f.index for f in received)
+                    missing.extend(
+                        '%s: file %d' % (address, f.index)
+                        for f in files
+                        if f.index not in received_indexes
+                        )
+                    for f in received:
                         if f.filetype == 'IMAGE':
-                            stream = io.BytesIO()
-                            self.client.download(address, f.index, stream)
+                            stream = streams[f.index]
                             if stream.tell() != f.size:
                                 raise IOError('Incorrect download size')
                             self.images[address][f.timestamp] = stream
+                if missing:
+                    QtGui.QMessageBox.warning(
+                        self, 'Missing files',
+                        'The following files were not received:\n\n%s' %
+                        '\n'.join(missing))
                 # XXX Check ordering of self.images[address]
                 # XXX Rollback in the case of a partial download...
                 self.client.clear(self.selected_addresses)
@@ -318,8 +376,9 @@ The project homepage and documentation is at
             self.settings.endGroup()
 
     def servers_configure(self):
+        selected_data = self.selected_data
         settings = {
-            attr: set(getattr(status, attr) for (addr, status) in self.selected_data)
+            attr: set(getattr(status, attr) for (addr, status) in selected_data)
             for attr in (
                 'resolution',
                 'framerate',
@@ -348,73 +407,76 @@ The project homepage and documentation is at
         dialog = ConfigureDialog(self)
         for attr, value in settings.items():
             setattr(dialog, attr, value)
+        # Record the values the dialog shows for settings that differ between
+        # servers so that, if the user leaves them alone, each server keeps
+        # its own value
+        shown = {
+            attr: getattr(dialog, attr)
+            for attr in ('awb_red', 'awb_blue', 'exposure_speed')
+            }
         if dialog.exec_():
+            # Gather all changed settings so they can be sent in a single
+            # command; the AWB gains and exposure speed may differ per server
+            # (see above) in which case each server is sent its own command
+            changes = {
+                attr: getattr(dialog, attr)
+                for attr in (
+                    'resolution',
+                    'framerate',
+                    'agc_mode',
+                    'metering_mode',
+                    'iso',
+                    'brightness',
+                    'contrast',
+                    'saturation',
+                    'ev',
+                    'denoise',
+                    )
+                if getattr(dialog, attr) != settings[attr]
+                }
+            per_server = {addr: {} for (addr, status) in selected_data}
+            if (dialog.awb_mode != settings['awb_mode']) or (
+                    dialog.awb_mode == 'off' and (
+                        dialog.awb_red != settings['awb_red'] or
+                        dialog.awb_blue != settings['awb_blue']
+                        )):
+                changes['awb_mode'] = dialog.awb_mode
+                if dialog.awb_mode == 'off':
+                    for (addr, status) in selected_data:
+                        per_server[addr]['awb_red'] = (
+                            status.awb_red
+                            if dialog.awb_red == shown['awb_red'] else
+                            dialog.awb_red)
+                        per_server[addr]['awb_blue'] = (
+                            status.awb_blue
+                            if dialog.awb_blue == shown['awb_blue'] else
+                            dialog.awb_blue)
+            if (dialog.exposure_mode != settings['exposure_mode']) or (
+                    dialog.exposure_mode == 'off' and
+                    dialog.exposure_speed != settings['exposure_speed']
+                    ):
+                changes['exposure_mode'] = dialog.exposure_mode
+                if dialog.exposure_mode == 'off':
+                    for (addr, status) in selected_data:
+                        per_server[addr]['exposure_speed'] = (
+                            status.exposure_speed
+                            if dialog.exposure_speed == shown['exposure_speed'] else
+                            dialog.exposure_speed)
+            if (
+                    dialog.hflip != settings['hflip'] or
+                    dialog.vflip != settings['vflip']
+                    ):
+                changes['hflip'] = dialog.hflip
+                changes['vflip'] = dialog.vflip
             try:
-                if dialog.resolution != settings['resolution']:
-                    self.client.resolution(
-                            *dialog.resolution,
-                            addresses=self.selected_addresses)
-                if dialog.framerate != settings['framerate']:
-                    self.client.framerate(
-                            dialog.framerate,
-                            addresses=self.selected_addresses)
-                if dialog.agc_mode != settings['agc_mode']:
-                    self.client.agc(
-                            dialog.agc_mode,
-                            addresses=self.selected_addresses)
-                if (dialog.awb_mode != settings['awb_mode']) or (
-                        dialog.awb_mode == 'off' and (
-                            dialog.awb_red != settings['awb_red'] or
-                            dialog.awb_blue != settings['awb_blue']
-                            )):
-                    self.client.awb(
-                            dialog.awb_mode,
-                            dialog.awb_red,
-                            dialog.awb_blue,
-                            addresses=self.selected_addresses)
-                if (dialog.exposure_mode != settings['exposure_mode']) or (
-                        dialog.exposure_mode == 'off' and
-                        dialog.exposure_speed != settings['exposure_speed']
-                        ):
-                    self.client.exposure(
-                            dialog.exposure_mode,
-                            dialog.exposure_speed,
-                            addresses=self.selected_addresses)
-                if dialog.metering_mode != settings['metering_mode']:
-                    self.client.metering(
-                            dialog.metering_mode,
-                            addresses=self.selected_addresses)
-                if dialog.iso != settings['iso']:
-                    self.client.iso(
-                            dialog.iso,
-                            addresses=self.selected_addresses)
-                if dialog.brightness != settings['brightness']:
-                    self.client.brightness(
-                            dialog.brightness,
-                            addresses=self.selected_addresses)
-                if dialog.contrast != settings['contrast']:
-                    self.client.contrast(
-                            dialog.contrast,
-                            addresses=self.selected_addresses)
-                if dialog.saturation != settings['saturation']:
-                    self.client.saturation(
-                            dialog.saturation,
-                            addresses=self.selected_addresses)
-                if dialog.ev != settings['ev']:
-                    self.client.ev(
-                            dialog.ev,
-                            addresses=self.selected_addresses)
-                if (
-                        dialog.hflip != settings['hflip'] or
-                        dialog.vflip != settings['vflip']
-                        ):
-                    self.client.flip(
-                            dialog.hflip, dialog.vflip,
-                            addresses=self.selected_addresses)
-                if dialog.denoise != settings['denoise']:
-                    self.client.denoise(
-                            dialog.denoise,
-                            addresses=self.selected_addresses)
+                if any(per_server.values()):
+                    self.client.configure_many({
+                        addr: dict(changes, **server_changes)
+                        for (addr, server_changes) in per_server.items()
+                        })
+                elif changes:
+                    self.client.configure(
+                            addresses=self.selected_addresses, **changes)
             finally:
                 self.ui.server_list.model().refresh_selected(update=True)
 
@@ -422,38 +484,37 @@ The project homepage and documentation is at
         # There can be only one! ... selected server that is
         addr, status = next(iter(self.selected_data))
         try:
-            # Before we go setting resolution and framerate (which will reset
-            # the cameras, ensure AGC gains are allowed to float)
-            self.client.agc('auto')
-            self.client.resolution(*status.resolution)
-            self.client.framerate(status.framerate)
-            if status.awb_mode == 'off':
-                self.client.awb('off', status.awb_red, status.awb_blue)
-            else:
-                self.client.awb(status.awb_mode)
+            # All settings are sent in a single command. If the reference
+            # server's gains are fixed, let the gains float to begin with as
+            # setting the resolution and framerate may reset the cameras
+            self.client.configure(
+                resolution=status.resolution,
+                framerate=status.framerate,
+                awb_mode=status.awb_mode,
+                awb_red=status.awb_red if status.awb_mode == 'off' else None,
+                awb_blue=status.awb_blue if status.awb_mode == 'off' else None,
+                agc_mode='auto' if status.agc_mode == 'off' else status.agc_mode,
+                exposure_mode=status.exposure_mode,
+                exposure_speed=(
+                    status.exposure_speed if status.exposure_mode == 'off' else
+                    None),
+                ev=status.ev,
+                iso=status.iso,
+                metering_mode=status.metering_mode,
+                brightness=status.brightness,
+                contrast=status.contrast,
+                saturation=status.saturation,
+                denoise=status.denoise,
+                hflip=status.hflip,
+                vflip=status.vflip,
+                )
             if status.agc_mode == 'off':
-                # We've just reset the resolution and framerate which has reset
-                # all the cameras. Given we can't directly set the gains we
-                # need to wait a decent number of frames to let the gains
-                # settle before we disable AGC. Here we wait long enough for 30
-                # frames to have been captured (1 second at "normal"
-                # framerates)
+                # Given we can't directly set the gains we need to wait a
+                # decent number of frames to let the gains settle before we
+                # disable AGC. Here we wait long enough for 30 frames to have
+                # been captured (1 second at "normal" framerates)
                 time.sleep(30.0 / status.framerate)
                 self.client.agc('off')
-            else:
-                self.client.agc(status.agc_mode)
-            if status.exposure_mode == 'off':
-                self.client.exposure('off', status.exposure_speed)
-            else:
-                self.client.exposure(status.exposure_mode)
-            self.client.ev(status.ev)
-            self.client.iso(status.iso)
-            self.client.metering(status.metering_mode)
-            self.client.brightness(status.brightness)
-            self.client.contrast(status.contrast)
-            self.client.saturation(status.saturation)
-            self.client.denoise(status.denoise)
-            self.client.flip(status.hflip, status.vflip)
         finally:
             self.ui.server_list.model().refresh_all(update=True)
 
@@ -657,6 +718,28 @@ class ServersModel(QtCore.QAbstractTableModel):
         finally:
             self.endResetModel()
 
+    def load(self, filename):
+        # Returns the list of cached servers which failed to respond (and
+        # which have therefore been dropped from the server list)
+        self.beginResetModel()
+        try:
+            self.parent.client.servers.load(filename)
+            self._data = {}
+            dropped = []
+            if len(self.parent.client.servers):
+                try:
+                    for address, status in self.parent.client.status_iter():
+                        self._data[address] = status
+                except CompoundPiTransactionFailed:
+                    dropped = [
+                        address for address in self.parent.client.servers
+                        if address not in self._data]
+                    for address in dropped:
+                        self.parent.client.servers.remove(address)
+            return dropped
+        finally:
+            self.endResetModel()
+
     def refresh_all(self, update=False):
         if update:
             self._data = self.parent.client.status()
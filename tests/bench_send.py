@@ -0,0 +1,147 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2014 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of compoundpi.
+#
+# compoundpi is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 2 of the License, or (at your option) any later
+# version.
+#
+# compoundpi is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# compoundpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark for the server's file transfer path.
+
+This script is not part of the test suite; run it directly on the server
+(where picamera and RPi.GPIO are installed) to compare the throughput and CPU
+usage of the old copying transfer (``makefile`` and ``shutil.copyfileobj``)
+with :meth:`CompoundPiFile.send` for in-memory and spooled files over the
+loopback interface::
+
+    python tests/bench_send.py --size 50M --repeat 5
+"""
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+native_str = str
+str = type('')
+
+import os
+import io
+import sys
+import time
+import struct
+import socket
+import shutil
+import tempfile
+import argparse
+import resource
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from compoundpi.server import CompoundPiFile, size
+
+
+def thread_cpu_time():
+    # RUSAGE_THREAD is Linux specific; fall back to the whole process
+    # elsewhere (which includes the receiving thread)
+    who = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def receiver(listen_sock, count):
+    for i in range(count):
+        conn, addr = listen_sock.accept()
+        try:
+            while conn.recv(65536):
+                pass
+        finally:
+            conn.close()
+
+
+def send_copy(f, address):
+    client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_sock.connect(address)
+    client_file = client_sock.makefile('wb')
+    try:
+        client_file.write(struct.pack(native_str('>L'), f.size))
+        client_file.flush()
+        f.stream.seek(0)
+        shutil.copyfileobj(f.stream, client_file)
+    finally:
+        client_file.close()
+        client_sock.close()
+
+
+def send_direct(f, address):
+    client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        client_sock.connect(address)
+        client_sock.sendall(struct.pack(native_str('>Q'), f.size))
+        f.send(client_sock)
+    finally:
+        client_sock.close()
+
+
+def bench(name, method, f, repeat):
+    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_sock.bind(('127.0.0.1', 0))
+    listen_sock.listen(1)
+    thread = threading.Thread(
+        target=receiver, args=(listen_sock, repeat))
+    thread.start()
+    try:
+        start_cpu = thread_cpu_time()
+        start = time.time()
+        for i in range(repeat):
+            method(f, listen_sock.getsockname())
+        elapsed = time.time() - start
+        cpu = thread_cpu_time() - start_cpu
+    finally:
+        thread.join()
+        listen_sock.close()
+    total = f.size * repeat / 1048576
+    print('%-16s %8.1f MB/s %8.1f%% CPU' % (
+        name, total / elapsed, cpu * 100 / elapsed))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        '-s', '--size', type=size, default='20M',
+        help='size of the file to send (default: %(default)s)')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=5,
+        help='number of times to send the file (default: %(default)s)')
+    parser.add_argument(
+        '--spool-dir', default=tempfile.gettempdir(),
+        help='directory to spool the test file to (default: %(default)s)')
+    args = parser.parse_args(args)
+
+    f = CompoundPiFile('IMAGE')
+    f.stream.write(os.urandom(args.size))
+    try:
+        bench('copy (RAM)', send_copy, f, args.repeat)
+        bench('direct (RAM)', send_direct, f, args.repeat)
+        f.spool(args.spool_dir)
+        bench('copy (spooled)', send_copy, f, args.repeat)
+        bench('direct (spooled)', send_direct, f, args.repeat)
+    finally:
+        f.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+# vim: set et sw=4 sts=4 fileencoding=utf-8:
+
+# Copyright 2014 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of compoundpi.
+#
+# compoundpi is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 2 of the License, or (at your option) any later
+# version.
+#
+# compoundpi is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# compoundpi.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark for the client's transaction bookkeeping.
+
+This script is not part of the test suite; run it directly on the client. It
+replaces the client's socket with one that answers every command immediately
+(from every server addressed) so that only the client's own overhead is
+measured: address checks, sending, and parsing and matching the responses of
+large fleets::
+
+    python tests/bench_transact.py --servers 1000,5000 --repeat 10
+"""
+
+from __future__ import (
+    unicode_literals,
+    absolute_import,
+    print_function,
+    division,
+    )
+native_str = str
+str = type('')
+
+import os
+import sys
+import time
+import errno
+import socket
+import argparse
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import compoundpi.client
+from compoundpi.client import (
+    CompoundPiServerList,
+    CompoundPiProgressHandler,
+    IPv4Address,
+    )
+
+
+class FakeSocket(object):
+    # Queues a response from every addressed server as each command is sent
+    def __init__(self, servers):
+        self.servers = servers
+        self.queue = deque()
+
+    def command(self, address, data):
+        header = data.split(b' ', 1)[0].decode('utf-8')
+        seqno, _, selector = header.partition('@')
+        response = ('%s OK' % seqno).encode('utf-8')
+        if address[0] != self.servers._broadcast:
+            targets = [address[0]]
+        elif selector:
+            base, bitmap = selector.split('/')
+            base = int(IPv4Address(base))
+            bitmap = int(bitmap, 16)
+            targets = [
+                str(IPv4Address(base + offset))
+                for offset in range(bitmap.bit_length())
+                if bitmap >> offset & 1
+                ]
+        else:
+            targets = [str(server) for server in self.servers]
+        for target in targets:
+            self.queue.append((response, (native_str(target), address[1])))
+
+    def recvfrom(self, size, flags=0):
+        try:
+            return self.queue.popleft()
+        except IndexError:
+            raise socket.error(errno.EAGAIN, 'Resource temporarily unavailable')
+
+    def setsockopt(self, level, option, value):
+        pass
+
+    def fileno(self):
+        return -1
+
+    def sendto(self, data, address):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeSelect(object):
+    def __init__(self, sock):
+        self.sock = sock
+
+    def select(self, rlist, wlist, xlist, timeout=None):
+        return ([self.sock] if self.sock.queue else [], [], [])
+
+
+class FakeRepeater(object):
+    # Sends its data once, and never retransmits
+    def __init__(self, sock, address, data, interval=None, backoff=None):
+        self.address = address
+        self.interval = interval
+        self.sends = 1
+        self.sent = time.time()
+        self.terminate = False
+        sock.command(address, data)
+
+    def join(self):
+        pass
+
+
+def make_servers(count):
+    servers = CompoundPiServerList(CompoundPiProgressHandler())
+    servers._socket.close()
+    servers._socket = FakeSocket(servers)
+    servers.network = '10.0.0.0/16'
+    servers._items = [
+        IPv4Address('10.0.%d.%d' % divmod(i + 1, 256))
+        for i in range(count)
+        ]
+    compoundpi.client.select = FakeSelect(servers._socket)
+    return servers
+
+
+def bench(name, method, repeat, responses):
+    start = time.time()
+    for i in range(repeat):
+        method()
+    elapsed = time.time() - start
+    print('%-24s %8.2f ms/transaction %8.2f us/response' % (
+        name, elapsed * 1000 / repeat,
+        elapsed * 1000000 / (repeat * responses)))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        '-s', '--servers', default='1000,5000',
+        type=lambda s: [int(i) for i in s.split(',')],
+        help='comma-separated sizes of fleet to simulate '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=10,
+        help='number of transactions to time (default: %(default)s)')
+    args = parser.parse_args(args)
+
+    compoundpi.client.NetworkRepeater = FakeRepeater
+    for count in args.servers:
+        servers = make_servers(count)
+        half = list(servers)[::2]
+        bench(
+            'broadcast (%d)' % count,
+            lambda: servers.transact('FRAMERATE 30'),
+            args.repeat, count)
+        bench(
+            'subset (%d)' % (count // 2),
+            lambda: servers.transact('FRAMERATE 30', half),
+            args.repeat, len(half))
+        bench(
+            'membership (%d)' % count,
+            lambda: all(str(address) in servers for address in half),
+            args.repeat, len(half))
+
+
+if __name__ == '__main__':
+    main()
@@ -28,6 +28,10 @@ str = type('')
 
 
 import io
+import json
+import errno
+import socket
+import struct
 import warnings
 import datetime as dt
 from fractions import Fraction
@@ -36,8 +40,10 @@ import pytest
 from mock import Mock, MagicMock, patch, sentinel, call
 
 import compoundpi
+import compoundpi.common
 import compoundpi.client
 from compoundpi.exc import (
+        CompoundPiServerError,
         CompoundPiRedefinedServer,
         CompoundPiTransactionFailed,
         CompoundPiInvalidResponse,
@@ -52,8 +58,18 @@ from compoundpi.exc import (
         CompoundPiSendTruncated,
         CompoundPiNoServers,
         CompoundPiUndefinedServers,
+        CompoundPiClientError,
+        CompoundPiWindowFull,
+        CompoundPiPacketsDropped,
         )
 
+def recv_effect(responses):
+    # Emulates a non-blocking recvfrom returning each of *responses* in turn
+    def recvfrom(size, flags=0):
+        if not responses:
+            raise socket.error(errno.EAGAIN, 'Resource temporarily unavailable')
+        return responses.pop(0)
+    return recvfrom
 
 def test_resolution():
     r = compoundpi.client.Resolution(1280, 720)
@@ -164,7 +180,7 @@ def test_server_list_insert():
                 progress=compoundpi.client.CompoundPiProgressHandler())
         l.insert(0, '192.168.0.1')
         assert l == [compoundpi.client.IPv4Address('192.168.0.1')]
-        m.assert_called_once_with(client_sock, ('192.168.0.1', 5647), b'1 HELLO 1000.0')
+        m.assert_called_once_with(client_sock, ('192.168.0.1', 5647), b'1 HELLO 1000.0', interval=0.5, backoff=2)
 
 def test_server_list_insert_again():
     client_sock = Mock()
@@ -227,7 +243,7 @@ def test_server_list_append():
         assert l == [
                 compoundpi.client.IPv4Address('192.168.0.1'),
                 compoundpi.client.IPv4Address('192.168.0.2')]
-        m.assert_called_once_with(client_sock, ('192.168.0.2', 5647), b'1 HELLO 1000.0')
+        m.assert_called_once_with(client_sock, ('192.168.0.2', 5647), b'1 HELLO 1000.0', interval=0.5, backoff=2)
 
 def test_server_list_extend():
     client_sock = Mock()
@@ -245,8 +261,8 @@ def test_server_list_extend():
         assert l == [
                 compoundpi.client.IPv4Address('192.168.0.1'),
                 compoundpi.client.IPv4Address('192.168.0.2')]
-        m.assert_any_call(client_sock, ('192.168.0.1', 5647), b'1 HELLO 1000.0')
-        m.assert_any_call(client_sock, ('192.168.0.2', 5647), b'2 HELLO 1000.0')
+        m.assert_any_call(client_sock, ('192.168.0.1', 5647), b'1 HELLO 1000.0', interval=0.5, backoff=2)
+        m.assert_any_call(client_sock, ('192.168.0.2', 5647), b'2 HELLO 1000.0', interval=0.5, backoff=2)
 
 def test_server_list_remove():
     client_sock = Mock()
@@ -258,6 +274,33 @@ def test_server_list_remove():
         assert l == []
         assert client_sock.sendto.call_count == 0
 
+def test_server_list_packed_index():
+    client_sock = Mock()
+    with patch('compoundpi.client.socket.socket', return_value=client_sock):
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l._items = [
+                compoundpi.client.IPv4Address('192.168.0.1'),
+                compoundpi.client.IPv4Address('192.168.0.2')]
+        assert '192.168.0.2' in l
+        assert compoundpi.client.IPv4Address('192.168.0.1') in l
+        assert '192.168.0.3' not in l
+        assert 'foo' not in l
+        assert l.index('192.168.0.2') == 1
+        l.remove(compoundpi.client.IPv4Address('192.168.0.1'))
+        assert '192.168.0.1' not in l
+        assert l.index('192.168.0.2') == 0
+        with pytest.raises(ValueError):
+            l.index('192.168.0.1')
+        with pytest.raises(ValueError):
+            l.remove('192.168.0.1')
+        space = compoundpi.client.CompoundPiAddressSpace([
+                compoundpi.client.IPv4Network('192.168.0.0/24'),
+                compoundpi.client.IPv4Network('10.0.0.0/8')])
+        assert '10.1.2.3' in space
+        assert int(compoundpi.client.IPv4Address('192.168.0.7')) in space
+        assert '192.168.1.7' not in space
+
 def test_server_list_set_item():
     client_sock = Mock()
     with patch('compoundpi.client.socket.socket', return_value=client_sock), \
@@ -276,7 +319,7 @@ def test_server_list_set_item():
         assert l == [
                 compoundpi.client.IPv4Address('192.168.0.1'),
                 compoundpi.client.IPv4Address('192.168.0.3')]
-        m.assert_called_once_with(client_sock, ('192.168.0.3', 5647), b'1 HELLO 1000.0')
+        m.assert_called_once_with(client_sock, ('192.168.0.3', 5647), b'1 HELLO 1000.0', interval=0.5, backoff=2)
 
 def test_server_list_del_item():
     client_sock = Mock()
@@ -335,7 +378,7 @@ def test_server_list_find_count():
         assert l == [
                 compoundpi.client.IPv4Address('192.168.0.1'),
                 compoundpi.client.IPv4Address('192.168.0.2')]
-        m.assert_any_call(client_sock, ('192.168.255.255', 5647), b'1 HELLO 1000.0')
+        m.assert_any_call(client_sock, ('192.168.255.255', 5647), b'1 HELLO 1000.0', interval=0.5, backoff=2)
 
 def test_server_list_find_all():
     client_sock = Mock()
@@ -357,10 +400,10 @@ def test_server_list_find_all():
             patch('compoundpi.client.select.select', side_effect=select_effect()), \
             patch('compoundpi.client.time.time', side_effect=time_effect()), \
             patch('compoundpi.client.NetworkRepeater') as m:
-        client_sock.recvfrom.side_effect = [
+        client_sock.recvfrom.side_effect = recv_effect([
                 (('1 OK\nVERSION %s' % compoundpi.__version__).encode('utf-8'), ('192.168.0.1', 5647)),
                 (('1 OK\nVERSION %s' % compoundpi.__version__).encode('utf-8'), ('192.168.0.2', 5647)),
-                ]
+                ])
         l = compoundpi.client.CompoundPiServerList(
                 progress=compoundpi.client.CompoundPiProgressHandler())
         l.timeout = 1
@@ -370,7 +413,179 @@ def test_server_list_find_all():
                 compoundpi.client.IPv4Address('192.168.0.1'),
                 compoundpi.client.IPv4Address('192.168.0.2')]
         print(m.mock_calls)
-        m.assert_any_call(client_sock, ('192.168.255.255', 5647), b'1 HELLO 1000.0')
+        m.assert_any_call(client_sock, ('192.168.255.255', 5647), b'1 HELLO 1000.0', interval=0.5, backoff=2)
+
+def test_server_list_find_quiet():
+    client_sock = Mock()
+    clock = [1000.0]
+    responses = [
+        (('1 OK\nVERSION %s' % compoundpi.__version__).encode('utf-8'), ('192.168.0.1', 5647)),
+        (('1 OK\nVERSION %s' % compoundpi.__version__).encode('utf-8'), ('192.168.0.2', 5647)),
+        ]
+    def select_effect(*args):
+        clock[0] += 0.5
+        if responses:
+            return ([client_sock],)
+        return ([],)
+    with patch('compoundpi.client.socket.socket', return_value=client_sock), \
+            patch('compoundpi.client.select.select', side_effect=select_effect), \
+            patch('compoundpi.client.time.time', side_effect=lambda: clock[0]), \
+            patch('compoundpi.client.NetworkRepeater') as m:
+        client_sock.recvfrom.side_effect = recv_effect(responses)
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l.find()
+        assert len(l) == 2
+        # Discovery ends once no new server has responded for the quiet
+        # period rather than after the full timeout (both responses are
+        # drained by the first wakeup)
+        assert clock[0] == 1002.5
+
+def test_server_list_find_networks():
+    client_sock = Mock()
+    with patch('compoundpi.client.socket.socket', return_value=client_sock), \
+            patch('compoundpi.client.select.select', return_value=([client_sock],)), \
+            patch('compoundpi.client.time.time', return_value=1000.0), \
+            patch('compoundpi.client.NetworkRepeater') as m:
+        client_sock.recvfrom.side_effect = [
+                (('1 OK\nVERSION %s' % compoundpi.__version__).encode('utf-8'), ('192.168.0.1', 5647)),
+                (('1 OK\nVERSION %s' % compoundpi.__version__).encode('utf-8'), ('10.0.0.1', 5647)),
+                (b'2 OK', ('10.0.0.1', 5647)),
+                (b'2 OK', ('192.168.0.1', 5647)),
+                ]
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l.find(2, networks=['192.168.0.0/16', '10.0.0.0/24'])
+        m.assert_any_call(client_sock, ('192.168.255.255', 5647), b'1 HELLO 1000.0', interval=0.5, backoff=2)
+        m.assert_any_call(client_sock, ('10.0.0.255', 5647), b'1 HELLO 1000.0', interval=0.5, backoff=2)
+        assert set(l) == {
+                compoundpi.client.IPv4Address('192.168.0.1'),
+                compoundpi.client.IPv4Address('10.0.0.1')}
+        # Servers outside the configured network are addressed by unicast
+        m.reset_mock()
+        l.transact('FRAMERATE 30')
+        assert m.call_count == 2
+        m.assert_any_call(client_sock, ('192.168.255.255', 5647), b'2 FRAMERATE 30', interval=0.5, backoff=2)
+        m.assert_any_call(client_sock, ('10.0.0.1', 5647), b'2 FRAMERATE 30', interval=0.5, backoff=2)
+
+def test_server_list_save_load(tmpdir):
+    client_sock = Mock()
+    cache = str(tmpdir.join('servers.json'))
+    with patch('compoundpi.client.socket.socket', return_value=client_sock), \
+            patch('compoundpi.client.select.select', return_value=([client_sock],)), \
+            patch('compoundpi.client.time.time', return_value=1000.0), \
+            patch('compoundpi.client.NetworkRepeater') as m:
+        client_sock.recvfrom.side_effect = [
+                (('1 OK\nVERSION %s' % compoundpi.__version__).encode('utf-8'), ('192.168.0.2', 5647)),
+                (('1 OK\nVERSION %s' % compoundpi.__version__).encode('utf-8'), ('192.168.0.1', 5647)),
+                ]
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l.find(2)
+        l.sort()
+        l.save(cache)
+        with io.open(cache, 'r', encoding='utf-8') as f:
+            assert json.load(f) == {
+                'network': '192.168.0.0/16',
+                'port': 5647,
+                'servers': [
+                    {'address': '192.168.0.1', 'seen': 1000.0, 'version': compoundpi.__version__},
+                    {'address': '192.168.0.2', 'seen': 1000.0, 'version': compoundpi.__version__},
+                    ],
+                }
+        client_sock.recvfrom.side_effect = [
+                (('1 OK\nVERSION %s' % compoundpi.__version__).encode('utf-8'), ('192.168.0.2', 5647)),
+                (('1 OK\nVERSION %s' % compoundpi.__version__).encode('utf-8'), ('192.168.0.1', 5647)),
+                ]
+        m.reset_mock()
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l.load(cache)
+        # Cached servers are revalidated by unicast, keeping their order, and
+        # no broadcast is sent
+        assert l == [
+                compoundpi.client.IPv4Address('192.168.0.1'),
+                compoundpi.client.IPv4Address('192.168.0.2')]
+        assert m.call_count == 2
+        m.assert_any_call(client_sock, ('192.168.0.1', 5647), b'1 HELLO 1000.0', interval=0.5, backoff=2)
+        m.assert_any_call(client_sock, ('192.168.0.2', 5647), b'1 HELLO 1000.0', interval=0.5, backoff=2)
+
+def test_server_list_load_gaps(tmpdir):
+    client_sock = Mock()
+    cache = tmpdir.join('servers.json')
+    cache.write(json.dumps({
+        'network': '192.168.0.0/16',
+        'port': 5647,
+        'servers': [
+            {'address': '192.168.0.1', 'seen': 1000.0, 'version': compoundpi.__version__},
+            {'address': '192.168.0.2', 'seen': 1000.0, 'version': compoundpi.__version__},
+            ],
+        }))
+    clock = [1000.0]
+    responses = [
+        (('1 OK\nVERSION %s' % compoundpi.__version__).encode('utf-8'), ('192.168.0.2', 5647)),
+        ]
+    def select_effect(*args):
+        clock[0] += 0.5
+        if responses:
+            return ([client_sock],)
+        return ([],)
+    with patch('compoundpi.client.socket.socket', return_value=client_sock), \
+            patch('compoundpi.client.select.select', side_effect=select_effect), \
+            patch('compoundpi.client.time.time', side_effect=lambda: clock[0]), \
+            patch('compoundpi.client.NetworkRepeater') as m:
+        client_sock.recvfrom.side_effect = recv_effect(responses)
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l.load(str(cache), 1)
+        assert l == [compoundpi.client.IPv4Address('192.168.0.2')]
+        assert m.call_count == 2
+        # Only when the revalidated servers fall short of the expected count
+        # is a broadcast find used to fill the gap
+        def repeater_effect(sock, address, data, **kwargs):
+            if address == ('192.168.255.255', 5647):
+                responses.extend([
+                    (('3 OK\nVERSION %s' % compoundpi.__version__).encode('utf-8'), ('192.168.0.3', 5647)),
+                    (('3 OK\nVERSION %s' % compoundpi.__version__).encode('utf-8'), ('192.168.0.2', 5647)),
+                    ])
+            return Mock()
+        responses.append(
+            (('2 OK\nVERSION %s' % compoundpi.__version__).encode('utf-8'), ('192.168.0.2', 5647)))
+        m.reset_mock()
+        m.side_effect = repeater_effect
+        l.load(str(cache), 2)
+        assert l == [
+                compoundpi.client.IPv4Address('192.168.0.2'),
+                compoundpi.client.IPv4Address('192.168.0.3')]
+        assert [
+            c for c in m.call_args_list
+            if c[0][1] == ('192.168.255.255', 5647) and c[0][2].startswith(b'3 HELLO ')
+            ]
+
+def test_server_list_load_invalid(tmpdir):
+    client_sock = Mock()
+    with patch('compoundpi.client.socket.socket', return_value=client_sock), \
+            patch('compoundpi.client.select.select', return_value=([client_sock],)), \
+            patch('compoundpi.client.time.time', return_value=1000.0), \
+            patch('compoundpi.client.NetworkRepeater') as m:
+        client_sock.recvfrom.side_effect = [
+                (('1 OK\nVERSION %s' % compoundpi.__version__).encode('utf-8'), ('192.168.0.1', 5647)),
+                (('2 OK\nVERSION %s' % compoundpi.__version__).encode('utf-8'), ('192.168.0.1', 5647)),
+                ]
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        # A missing cache falls back to a broadcast find
+        l.load(str(tmpdir.join('missing.json')), 1)
+        assert l == [compoundpi.client.IPv4Address('192.168.0.1')]
+        m.assert_called_once_with(client_sock, ('192.168.255.255', 5647), b'1 HELLO 1000.0', interval=0.5, backoff=2)
+        # As does a cache written for another network
+        cache = str(tmpdir.join('servers.json'))
+        l.save(cache)
+        l.network = '192.168.0.0/24'
+        m.reset_mock()
+        l.load(cache, 1)
+        assert l == [compoundpi.client.IPv4Address('192.168.0.1')]
+        m.assert_called_once_with(client_sock, ('192.168.0.255', 5647), b'2 HELLO 1000.0', interval=0.5, backoff=2)
 
 def test_server_list_wrong_port():
     client_sock = Mock()
@@ -490,7 +705,39 @@ def test_server_list_transact_ok():
             compoundpi.client.IPv4Address('192.168.0.1'): None,
             compoundpi.client.IPv4Address('192.168.0.2'): None,
             }
-        m.assert_called_once_with(client_sock, ('192.168.255.255', 5647), b'1 FRAMERATE 30')
+        m.assert_called_once_with(client_sock, ('192.168.255.255', 5647), b'1 FRAMERATE 30', interval=0.5, backoff=2)
+
+def test_server_list_transact_fragments():
+    client_sock = Mock()
+    with patch('compoundpi.client.socket.socket', return_value=client_sock), \
+            patch('compoundpi.client.select.select', return_value=([client_sock],)), \
+            patch('compoundpi.client.NetworkRepeater') as m:
+        client_sock.recvfrom.side_effect = [
+                (b'1.1/3 OK\nIMAGE,1,', ('192.168.0.1', 5647)),
+                (b'1 OK\nIMAGE,0,1000.0,10', ('192.168.0.2', 5647)),
+                (b'1.0/3 OK\nIMAGE,0,1000.0,10\n', ('192.168.0.1', 5647)),
+                (b'1.1/3 OK\nIMAGE,1,', ('192.168.0.1', 5647)),
+                (b'1.2/3 OK\n1001.0,20', ('192.168.0.1', 5647)),
+                ]
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l._items = [
+                compoundpi.client.IPv4Address('192.168.0.1'),
+                compoundpi.client.IPv4Address('192.168.0.2'),
+                ]
+        assert l.transact('LIST') == {
+            compoundpi.client.IPv4Address('192.168.0.1'):
+                'IMAGE,0,1000.0,10\nIMAGE,1,1001.0,20',
+            compoundpi.client.IPv4Address('192.168.0.2'):
+                'IMAGE,0,1000.0,10',
+            }
+        assert client_sock.sendto.call_args_list == [
+                call(b'1.1 ACK', ('192.168.0.1', 5647)),
+                call(b'1 ACK', ('192.168.0.2', 5647)),
+                call(b'1.0 ACK', ('192.168.0.1', 5647)),
+                call(b'1.1 ACK', ('192.168.0.1', 5647)),
+                call(b'1.2 ACK', ('192.168.0.1', 5647)),
+                ]
 
 def test_server_list_transact_subset():
     client_sock = Mock()
@@ -510,7 +757,361 @@ def test_server_list_transact_subset():
         assert l.transact('FRAMERATE 30', [compoundpi.client.IPv4Address('192.168.0.1')]) == {
             compoundpi.client.IPv4Address('192.168.0.1'): None,
             }
-        m.assert_called_once_with(client_sock, ('192.168.0.1', 5647), b'1 FRAMERATE 30')
+        m.assert_called_once_with(client_sock, ('192.168.0.1', 5647), b'1 FRAMERATE 30', interval=0.5, backoff=2)
+
+def test_server_list_transact_burst():
+    client_sock = Mock()
+    responses = [
+        (b'1 OK', ('192.168.%d.%d' % divmod(i, 256), 5647))
+        for i in range(1, 301)
+        ]
+    with patch('compoundpi.client.socket.socket', return_value=client_sock), \
+            patch('compoundpi.client.select.select', return_value=([client_sock],)) as s, \
+            patch('compoundpi.client._udp_drops', side_effect=[0, 12]), \
+            patch('compoundpi.client.NetworkRepeater') as m:
+        client_sock.recvfrom.side_effect = recv_effect(responses)
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l._items = [
+                compoundpi.client.IPv4Address('192.168.%d.%d' % divmod(i, 256))
+                for i in range(1, 301)
+                ]
+        # The receive buffer is sized for the number of servers
+        client_sock.setsockopt.assert_called_with(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, 300 * 2048)
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            assert len(l.transact('FRAMERATE 30')) == 300
+            # A burst of responses is drained in batches rather than one per
+            # wakeup
+            assert s.call_count == 2
+            assert len(w) == 1
+            assert isinstance(w[0].message, CompoundPiPacketsDropped)
+            assert w[0].message.count == 12
+            assert l.drops == 12
+
+def test_server_list_transact_rtt():
+    client_sock = Mock()
+    clock = [1000.2]
+    responses = [(b'1 OK', ('192.168.0.1', 5647))]
+    def select_effect(*args):
+        if responses:
+            return ([client_sock],)
+        # Once all responses are read, skip to the end of the timeout
+        clock[0] = 2000.0
+        return ([],)
+    repeaters = []
+    def repeater_effect(sock, address, data, interval, backoff):
+        repeaters.append(
+            Mock(address=address, sent=1000.0, sends=1, interval=interval))
+        return repeaters[-1]
+    with patch('compoundpi.client.socket.socket', return_value=client_sock), \
+            patch('compoundpi.client.select.select', side_effect=select_effect), \
+            patch('compoundpi.client.time.time', side_effect=lambda: clock[0]), \
+            patch('compoundpi.client.NetworkRepeater', side_effect=repeater_effect) as m:
+        client_sock.recvfrom.side_effect = recv_effect(responses)
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l._items = [
+                compoundpi.client.IPv4Address('192.168.0.1'),
+                compoundpi.client.IPv4Address('192.168.0.2'),
+                ]
+        with pytest.raises(CompoundPiTransactionFailed):
+            l.transact('FRAMERATE 30')
+        estimate = l.rtt[compoundpi.client.IPv4Address('192.168.0.1')]
+        assert estimate.samples == 1
+        assert estimate.srtt == pytest.approx(0.2)
+        assert estimate.rto == pytest.approx(0.6)
+        # The broadcast is repeated less often as only one of the two servers
+        # remains outstanding
+        assert repeaters[0].address == ('192.168.255.255', 5647)
+        assert repeaters[0].interval == pytest.approx(1.2)
+        # The server that failed to respond has its timeout backed off
+        assert l.rtt[compoundpi.client.IPv4Address('192.168.0.2')].rto == 1.0
+        clock[0] = 1000.2
+        responses.append((b'2 OK', ('192.168.0.1', 5647)))
+        l.transact('FRAMERATE 30', ['192.168.0.1'])
+        m.assert_called_with(
+                client_sock, ('192.168.0.1', 5647), b'2 FRAMERATE 30',
+                interval=pytest.approx(0.6), backoff=2)
+        assert estimate.samples == 2
+
+def test_rtt_estimate():
+    estimate = compoundpi.client.CompoundPiRTTEstimate()
+    assert estimate.rto == 0.5
+    assert estimate.srtt is None
+    estimate.update(0.1)
+    assert estimate.srtt == pytest.approx(0.1)
+    assert estimate.rttvar == pytest.approx(0.05)
+    assert estimate.rto == pytest.approx(0.3)
+    estimate.update(0.02)
+    assert estimate.rttvar == pytest.approx(0.0575)
+    assert estimate.srtt == pytest.approx(0.09)
+    assert estimate.rto == pytest.approx(0.32)
+    estimate.backoff()
+    assert estimate.rto == pytest.approx(0.64)
+    for i in range(10):
+        estimate.backoff()
+    assert estimate.rto == 5.0
+    for i in range(50):
+        estimate.update(0.001)
+    assert estimate.rto == 0.1
+
+def test_network_repeater_backoff():
+    sock = Mock()
+    with patch('compoundpi.common.time.sleep') as sleep, \
+            patch('compoundpi.common.random.uniform', side_effect=lambda a, b: b), \
+            patch('compoundpi.common.time.time', side_effect=[1000.0] + [1000.0] * 5 + [1010.0]):
+        repeater = compoundpi.common.NetworkRepeater(
+                sock, ('192.168.0.1', 5647), b'1 HELLO 1000.0',
+                interval=1, backoff=2, max_interval=5)
+        repeater.join()
+    assert repeater.sends == 5
+    assert sleep.call_args_list == [call(1), call(2), call(4), call(5), call(5)]
+
+def test_server_list_transact_targets():
+    client_sock = Mock()
+    with patch('compoundpi.client.socket.socket', return_value=client_sock), \
+            patch('compoundpi.client.select.select', return_value=([client_sock],)), \
+            patch('compoundpi.client.NetworkRepeater') as m:
+        client_sock.recvfrom.side_effect = [
+                (b'1 OK', ('192.168.0.4', 5647)),
+                (b'1 OK', ('192.168.0.1', 5647)),
+                ]
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l._items = [
+                compoundpi.client.IPv4Address('192.168.%d.%d' % divmod(i, 256))
+                for i in range(1, 6)
+                ]
+        assert l.transact('FRAMERATE 30', ['192.168.0.1', '192.168.0.4']) == {
+            compoundpi.client.IPv4Address('192.168.0.1'): None,
+            compoundpi.client.IPv4Address('192.168.0.4'): None,
+            }
+        m.assert_called_once_with(
+                client_sock, ('192.168.255.255', 5647),
+                b'1@192.168.0.1/9 FRAMERATE 30', interval=0.5, backoff=2)
+
+def test_server_list_transact_targets_too_large():
+    client_sock = Mock()
+    with patch('compoundpi.client.socket.socket', return_value=client_sock), \
+            patch('compoundpi.client.select.select', return_value=([client_sock],)), \
+            patch('compoundpi.client.NetworkRepeater') as m:
+        client_sock.recvfrom.side_effect = [
+                (b'1 OK', ('192.168.0.1', 5647)),
+                (b'1 OK', ('192.168.16.1', 5647)),
+                ]
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l._items = [
+                compoundpi.client.IPv4Address('192.168.0.1'),
+                compoundpi.client.IPv4Address('192.168.0.2'),
+                compoundpi.client.IPv4Address('192.168.16.1'),
+                ]
+        l.transact('FRAMERATE 30', ['192.168.0.1', '192.168.16.1'])
+        assert m.call_count == 2
+        m.assert_any_call(
+                client_sock, ('192.168.0.1', 5647), b'1 FRAMERATE 30',
+                interval=0.5, backoff=2)
+        m.assert_any_call(
+                client_sock, ('192.168.16.1', 5647), b'1 FRAMERATE 30',
+                interval=0.5, backoff=2)
+
+def test_server_list_transact_many():
+    client_sock = Mock()
+    with patch('compoundpi.client.socket.socket', return_value=client_sock), \
+            patch('compoundpi.client.select.select', return_value=([client_sock],)), \
+            patch('compoundpi.client.NetworkRepeater') as m:
+        client_sock.recvfrom.side_effect = [
+                (b'1 OK', ('192.168.0.2', 5647)),
+                (b'1 ERROR\nfoo', ('192.168.0.1', 5647)),
+                ]
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l._items = [
+                compoundpi.client.IPv4Address('192.168.%d.%d' % divmod(i, 256))
+                for i in range(1, 4)
+                ]
+        with pytest.raises(CompoundPiTransactionFailed) as excinfo:
+            l.transact_many({
+                '192.168.0.1': 'EXPOSURE off,10.0',
+                '192.168.0.2': 'EXPOSURE off,20.0',
+                })
+        assert len(excinfo.value.errors) == 1
+        assert isinstance(excinfo.value.errors[0], CompoundPiServerError)
+        # Each command is unicast under the same sequence number
+        assert m.call_count == 2
+        m.assert_any_call(
+                client_sock, ('192.168.0.1', 5647), b'1 EXPOSURE off,10.0',
+                interval=0.5, backoff=2)
+        m.assert_any_call(
+                client_sock, ('192.168.0.2', 5647), b'1 EXPOSURE off,20.0',
+                interval=0.5, backoff=2)
+        with pytest.raises(CompoundPiUndefinedServers):
+            l.transact_many({'192.168.0.4': 'EXPOSURE off,10.0'})
+
+def test_target_selector():
+    selector = compoundpi.common.target_selector(
+            ['192.168.0.14', '192.168.0.10', '192.168.0.11'])
+    assert selector == '192.168.0.10/13'
+    assert compoundpi.common.target_selected(selector, '192.168.0.10')
+    assert compoundpi.common.target_selected(selector, '192.168.0.14')
+    assert not compoundpi.common.target_selected(selector, '192.168.0.12')
+    assert not compoundpi.common.target_selected(selector, '192.168.0.9')
+    assert not compoundpi.common.target_selected(selector, '192.168.0.15')
+
+def test_server_list_transact_async():
+    client_sock = Mock()
+    with patch('compoundpi.client.socket.socket', return_value=client_sock), \
+            patch('compoundpi.client.select.select', return_value=([client_sock],)), \
+            patch('compoundpi.client.NetworkRepeater') as m:
+        # The responses to the second transaction arrive while the first is
+        # being collected
+        client_sock.recvfrom.side_effect = [
+                (b'2 OK\nbar', ('192.168.0.2', 5647)),
+                (b'1 OK\nfoo', ('192.168.0.1', 5647)),
+                ]
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l._items = [
+                compoundpi.client.IPv4Address('192.168.0.1'),
+                compoundpi.client.IPv4Address('192.168.0.2'),
+                ]
+        t1 = l.transact_async('LIST', ['192.168.0.1'])
+        # Only one transaction may be outstanding by default
+        with pytest.raises(CompoundPiWindowFull):
+            l.transact_async('LIST', ['192.168.0.2'])
+        l.window = 2
+        t2 = l.transact_async('LIST', ['192.168.0.2'])
+        assert m.call_count == 2
+        assert t1.result() == {compoundpi.client.IPv4Address('192.168.0.1'): 'foo'}
+        assert t2.done
+        assert t2.result() == {compoundpi.client.IPv4Address('192.168.0.2'): 'bar'}
+        assert client_sock.recvfrom.call_count == 2
+        assert not l._pending
+        with pytest.raises(CompoundPiClientError):
+            t2.result()
+        with pytest.raises(ValueError):
+            l.window = 33
+
+def test_server_list_transact_iter():
+    client_sock = Mock()
+    clock = [1000.0]
+    responses = [
+        (b'1 OK\nfoo', ('192.168.0.2', 5647)),
+        (b'1 ERROR\nbar', ('192.168.0.1', 5647)),
+        ]
+    def select_effect(*args):
+        if responses:
+            return ([client_sock],)
+        clock[0] = 2000.0
+        return ([],)
+    with patch('compoundpi.client.socket.socket', return_value=client_sock), \
+            patch('compoundpi.client.select.select', side_effect=select_effect), \
+            patch('compoundpi.client.time.time', side_effect=lambda: clock[0]), \
+            patch('compoundpi.client.NetworkRepeater') as m:
+        client_sock.recvfrom.side_effect = recv_effect(responses)
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l._items = [
+                compoundpi.client.IPv4Address('192.168.0.1'),
+                compoundpi.client.IPv4Address('192.168.0.2'),
+                compoundpi.client.IPv4Address('192.168.0.3'),
+                ]
+        it = l.transact_iter('LIST')
+        assert not m.called
+        assert next(it) == (compoundpi.client.IPv4Address('192.168.0.2'), 'foo')
+        # The first response is yielded before the others have been read
+        assert len(responses) == 1
+        with pytest.raises(CompoundPiTransactionFailed) as excinfo:
+            next(it)
+        assert len(excinfo.value.errors) == 2
+        assert isinstance(excinfo.value.errors[0], CompoundPiServerError)
+        assert isinstance(excinfo.value.errors[1], CompoundPiMissingResponse)
+        assert excinfo.value.errors[1].address == compoundpi.client.IPv4Address('192.168.0.3')
+
+def test_server_list_transact_quorum():
+    client_sock = Mock()
+    with patch('compoundpi.client.socket.socket', return_value=client_sock), \
+            patch('compoundpi.client.select.select', return_value=([client_sock],)), \
+            patch('compoundpi.client.NetworkRepeater') as m:
+        client_sock.recvfrom.side_effect = [
+                (b'1 ERROR\nfoo', ('192.168.0.3', 5647)),
+                (b'1 OK\nbar', ('192.168.0.2', 5647)),
+                (b'1 OK\nbaz', ('192.168.0.1', 5647)),
+                ]
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l._items = [
+                compoundpi.client.IPv4Address('192.168.%d.%d' % divmod(i, 256))
+                for i in range(1, 5)
+                ]
+        result = l.transact('LIST', quorum=2)
+        assert result == {
+            compoundpi.client.IPv4Address('192.168.0.1'): 'baz',
+            compoundpi.client.IPv4Address('192.168.0.2'): 'bar',
+            }
+        assert result.succeeded == {
+            compoundpi.client.IPv4Address('192.168.0.1'),
+            compoundpi.client.IPv4Address('192.168.0.2'),
+            }
+        assert list(result.failed) == [compoundpi.client.IPv4Address('192.168.0.3')]
+        assert isinstance(result.failed[compoundpi.client.IPv4Address('192.168.0.3')], CompoundPiServerError)
+        assert result.stragglers == {compoundpi.client.IPv4Address('192.168.0.4')}
+        # The straggler's timeout isn't backed off as the transaction ended
+        # early
+        assert compoundpi.client.IPv4Address('192.168.0.4') not in l.rtt
+        # The broadcast is no longer repeated once the quorum is reached
+        assert m.return_value.terminate == True
+        m.return_value.join.assert_called_once_with()
+
+def test_server_list_transact_quorum_failed():
+    client_sock = Mock()
+    with patch('compoundpi.client.socket.socket', return_value=client_sock), \
+            patch('compoundpi.client.select.select', return_value=([client_sock],)), \
+            patch('compoundpi.client.NetworkRepeater') as m:
+        client_sock.recvfrom.side_effect = [
+                (b'1 ERROR\nfoo', ('192.168.0.3', 5647)),
+                (b'1 ERROR\nbar', ('192.168.0.2', 5647)),
+                ]
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l._items = [
+                compoundpi.client.IPv4Address('192.168.%d.%d' % divmod(i, 256))
+                for i in range(1, 4)
+                ]
+        # Once two servers have failed a quorum of two is impossible so the
+        # transaction ends immediately
+        with pytest.raises(CompoundPiTransactionFailed) as excinfo:
+            l.transact('LIST', quorum=2)
+        assert len(excinfo.value.errors) == 3
+
+def test_server_list_transact_deadline():
+    client_sock = Mock()
+    clock = [1000.0]
+    responses = [(b'1 OK\nfoo', ('192.168.0.2', 5647))]
+    def select_effect(*args):
+        if responses:
+            return ([client_sock],)
+        clock[0] = 1002.0
+        return ([],)
+    with patch('compoundpi.client.socket.socket', return_value=client_sock), \
+            patch('compoundpi.client.select.select', side_effect=select_effect), \
+            patch('compoundpi.client.time.time', side_effect=lambda: clock[0]), \
+            patch('compoundpi.client.NetworkRepeater') as m:
+        client_sock.recvfrom.side_effect = recv_effect(responses)
+        l = compoundpi.client.CompoundPiServerList(
+                progress=compoundpi.client.CompoundPiProgressHandler())
+        l._items = [
+                compoundpi.client.IPv4Address('192.168.0.1'),
+                compoundpi.client.IPv4Address('192.168.0.2'),
+                ]
+        l.deadline = 1
+        result = l.transact('LIST')
+        assert result == {compoundpi.client.IPv4Address('192.168.0.2'): 'foo'}
+        assert result.stragglers == {compoundpi.client.IPv4Address('192.168.0.1')}
+        assert result.failed == {}
+        assert l.rtt[compoundpi.client.IPv4Address('192.168.0.1')].rto == 1.0
 
 def test_server_list_transact_no_servers():
     client_sock = Mock()
@@ -547,9 +1148,9 @@ def test_server_list_transact_missing_response():
     with patch('compoundpi.client.socket.socket', return_value=client_sock), \
             patch('compoundpi.client.select.select', side_effect=select_effect()), \
             patch('compoundpi.client.NetworkRepeater') as m:
-        client_sock.recvfrom.side_effect = [
+        client_sock.recvfrom.side_effect = recv_effect([
                 (b'1 OK', ('192.168.0.1', 5647)),
-                ]
+                ])
         l = compoundpi.client.CompoundPiServerList(
                 progress=compoundpi.client.CompoundPiProgressHandler())
         l.timeout = 1
@@ -674,6 +1275,39 @@ FILES 0
             }
         l.assert_called_once_with('STATUS', None)
 
+def test_client_status_iter():
+    def transact_iter(data, addresses):
+        assert data == 'STATUS'
+        yield compoundpi.client.IPv4Address('192.168.0.1'), 'FOO'
+        yield compoundpi.client.IPv4Address('192.168.0.2'), 'BAR'
+        raise CompoundPiTransactionFailed(
+            [CompoundPiMissingResponse(compoundpi.client.IPv4Address('192.168.0.3'))])
+    with patch('compoundpi.client.CompoundPiServerList.transact_iter', side_effect=transact_iter), \
+            patch('compoundpi.client.CompoundPiClient._parse_status') as parse, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        parse.side_effect = lambda address, data, errors: (
+                sentinel.status if data == 'FOO' else
+                errors.append(CompoundPiInvalidResponse(address)))
+        client = compoundpi.client.CompoundPiClient()
+        it = client.status_iter()
+        assert next(it) == (compoundpi.client.IPv4Address('192.168.0.1'), sentinel.status)
+        with pytest.raises(CompoundPiTransactionFailed) as excinfo:
+            next(it)
+        assert len(excinfo.value.errors) == 2
+        assert isinstance(excinfo.value.errors[0], CompoundPiMissingResponse)
+        assert isinstance(excinfo.value.errors[1], CompoundPiInvalidResponse)
+
+def test_client_list_quorum():
+    with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        l.return_value = compoundpi.client.CompoundPiResponses(
+            {compoundpi.client.IPv4Address('192.168.0.1'): ''},
+            stragglers={compoundpi.client.IPv4Address('192.168.0.2')})
+        client = compoundpi.client.CompoundPiClient()
+        result = client.list()
+        assert result == {compoundpi.client.IPv4Address('192.168.0.1'): []}
+        assert result.stragglers == {compoundpi.client.IPv4Address('192.168.0.2')}
+
 def test_client_status_bad():
     status_response = "FOO"
     with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
@@ -722,6 +1356,19 @@ def test_client_awb():
         client.awb('off', 1.4, 1.5)
         l.assert_called_once_with('AWB off,7/5,3/2', None)
 
+def test_client_awb_many():
+    with patch('compoundpi.client.CompoundPiServerList.transact_many') as l, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        client = compoundpi.client.CompoundPiClient()
+        client.awb_many({
+            compoundpi.client.IPv4Address('192.168.0.1'): (1.4, 1.5),
+            compoundpi.client.IPv4Address('192.168.0.2'): (1.5, 1.4),
+            })
+        l.assert_called_once_with({
+            compoundpi.client.IPv4Address('192.168.0.1'): 'AWB off,7/5,3/2',
+            compoundpi.client.IPv4Address('192.168.0.2'): 'AWB off,3/2,7/5',
+            })
+
 def test_client_agc():
     with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
             patch('compoundpi.client.CompoundPiDownloadServer'):
@@ -744,6 +1391,44 @@ def test_client_exposure():
         client.exposure('off', 33.333)
         l.assert_called_once_with('EXPOSURE off,33.333', None)
 
+def test_client_exposure_many():
+    with patch('compoundpi.client.CompoundPiServerList.transact_many') as l, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        client = compoundpi.client.CompoundPiClient()
+        client.exposure_many({
+            compoundpi.client.IPv4Address('192.168.0.1'): 10.0,
+            compoundpi.client.IPv4Address('192.168.0.2'): 20.0,
+            })
+        l.assert_called_once_with({
+            compoundpi.client.IPv4Address('192.168.0.1'): 'EXPOSURE off,10.0',
+            compoundpi.client.IPv4Address('192.168.0.2'): 'EXPOSURE off,20.0',
+            })
+
+def test_client_configure():
+    with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        client = compoundpi.client.CompoundPiClient()
+        client.configure(
+            resolution=(1280, 720), framerate=30, exposure_mode='auto',
+            hflip=True, vflip=False)
+        l.assert_called_once_with(
+            'CONFIGURE 1280,720,30,,,,,auto,,,,,,,,1,0,', None)
+        with pytest.raises(TypeError):
+            client.configure(foo=1)
+
+def test_client_configure_many():
+    with patch('compoundpi.client.CompoundPiServerList.transact_many') as l, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        client = compoundpi.client.CompoundPiClient()
+        client.configure_many({
+            compoundpi.client.IPv4Address('192.168.0.1'): {'iso': 100},
+            compoundpi.client.IPv4Address('192.168.0.2'): {'iso': 200},
+            })
+        l.assert_called_once_with({
+            compoundpi.client.IPv4Address('192.168.0.1'): 'CONFIGURE ,,,,,,,,,100,,,,,,,,',
+            compoundpi.client.IPv4Address('192.168.0.2'): 'CONFIGURE ,,,,,,,,,200,,,,,,,,',
+            })
+
 def test_client_metering():
     with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
             patch('compoundpi.client.CompoundPiDownloadServer'):
@@ -843,6 +1528,95 @@ def test_client_capture_now():
         client.capture()
         l.assert_called_once_with('CAPTURE 1,0,,', None)
 
+def test_client_capture_async():
+    jobs = ['3,DONE,1.000,']
+    def transact_effect(data, addresses):
+        if data.startswith('CAPTURE'):
+            return {
+                compoundpi.client.IPv4Address('192.168.0.1'): 'JOB 1',
+                compoundpi.client.IPv4Address('192.168.0.2'): 'JOB 3',
+                }
+        assert data == 'JOBS'
+        if addresses == [compoundpi.client.IPv4Address('192.168.0.2')]:
+            return {
+                compoundpi.client.IPv4Address('192.168.0.2'): jobs.pop(0),
+                }
+        return {
+            compoundpi.client.IPv4Address('192.168.0.1'): '1,DONE,1.000,',
+            compoundpi.client.IPv4Address('192.168.0.2'): '3,RUNNING,0.250,',
+            }
+    with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
+            patch('compoundpi.client.time.sleep') as sleep, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        l.side_effect = transact_effect
+        client = compoundpi.client.CompoundPiClient()
+        job = client.capture_async(count=5)
+        l.assert_called_once_with('CAPTURE 5,0,,', None)
+        assert job.jobs == {
+            compoundpi.client.IPv4Address('192.168.0.1'): 1,
+            compoundpi.client.IPv4Address('192.168.0.2'): 3,
+            }
+        assert not job.done
+        job.poll()
+        assert not job.done
+        assert job.status[compoundpi.client.IPv4Address('192.168.0.2')] == (
+            compoundpi.client.CompoundPiJobStatus(3, 'RUNNING', 0.25, ''))
+        # Only the server whose job is still running is polled again
+        assert job.wait()
+        assert sleep.call_count == 0
+        assert job.done
+
+def test_client_job_wait_failed():
+    def transact_effect(data, addresses):
+        if data.startswith('RECORD'):
+            return {compoundpi.client.IPv4Address('192.168.0.1'): 'JOB 2'}
+        return {compoundpi.client.IPv4Address('192.168.0.1'): '2,FAILED,0.400,Out of resources'}
+    with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        l.side_effect = transact_effect
+        client = compoundpi.client.CompoundPiClient()
+        with pytest.raises(CompoundPiTransactionFailed) as excinfo:
+            client.record(5)
+        assert len(excinfo.value.errors) == 1
+        assert isinstance(excinfo.value.errors[0], CompoundPiServerError)
+
+def test_client_job_wait_timeout():
+    with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
+            patch('compoundpi.client.time.time') as now, \
+            patch('compoundpi.client.time.sleep') as sleep, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        l.return_value = {compoundpi.client.IPv4Address('192.168.0.1'): '2,RUNNING,0.400,'}
+        now.side_effect = [1000.0, 1000.5, 1001.5]
+        client = compoundpi.client.CompoundPiClient()
+        job = compoundpi.client.CompoundPiJob(
+            client, {compoundpi.client.IPv4Address('192.168.0.1'): 2})
+        assert not job.wait(timeout=1)
+        sleep.assert_called_once_with(0.5)
+
+def test_client_jobs():
+    with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        l.return_value = {
+            compoundpi.client.IPv4Address('192.168.0.1'): '1,DONE,1.000,\n2,FAILED,0.250,Out of resources',
+            compoundpi.client.IPv4Address('192.168.0.2'): '',
+            }
+        client = compoundpi.client.CompoundPiClient()
+        assert client.jobs() == {
+            compoundpi.client.IPv4Address('192.168.0.1'): [
+                compoundpi.client.CompoundPiJobStatus(1, 'DONE', 1.0, ''),
+                compoundpi.client.CompoundPiJobStatus(2, 'FAILED', 0.25, 'Out of resources'),
+                ],
+            compoundpi.client.IPv4Address('192.168.0.2'): [],
+            }
+        l.assert_called_once_with('JOBS', None)
+        l.reset_mock()
+        l.return_value = {
+            compoundpi.client.IPv4Address('192.168.0.1'): 'FOO',
+            }
+        with pytest.raises(CompoundPiTransactionFailed):
+            client.jobs(['192.168.0.1'], 1)
+        l.assert_called_once_with('JOBS 1', ['192.168.0.1'])
+
 def test_client_capture_sync():
     with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
             patch('compoundpi.client.time.time', return_value=1000.0), \
@@ -855,6 +1629,122 @@ def test_client_capture_sync():
         client.capture(5, video_port=True, delay=2)
         l.assert_called_once_with('CAPTURE 5,1,,1002.0', None)
 
+def test_client_time_sync():
+    with patch('compoundpi.client.CompoundPiServerList.transact_iter') as l, \
+            patch('compoundpi.client.time.time') as now, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        l.side_effect = [
+            iter([(compoundpi.client.IPv4Address('192.168.0.1'), '1000.105000,1000.106000')]),
+            iter([(compoundpi.client.IPv4Address('192.168.0.1'), '1001.102000,1001.103000')]),
+            ]
+        now.side_effect = [1000.0, 1000.011, 1001.0, 1001.005]
+        client = compoundpi.client.CompoundPiClient()
+        result = client.time_sync(rounds=2)
+        assert l.call_count == 2
+        l.assert_called_with('TIME', None)
+        clock = result[compoundpi.client.IPv4Address('192.168.0.1')]
+        # The second sample has the shorter round-trip so it is kept
+        assert clock.offset == pytest.approx(0.1)
+        assert clock.delay == pytest.approx(0.004)
+        assert client.clocks == result
+
+def test_client_time_sync_invalid():
+    with patch('compoundpi.client.CompoundPiServerList.transact_iter') as l, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        l.return_value = iter([
+            (compoundpi.client.IPv4Address('192.168.0.1'), 'FOO'),
+            ])
+        client = compoundpi.client.CompoundPiClient()
+        with pytest.raises(CompoundPiTransactionFailed):
+            client.time_sync(rounds=1)
+        assert client.clocks == {}
+        with pytest.raises(ValueError):
+            client.time_sync(rounds=0)
+
+def test_client_capture_sync_clocks():
+    with patch('compoundpi.client.CompoundPiServerList.transact_many') as l, \
+            patch('compoundpi.client.time.time', return_value=1000.0), \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        l.return_value = {
+            compoundpi.client.IPv4Address('192.168.0.1'): None,
+            compoundpi.client.IPv4Address('192.168.0.2'): None,
+            }
+        client = compoundpi.client.CompoundPiClient()
+        client.clocks = {
+            compoundpi.client.IPv4Address('192.168.0.1'):
+                compoundpi.client.CompoundPiClock(0.25, 0.001),
+            }
+        client.capture(5, video_port=True, delay=2,
+                addresses=['192.168.0.1', '192.168.0.2'])
+        l.assert_called_once_with({
+            compoundpi.client.IPv4Address('192.168.0.1'): 'CAPTURE 5,1,,1002.25',
+            compoundpi.client.IPv4Address('192.168.0.2'): 'CAPTURE 5,1,,1002.0',
+            })
+
+def test_client_arm():
+    with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        l.return_value = {
+            compoundpi.client.IPv4Address('192.168.0.1'): 'JOB 1',
+            compoundpi.client.IPv4Address('192.168.0.2'): 'JOB 2',
+            }
+        client = compoundpi.client.CompoundPiClient()
+        job = client.arm(video_port=True)
+        l.assert_called_once_with('ARM 1,1,', None)
+        assert job.jobs == {
+            compoundpi.client.IPv4Address('192.168.0.1'): 1,
+            compoundpi.client.IPv4Address('192.168.0.2'): 2,
+            }
+        l.reset_mock()
+        client.disarm()
+        l.assert_called_once_with('ARM 0,0,', None)
+
+def test_client_fire():
+    def transact_effect(data, addresses):
+        if data == 'FIRE':
+            return {
+                compoundpi.client.IPv4Address('192.168.0.1'): 'JOB 1',
+                compoundpi.client.IPv4Address('192.168.0.2'): 'JOB 3',
+                }
+        return {
+            compoundpi.client.IPv4Address('192.168.0.1'): '1,DONE,1.000,DELAY 0.052100',
+            compoundpi.client.IPv4Address('192.168.0.2'): '3,DONE,1.000,DELAY 0.054300',
+            }
+    with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        l.side_effect = transact_effect
+        client = compoundpi.client.CompoundPiClient()
+        assert client.fire() == {
+            compoundpi.client.IPv4Address('192.168.0.1'): 0.0521,
+            compoundpi.client.IPv4Address('192.168.0.2'): 0.0543,
+            }
+        assert l.call_args_list[0] == call('FIRE', None)
+
+def test_client_fire_invalid():
+    with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        l.return_value = {
+            compoundpi.client.IPv4Address('192.168.0.1'): 'JOB 1',
+            compoundpi.client.IPv4Address('192.168.0.2'): 'FOO',
+            }
+        client = compoundpi.client.CompoundPiClient()
+        with pytest.raises(CompoundPiTransactionFailed):
+            client.fire()
+        l.assert_called_once_with('FIRE', None)
+
+def test_client_fire_no_delay():
+    def transact_effect(data, addresses):
+        if data == 'FIRE':
+            return {compoundpi.client.IPv4Address('192.168.0.1'): 'JOB 1'}
+        # The capture was disarmed before it was taken
+        return {compoundpi.client.IPv4Address('192.168.0.1'): '1,DONE,1.000,'}
+    with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        l.side_effect = transact_effect
+        client = compoundpi.client.CompoundPiClient()
+        with pytest.raises(CompoundPiTransactionFailed):
+            client.fire()
+
 def test_client_record_now():
     with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
             patch('compoundpi.client.CompoundPiDownloadServer'):
@@ -864,7 +1754,7 @@ def test_client_record_now():
             }
         client = compoundpi.client.CompoundPiClient()
         client.record(5)
-        l.assert_called_once_with('RECORD 5.0,h264,,,,0,', None)
+        l.assert_called_once_with('RECORD 5.0,h264,,,,0,,', None)
 
 def test_client_record_sync():
     with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
@@ -876,7 +1766,46 @@ def test_client_record_sync():
             }
         client = compoundpi.client.CompoundPiClient()
         client.record(5, format='mjpeg', delay=2)
-        l.assert_called_once_with('RECORD 5.0,mjpeg,,,,0,1002.0', None)
+        l.assert_called_once_with('RECORD 5.0,mjpeg,,,,0,1002.0,', None)
+
+def test_client_record_segmented():
+    with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        l.return_value = {
+            compoundpi.client.IPv4Address('192.168.0.1'): None,
+            compoundpi.client.IPv4Address('192.168.0.2'): None,
+            }
+        client = compoundpi.client.CompoundPiClient()
+        client.record(60, segment=10)
+        l.assert_called_once_with('RECORD 60.0,h264,,,,0,,10.0', None)
+
+def test_client_buffer():
+    with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        l.return_value = {
+            compoundpi.client.IPv4Address('192.168.0.1'): None,
+            compoundpi.client.IPv4Address('192.168.0.2'): None,
+            }
+        client = compoundpi.client.CompoundPiClient()
+        client.buffer(10, bitrate=5000000)
+        l.assert_called_once_with('BUFFER 10.0,,5000000,', None)
+        l.reset_mock()
+        client.buffer(0, addresses=['192.168.0.1'])
+        l.assert_called_once_with('BUFFER 0.0,,,', ['192.168.0.1'])
+
+def test_client_trigger():
+    with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        l.return_value = {
+            compoundpi.client.IPv4Address('192.168.0.1'): None,
+            compoundpi.client.IPv4Address('192.168.0.2'): None,
+            }
+        client = compoundpi.client.CompoundPiClient()
+        client.trigger()
+        l.assert_called_once_with('TRIGGER', None)
+        l.reset_mock()
+        client.trigger(5)
+        l.assert_called_once_with('TRIGGER 5.0', None)
 
 def test_client_list_ok():
     list_response = """\
@@ -900,6 +1829,39 @@ VIDEO,1,2000.0,2345678
             }
         l.assert_called_once_with('LIST', None)
 
+def test_client_list_requested():
+    with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        l.return_value = {
+            compoundpi.client.IPv4Address('192.168.0.1'):
+                'IMAGE,0,1000.0002,1234567,1000.0\nIMAGE,1,1000.5,1234567',
+            }
+        client = compoundpi.client.CompoundPiClient()
+        assert client.list() == {
+            compoundpi.client.IPv4Address('192.168.0.1'): [
+                compoundpi.client.CompoundPiFile(
+                    'IMAGE', 0, dt.datetime.fromtimestamp(1000.0002), 1234567,
+                    dt.datetime.fromtimestamp(1000.0)),
+                compoundpi.client.CompoundPiFile(
+                    'IMAGE', 1, dt.datetime.fromtimestamp(1000.5), 1234567),
+                ],
+            }
+
+def test_client_list_iter():
+    def transact_iter(data, addresses):
+        assert data == 'LIST'
+        assert addresses == ['192.168.0.1', '192.168.0.2']
+        yield compoundpi.client.IPv4Address('192.168.0.2'), 'IMAGE,0,1000.0,1234567'
+        yield compoundpi.client.IPv4Address('192.168.0.1'), ''
+    with patch('compoundpi.client.CompoundPiServerList.transact_iter', side_effect=transact_iter), \
+            patch('compoundpi.client.CompoundPiDownloadServer'):
+        client = compoundpi.client.CompoundPiClient()
+        assert list(client.list_iter(['192.168.0.1', '192.168.0.2'])) == [
+            (compoundpi.client.IPv4Address('192.168.0.2'), [
+                compoundpi.client.CompoundPiFile('IMAGE', 0, dt.datetime.fromtimestamp(1000.0), 1234567)]),
+            (compoundpi.client.IPv4Address('192.168.0.1'), []),
+            ]
+
 def test_client_list_bad():
     list_response = "FOO"
     with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
@@ -925,6 +1887,9 @@ def test_client_clear():
         client = compoundpi.client.CompoundPiClient()
         client.clear()
         l.assert_called_once_with('CLEAR', None)
+        l.reset_mock()
+        client.clear(['192.168.0.1'], 2)
+        l.assert_called_once_with('CLEAR 2', ['192.168.0.1'])
 
 def test_client_identify():
     with patch('compoundpi.client.CompoundPiServerList.transact') as l, \
@@ -949,7 +1914,7 @@ def test_client_download_ok():
         client._server.event = Mock()
         client._server.event.wait.return_value = True
         client.download('192.168.0.1', 0, io.BytesIO())
-        l.assert_called_once_with('SEND 0,5647', ['192.168.0.1'])
+        l.assert_called_once_with('SEND 0,5647,0,', ['192.168.0.1'])
 
 def test_client_download_timeout():
     def download_server_effect(bind, handler):
@@ -981,6 +1946,309 @@ def test_client_download_exception():
             client.download('192.168.0.1', 0, io.BytesIO())
             assert excinfo.value.args == ('Foo',)
 
+def test_client_download_resume():
+    def download_server_effect(bind, handler):
+        return Mock(**{'socket.getsockname.return_value': bind})
+    def transact_effect(data, addresses):
+        # Simulate a connection which drops after 3 bytes on the first
+        # attempt, then succeeds on the second
+        if data == 'SEND 0,5647,0,':
+            client._server.output.write(b'foo')
+            client._server.exception = CompoundPiSendTruncated(addresses[0])
+        else:
+            assert data == 'SEND 0,5647,3,'
+            client._server.output.write(b' bar')
+            client._server.exception = None
+        return {addresses[0]: None}
+    with patch('compoundpi.client.CompoundPiDownloadServer', side_effect=download_server_effect), \
+            patch('compoundpi.client.CompoundPiServerList.transact') as l:
+        l.side_effect = transact_effect
+        client = compoundpi.client.CompoundPiClient()
+        client._server.event = Mock()
+        client._server.event.wait.return_value = True
+        output = io.BytesIO()
+        with pytest.raises(CompoundPiSendTruncated):
+            client.download('192.168.0.1', 0, output)
+        assert output.getvalue() == b'foo'
+        client.download('192.168.0.1', 0, output)
+        assert output.getvalue() == b'foo bar'
+        assert client._journal == {}
+
+def test_client_download_retries():
+    def download_server_effect(bind, handler):
+        return Mock(**{'socket.getsockname.return_value': bind})
+    def transact_effect(data, addresses):
+        if data == 'SEND 0,5647,0,':
+            client._server.output.write(b'foo')
+            client._server.exception = CompoundPiSendTruncated(addresses[0])
+        else:
+            client._server.output.write(b' bar')
+            client._server.exception = None
+        return {addresses[0]: None}
+    with patch('compoundpi.client.CompoundPiDownloadServer', side_effect=download_server_effect), \
+            patch('compoundpi.client.CompoundPiServerList.transact') as l:
+        l.side_effect = transact_effect
+        client = compoundpi.client.CompoundPiClient()
+        client._server.event = Mock()
+        client._server.event.wait.return_value = True
+        output = io.BytesIO()
+        client.download('192.168.0.1', 0, output, retries=1)
+        assert output.getvalue() == b'foo bar'
+        assert l.call_args_list == [
+            call('SEND 0,5647,0,', ['192.168.0.1']),
+            call('SEND 0,5647,3,', ['192.168.0.1']),
+            ]
+
+def test_client_download_no_resume_fresh_output():
+    def download_server_effect(bind, handler):
+        return Mock(**{'socket.getsockname.return_value': bind})
+    with patch('compoundpi.client.CompoundPiDownloadServer', side_effect=download_server_effect), \
+            patch('compoundpi.client.CompoundPiServerList.transact') as l:
+        l.return_value = {
+            compoundpi.client.IPv4Address('192.168.0.1'): None,
+            }
+        client = compoundpi.client.CompoundPiClient()
+        client._server.event = Mock()
+        client._server.event.wait.return_value = True
+        client._journal[(compoundpi.client.IPv4Address('192.168.0.1'), 0)] = 3
+        client.download('192.168.0.1', 0, io.BytesIO())
+        l.assert_called_once_with('SEND 0,5647,0,', ['192.168.0.1'])
+
+def test_client_download_resume_existing():
+    def download_server_effect(bind, handler):
+        return Mock(**{'socket.getsockname.return_value': bind})
+    with patch('compoundpi.client.CompoundPiDownloadServer', side_effect=download_server_effect), \
+            patch('compoundpi.client.CompoundPiServerList.transact') as l:
+        l.return_value = {
+            compoundpi.client.IPv4Address('192.168.0.1'): None,
+            }
+        client = compoundpi.client.CompoundPiClient()
+        client._server.event = Mock()
+        client._server.event.wait.return_value = True
+        # Without a journal entry, existing content is only resumed on request
+        client.download('192.168.0.1', 0, io.BytesIO(b'foo'))
+        l.assert_called_once_with('SEND 0,5647,0,', ['192.168.0.1'])
+        l.reset_mock()
+        client.download('192.168.0.1', 0, io.BytesIO(b'foo'), resume=True)
+        l.assert_called_once_with('SEND 0,5647,3,', ['192.168.0.1'])
+
+def test_client_download_timeout_stops_handler():
+    def download_server_effect(bind, handler):
+        return Mock(**{'socket.getsockname.return_value': bind})
+    with patch('compoundpi.client.CompoundPiDownloadServer', side_effect=download_server_effect), \
+            patch('compoundpi.client.CompoundPiServerList.transact') as l:
+        l.return_value = {
+            compoundpi.client.IPv4Address('192.168.0.1'): None,
+            }
+        client = compoundpi.client.CompoundPiClient()
+        client._server.event = Mock()
+        client._server.event.wait.return_value = False
+        handler = Mock()
+        client._server.active = handler
+        with pytest.raises(CompoundPiSendTimeout):
+            client.download('192.168.0.1', 0, io.BytesIO())
+        # The handler still receiving the failed transfer must be stopped
+        # before the output can be reused
+        handler.connection.shutdown.assert_called_once_with(socket.SHUT_RDWR)
+        handler.finished.wait.assert_called_once_with()
+
+def test_client_clear_journal():
+    def download_server_effect(bind, handler):
+        return Mock(**{'socket.getsockname.return_value': bind})
+    with patch('compoundpi.client.CompoundPiDownloadServer', side_effect=download_server_effect), \
+            patch('compoundpi.client.CompoundPiServerList.transact') as l:
+        l.return_value = {}
+        client = compoundpi.client.CompoundPiClient()
+        client._journal[(compoundpi.client.IPv4Address('192.168.0.1'), 0)] = 3
+        client._journal[(compoundpi.client.IPv4Address('192.168.0.2'), 0)] = 3
+        client.clear(['192.168.0.1'])
+        assert client._journal == {
+            (compoundpi.client.IPv4Address('192.168.0.2'), 0): 3}
+        client.clear()
+        assert client._journal == {}
+
+def test_client_download_handler_offset():
+    server = MagicMock(
+        output=io.BytesIO(b'foo'),
+        progress=MagicMock(),
+        event=Mock(),
+        exception=None,
+        source='client',
+        )
+    server.output.seek(3)
+    request = MagicMock(
+        makefile=Mock(side_effect=lambda mode, bufsize: io.BytesIO(b'\x00\x00\x00\x00\x00\x00\x00\x04 bar'))
+        )
+    compoundpi.client.CompoundPiDownloadHandler(request, ('client', 5647), server)
+    server.progress.start.assert_called_once_with(4)
+    server.progress.update.assert_called_with(4)
+    assert server.exception is None
+    assert server.output.getvalue() == b'foo bar'
+
+def test_client_download_many():
+    def download_server_effect(bind, handler):
+        return Mock(**{'socket.getsockname.return_value': bind})
+    with patch('compoundpi.client.CompoundPiDownloadServer', side_effect=download_server_effect), \
+            patch('compoundpi.client.CompoundPiServerList.transact') as l:
+        l.return_value = {
+            compoundpi.client.IPv4Address('192.168.0.1'): None,
+            }
+        client = compoundpi.client.CompoundPiClient()
+        client._server.event = Mock()
+        client._server.event.wait.return_value = True
+        f = compoundpi.client.CompoundPiFile(
+            'IMAGE', 0, dt.datetime.fromtimestamp(100.0), 3)
+        client._server.received = [f]
+        def transact_effect(data, addresses):
+            client._server.received.append(f)
+            return {compoundpi.client.IPv4Address('192.168.0.1'): None}
+        l.side_effect = transact_effect
+        assert client.download_many('192.168.0.1', Mock()) == [f]
+        l.assert_called_once_with('SENDALL 5647,0,', ['192.168.0.1'])
+
+def test_client_download_many_truncated():
+    def download_server_effect(bind, handler):
+        return Mock(**{'socket.getsockname.return_value': bind})
+    def transact_effect(data, addresses):
+        f = compoundpi.client.CompoundPiFile(
+            'IMAGE', 1, dt.datetime.fromtimestamp(100.0), 10)
+        client._server.partial = (f, 3)
+        client._server.exception = CompoundPiSendTruncated(addresses[0])
+        return {compoundpi.client.IPv4Address('192.168.0.1'): None}
+    with patch('compoundpi.client.CompoundPiDownloadServer', side_effect=download_server_effect), \
+            patch('compoundpi.client.CompoundPiServerList.transact') as l:
+        l.side_effect = transact_effect
+        client = compoundpi.client.CompoundPiClient()
+        client._server.event = Mock()
+        client._server.event.wait.return_value = True
+        with pytest.raises(CompoundPiSendTruncated):
+            client.download_many('192.168.0.1', Mock(), 1, 2)
+        l.assert_called_once_with('SENDALL 5647,1,2', ['192.168.0.1'])
+        assert client._journal == {
+            (compoundpi.client.IPv4Address('192.168.0.1'), 1): 3}
+
+def test_client_download_many_handler():
+    outputs = {}
+    def factory(f):
+        outputs[f] = io.BytesIO()
+        return outputs[f]
+    server = MagicMock(
+        progress=MagicMock(),
+        event=Mock(),
+        exception=None,
+        source='client',
+        output=None,
+        factory=factory,
+        received=[],
+        partial=None,
+        )
+    data = (
+        struct.pack(b'>LQ', 2, 10) +
+        struct.pack(b'>L8sdQ', 0, b'IMAGE   ', 100.0, 3) + b'foo' +
+        struct.pack(b'>L8sdQ', 1, b'VIDEO   ', 200.0, 7) + b'bar baz'
+        )
+    request = MagicMock(
+        makefile=Mock(side_effect=lambda mode, bufsize: io.BytesIO(data))
+        )
+    compoundpi.client.CompoundPiDownloadHandler(request, ('client', 5647), server)
+    assert server.exception is None
+    server.event.set.assert_called_once_with()
+    server.progress.start.assert_called_once_with(10)
+    server.progress.update.assert_called_with(10)
+    file1 = compoundpi.client.CompoundPiFile(
+        'IMAGE', 0, dt.datetime.fromtimestamp(100.0), 3)
+    file2 = compoundpi.client.CompoundPiFile(
+        'VIDEO', 1, dt.datetime.fromtimestamp(200.0), 7)
+    assert server.received == [file1, file2]
+    assert outputs[file1].getvalue() == b'foo'
+    assert outputs[file2].getvalue() == b'bar baz'
+
+def test_client_download_many_handler_truncated():
+    server = MagicMock(
+        progress=MagicMock(),
+        event=Mock(),
+        exception=None,
+        source='client',
+        output=None,
+        factory=lambda f: io.BytesIO(),
+        received=[],
+        partial=None,
+        )
+    data = (
+        struct.pack(b'>LQ', 1, 7) +
+        struct.pack(b'>L8sdQ', 0, b'VIDEO   ', 200.0, 7) + b'bar'
+        )
+    request = MagicMock(
+        makefile=Mock(side_effect=lambda mode, bufsize: io.BytesIO(data))
+        )
+    compoundpi.client.CompoundPiDownloadHandler(request, ('client', 5647), server)
+    assert isinstance(server.exception, CompoundPiSendTruncated)
+    assert server.received == []
+    assert server.partial == (compoundpi.client.CompoundPiFile(
+        'VIDEO', 0, dt.datetime.fromtimestamp(200.0), 7), 3)
+
+def test_client_transfers():
+    def download_server_effect(bind, handler):
+        return Mock(**{'socket.getsockname.return_value': bind})
+    with patch('compoundpi.client.CompoundPiDownloadServer', side_effect=download_server_effect), \
+            patch('compoundpi.client.CompoundPiServerList.transact') as l:
+        l.return_value = {
+            compoundpi.client.IPv4Address('192.168.0.1'): '1,DONE,\n2,FAILED,Connection refused',
+            compoundpi.client.IPv4Address('192.168.0.2'): '',
+            }
+        client = compoundpi.client.CompoundPiClient()
+        assert client.transfers() == {
+            compoundpi.client.IPv4Address('192.168.0.1'): [
+                compoundpi.client.CompoundPiTransfer(1, 'DONE', ''),
+                compoundpi.client.CompoundPiTransfer(2, 'FAILED', 'Connection refused'),
+                ],
+            compoundpi.client.IPv4Address('192.168.0.2'): [],
+            }
+        l.assert_called_once_with('TRANSFERS', None)
+        l.reset_mock()
+        l.return_value = {
+            compoundpi.client.IPv4Address('192.168.0.1'): 'FOO',
+            }
+        with pytest.raises(CompoundPiTransactionFailed):
+            client.transfers(['192.168.0.1'], 1)
+        l.assert_called_once_with('TRANSFERS 1', ['192.168.0.1'])
+
+def test_client_download_failed_transfer():
+    def download_server_effect(bind, handler):
+        return Mock(**{'socket.getsockname.return_value': bind})
+    def transact_effect(data, addresses):
+        if data.startswith('SEND'):
+            return {compoundpi.client.IPv4Address('192.168.0.1'): 'TRANSFER 5'}
+        assert data == 'TRANSFERS 5'
+        return {compoundpi.client.IPv4Address('192.168.0.1'): '5,FAILED,Connection refused'}
+    with patch('compoundpi.client.CompoundPiDownloadServer', side_effect=download_server_effect), \
+            patch('compoundpi.client.CompoundPiServerList.transact') as l:
+        l.side_effect = transact_effect
+        client = compoundpi.client.CompoundPiClient()
+        client._server.event = Mock()
+        client._server.event.wait.return_value = False
+        with pytest.raises(CompoundPiServerError) as excinfo:
+            client.download('192.168.0.1', 0, io.BytesIO())
+        assert 'Connection refused' in str(excinfo.value)
+
+def test_client_download_slow_transfer():
+    def download_server_effect(bind, handler):
+        return Mock(**{'socket.getsockname.return_value': bind})
+    def wait_effect(timeout):
+        # Simulate a transfer that takes longer than the timeout but which
+        # continues to make progress
+        client._server.activity += 1
+        return client._server.activity > 2
+    with patch('compoundpi.client.CompoundPiDownloadServer', side_effect=download_server_effect), \
+            patch('compoundpi.client.CompoundPiServerList.transact') as l:
+        l.return_value = {compoundpi.client.IPv4Address('192.168.0.1'): 'TRANSFER 1'}
+        client = compoundpi.client.CompoundPiClient()
+        client._server.event = Mock()
+        client._server.event.wait.side_effect = wait_effect
+        client.download('192.168.0.1', 0, io.BytesIO())
+        assert client._server.event.wait.call_count == 3
+        l.assert_called_once_with('SEND 0,5647,0,', ['192.168.0.1'])
+
 def test_client_download_handler():
     server = MagicMock(
         output=io.BytesIO(),
@@ -990,13 +2258,14 @@ def test_client_download_handler():
         source='client',
         )
     request = MagicMock(
-        makefile=Mock(side_effect=lambda mode, bufsize: io.BytesIO(b'\x00\x00\x00\x07foo bar'))
+        makefile=Mock(side_effect=lambda mode, bufsize: io.BytesIO(b'\x00\x00\x00\x00\x00\x00\x00\x07foo bar'))
         )
     compoundpi.client.CompoundPiDownloadHandler(request, ('client', 5647), server)
     server.event.set.assert_called_once_with()
     server.progress.start.assert_called_once_with(7)
     server.progress.finish.assert_called_once_with()
     assert server.output.getvalue() == b'foo bar'
+    assert server.active is None
 
 def test_client_download_bad_client():
     server = MagicMock(
@@ -1007,7 +2276,7 @@ def test_client_download_bad_client():
         source='bad_client',
         )
     request = MagicMock(
-        makefile=Mock(side_effect=lambda mode, bufsize: io.BytesIO(b'\x00\x00\x00\x07foo bar'))
+        makefile=Mock(side_effect=lambda mode, bufsize: io.BytesIO(b'\x00\x00\x00\x00\x00\x00\x00\x07foo bar'))
         )
     with warnings.catch_warnings(record=True) as w:
         compoundpi.client.CompoundPiDownloadHandler(request, ('client', 5647), server)
@@ -1022,10 +2291,26 @@ def test_client_download_truncated():
         source='client',
         )
     request = MagicMock(
-        makefile=Mock(side_effect=lambda mode, bufsize: io.BytesIO(b'\x00\x00\x00\x10foo bar'))
+        makefile=Mock(side_effect=lambda mode, bufsize: io.BytesIO(b'\x00\x00\x00\x00\x00\x00\x00\x10foo bar'))
+        )
+    compoundpi.client.CompoundPiDownloadHandler(request, ('client', 5647), server)
+    assert isinstance(server.exception, CompoundPiSendTruncated)
+
+def test_client_download_truncated_header():
+    server = MagicMock(
+        output=io.BytesIO(),
+        progress=MagicMock(),
+        event=Mock(),
+        exception=None,
+        source='client',
+        )
+    request = MagicMock(
+        makefile=Mock(side_effect=lambda mode, bufsize: io.BytesIO(b'\x00\x00\x00'))
         )
     compoundpi.client.CompoundPiDownloadHandler(request, ('client', 5647), server)
+    # The client is woken immediately rather than waiting for the timeout
     assert isinstance(server.exception, CompoundPiSendTruncated)
+    server.event.set.assert_called_once_with()
 
 def test_client_progress_defaults():
     m = MagicMock()
@@ -31,11 +31,13 @@ import sys
 import os
 import io
 import time
+import struct
 import signal
+import threading
 from fractions import Fraction
 
 import pytest
-from mock import Mock, MagicMock, patch, sentinel, call
+from mock import Mock, MagicMock, patch, sentinel, call, ANY
 
 # Several of the modules that CompoundPiServer relies upon are Raspberry Pi
 # specific (can't be installed on other platforms) so we need to mock them
@@ -82,6 +84,14 @@ with patch.dict('sys.modules', {
             m.return_value.gr_gid = 0
             assert compoundpi.server.group('wheel') == 0
 
+    def test_size():
+        assert compoundpi.server.size('1000') == 1000
+        assert compoundpi.server.size('4k') == 4096
+        assert compoundpi.server.size('64M') == 64 * 1024 ** 2
+        assert compoundpi.server.size('1G') == 1024 ** 3
+        with pytest.raises(ValueError):
+            compoundpi.server.size('foo')
+
     def test_server_showwarning():
         with patch('compoundpi.server.logging.warning') as m:
             app = compoundpi.server.CompoundPiServer()
@@ -165,7 +175,7 @@ with patch.dict('sys.modules', {
         app.server.shutdown.assert_called_once_with()
 
     def test_handler_bad_request():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'FOO', socket), ('localhost', 1), MagicMock(seqno=2))
@@ -173,7 +183,7 @@ with patch.dict('sys.modules', {
                 socket, ('localhost', 1), b'0 ERROR\nUnable to parse request')
 
     def test_handler_unknown_command():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'3 FOO', socket), ('localhost', 1),
@@ -182,7 +192,7 @@ with patch.dict('sys.modules', {
                 socket, ('localhost', 1), b'3 ERROR\nUnknown command FOO')
 
     def test_handler_unknown_command_with_params():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'3 FOO 1 2 3', socket), ('localhost', 1),
@@ -191,7 +201,7 @@ with patch.dict('sys.modules', {
                 socket, ('localhost', 1), b'3 ERROR\nUnknown command FOO')
 
     def test_handler_invalid_client():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             server = MagicMock()
             server.client_address = ('foo', 1)
@@ -202,7 +212,7 @@ with patch.dict('sys.modules', {
                 b'0 ERROR\nlocalhost: Invalid client or protocol error')
 
     def test_handler_stale_seqno():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             compoundpi.server.CompoundPiServerProtocol(
                     (b'0 LIST', socket), ('localhost', 1),
@@ -211,8 +221,158 @@ with patch.dict('sys.modules', {
                 socket, ('localhost', 1),
                 b'0 ERROR\nlocalhost: Stale sequence number 0')
 
+    def test_handler_seqno_window():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            server = MagicMock(
+                client_address=('localhost', 1), seqno=1, skipped=set(), files=[])
+            # Commands may arrive out of order within the window
+            compoundpi.server.CompoundPiServerProtocol(
+                    (b'4 LIST', socket), ('localhost', 1), server)
+            assert server.seqno == 4
+            assert server.skipped == {2, 3}
+            compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 LIST', socket), ('localhost', 1), server)
+            assert server.seqno == 4
+            assert server.skipped == {3}
+            m.assert_called_with(socket, ('localhost', 1), b'2 OK\n')
+            # But each is only executed once
+            compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 CLEAR', socket), ('localhost', 1), server)
+            m.assert_called_with(
+                socket, ('localhost', 1),
+                b'2 ERROR\nlocalhost: Stale sequence number 2')
+            # And sequence numbers which fall out of the window are stale
+            compoundpi.server.CompoundPiServerProtocol(
+                    (b'40 LIST', socket), ('localhost', 1), server)
+            assert server.skipped == set(range(9, 40))
+            compoundpi.server.CompoundPiServerProtocol(
+                    (b'3 LIST', socket), ('localhost', 1), server)
+            m.assert_called_with(
+                socket, ('localhost', 1),
+                b'3 ERROR\nlocalhost: Stale sequence number 3')
+
+    def test_handler_targets():
+        with patch('compoundpi.server.NetworkTransmission') as m, \
+                patch('compoundpi.server.socket.socket') as s:
+            s.return_value.getsockname.return_value = ('192.168.0.11', 5647)
+            socket = Mock()
+            server = MagicMock(client_address=('192.168.0.1', 1), seqno=1, files=[])
+            compoundpi.server.CompoundPiServerProtocol(
+                    (b'2@192.168.0.10/13 LIST', socket), ('192.168.0.1', 1), server)
+            s.return_value.connect.assert_called_once_with(('192.168.0.1', 1))
+            m.assert_called_once_with(socket, ('192.168.0.1', 1), b'2 OK\n')
+            assert server.seqno == 2
+            m.reset_mock()
+            compoundpi.server.CompoundPiServerProtocol(
+                    (b'3@192.168.0.12/3 LIST', socket), ('192.168.0.1', 1), server)
+            assert not m.called
+            assert server.seqno == 2
+
+    def test_handler_replay_response():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            file1 = compoundpi.server.CompoundPiFile('IMAGE', 100.0)
+            file1.stream.write(b'\x10' * 10)
+            server = MagicMock(
+                client_address=('localhost', 1), seqno=1, files=[file1],
+                responses=compoundpi.server.CompoundPiResponseCache())
+            compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 LIST', socket), ('localhost', 1), server)
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'2 OK\nIMAGE,0,100.000000,10')
+            assert server.seqno == 2
+            m.reset_mock()
+            # A retransmission of the same command gets the same response
+            # without the command being executed again
+            server.files = []
+            socket.reset_mock()
+            compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 LIST', socket), ('localhost', 1), server)
+            assert not m.called
+            socket.sendto.assert_any_call(
+                b'2 OK\nIMAGE,0,100.000000,10', ('localhost', 1))
+            # A different command with the same sequence number is still
+            # rejected as stale
+            compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 CLEAR', socket), ('localhost', 1), server)
+            m.assert_called_once_with(
+                socket, ('localhost', 1),
+                b'2 ERROR\nlocalhost: Stale sequence number 2')
+
+    def test_list_handler_fragmented():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            files = []
+            for i in range(40):
+                f = compoundpi.server.CompoundPiFile('IMAGE', 100.0 + i)
+                f.stream.write(b'\x10' * 1000)
+                files.append(f)
+            server = MagicMock(
+                client_address=('localhost', 1), seqno=1, files=files,
+                responses=compoundpi.server.CompoundPiResponseCache())
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 LIST', socket), ('localhost', 1), server)
+            datagrams = [c[0][2] for c in m.call_args_list]
+            assert len(datagrams) > 1
+            assert all(len(d) <= 512 for d in datagrams)
+            data = b''
+            for i, datagram in enumerate(datagrams):
+                header, body = datagram.split(b'\n', 1)
+                assert header == ('2.%d/%d OK' % (i, len(datagrams))).encode('ascii')
+                data += body
+            assert data == '\n'.join(
+                'IMAGE,%d,%f,1000' % (i, 100.0 + i) for i in range(40)
+                ).encode('ascii')
+            assert server.responders.__setitem__.call_args_list == [
+                call((('localhost', 1), 2, i), m.return_value)
+                for i in range(len(datagrams))
+                ]
+            assert server.responses[(('localhost', 1), 2, '2 LIST')] == datagrams
+
+    def test_fragment_utf8():
+        handler = compoundpi.server.CompoundPiServerProtocol.__new__(
+                compoundpi.server.CompoundPiServerProtocol)
+        data = 'ERROR\n' + '\u00e9' * 600
+        datagrams = handler.fragment_response(1, data)
+        assert len(datagrams) == 3
+        assert b''.join(
+            d.split(b'\n', 1)[1] for f, d in datagrams
+            ).decode('utf-8') == '\u00e9' * 600
+
+    def test_ack_fragment():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            server = MagicMock()
+            server.responders = {
+                (('localhost', 1), 2, 0): Mock(),
+                (('localhost', 1), 2, 1): Mock(),
+                }
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2.1 ACK', socket), ('localhost', 1), server)
+            assert list(server.responders.keys()) == [(('localhost', 1), 2, 0)]
+            assert not m.called
+
+    def test_response_cache():
+        with patch('compoundpi.server.time.time', return_value=1000.0) as now:
+            cache = compoundpi.server.CompoundPiResponseCache(count=2, age=10)
+            cache['a'] = b'1'
+            cache['b'] = b'2'
+            assert len(cache) == 2
+            cache['c'] = b'3'
+            assert len(cache) == 2
+            assert 'a' not in cache
+            assert cache['b'] == b'2'
+            now.return_value = 1005.0
+            cache['b'] = b'4'
+            now.return_value = 1011.0
+            assert 'c' not in cache
+            assert cache['b'] == b'4'
+            cache.clear()
+            assert len(cache) == 0
+
     def test_ack_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             responder = Mock()
             server = MagicMock()
@@ -222,8 +382,89 @@ with patch.dict('sys.modules', {
             assert responder.terminate == True
             assert responder.join.called_once_with()
 
+    def test_network_scheduler():
+        # The clock is patched and the background thread isn't started; the
+        # scheduler is driven by calling _process directly
+        with patch('compoundpi.common.time.time') as now, \
+                patch('compoundpi.common.threading.Thread'):
+            now.return_value = 1000.0
+            socket = Mock()
+            scheduler = compoundpi.common.NetworkScheduler()
+            scheduler['a'] = compoundpi.common.NetworkTransmission(
+                    socket, ('localhost', 1), b'0 OK\n',
+                    timeout=0.2, interval=0.01)
+            scheduler['b'] = compoundpi.common.NetworkTransmission(
+                    socket, ('localhost', 2), b'1 OK\n',
+                    timeout=10, interval=0.01)
+            assert len(scheduler) == 2
+            assert socket.sendto.call_args_list == [
+                    call(b'0 OK\n', ('localhost', 1)),
+                    call(b'1 OK\n', ('localhost', 2)),
+                    ]
+            # Re-transmissions are never scheduled sooner than half the
+            # interval after a send
+            for when, order, key, transmission in scheduler._heap:
+                assert 1000.005 <= when <= 1000.01
+            with scheduler._lock:
+                assert scheduler._process(1000.0) >= 1000.005
+                assert scheduler.retransmits == 0
+                scheduler._process(1000.1)
+                assert scheduler.retransmits == 2
+            b = scheduler.pop('b')
+            assert b.terminate
+            assert 'b' not in scheduler
+            assert scheduler.pop('b', None) is None
+            with pytest.raises(KeyError):
+                del scheduler['b']
+            with scheduler._lock:
+                assert scheduler._process(1000.3) is None
+            assert len(scheduler) == 0
+            assert scheduler.acked == 1
+            assert scheduler.expired == 1
+            assert socket.sendto.call_count == scheduler.retransmits + 2
+            scheduler.close()
+
+    def test_network_scheduler_replace():
+        with patch('compoundpi.common.time.time') as now, \
+                patch('compoundpi.common.threading.Thread'):
+            now.return_value = 1000.0
+            socket = Mock()
+            scheduler = compoundpi.common.NetworkScheduler()
+            scheduler['a'] = compoundpi.common.NetworkTransmission(
+                    socket, ('localhost', 1), b'0 OK\n', interval=0.01)
+            scheduler['a'] = compoundpi.common.NetworkTransmission(
+                    socket, ('localhost', 1), b'0 ERROR\nfoo', interval=0.01)
+            with scheduler._lock:
+                scheduler._process(1000.1)
+            assert len(scheduler) == 1
+            assert socket.sendto.call_args_list.count(
+                    call(b'0 OK\n', ('localhost', 1))) == 1
+            assert socket.sendto.call_args_list.count(
+                    call(b'0 ERROR\nfoo', ('localhost', 1))) == 2
+            scheduler.close()
+            assert len(scheduler) == 0
+
+    def test_send_response_scheduled():
+        socket = Mock()
+        server = MagicMock(
+            client_address=('localhost', 1), client_timestamp=0.0,
+            responders=compoundpi.common.NetworkScheduler())
+        try:
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'0 HELLO 1000.0', socket), ('localhost', 1), server)
+            assert (('localhost', 1), 0) in server.responders
+            socket.sendto.assert_any_call(
+                    b'0 OK\nVERSION %s' % compoundpi.__version__.encode('ascii'),
+                    ('localhost', 1))
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'0 ACK', socket), ('localhost', 1), server)
+            assert len(server.responders) == 0
+            assert server.responders.acked == 1
+        finally:
+            server.responders.close()
+
     def test_hello_handler_stale_time():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'0 HELLO 1000.0', socket), ('localhost', 1),
@@ -235,7 +476,7 @@ with patch.dict('sys.modules', {
                 b'0 ERROR\nlocalhost: Stale client time 1000.000000')
 
     def test_hello_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             server = MagicMock()
             server.client_address = None
@@ -249,7 +490,7 @@ with patch.dict('sys.modules', {
             assert server.seqno == 0
 
     def test_blink_thread():
-        with patch('compoundpi.server.NetworkRepeater') as m, \
+        with patch('compoundpi.server.NetworkTransmission') as m, \
                 patch('compoundpi.server.time.sleep') as sleep:
             server = MagicMock()
             handler = compoundpi.server.CompoundPiServerProtocol(
@@ -261,7 +502,7 @@ with patch.dict('sys.modules', {
             assert server.camera.led == True
 
     def test_blink_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m, \
+        with patch('compoundpi.server.NetworkTransmission') as m, \
                 patch('threading.Thread') as thread:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
@@ -272,7 +513,7 @@ with patch.dict('sys.modules', {
             assert handler.server.seqno == 1
 
     def test_status_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m, \
+        with patch('compoundpi.server.NetworkTransmission') as m, \
                 patch.object(compoundpi.server.time, 'time') as now:
             socket = Mock()
             camera = Mock(
@@ -311,7 +552,7 @@ with patch.dict('sys.modules', {
             assert handler.server.seqno == 2
 
     def test_resolution_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 RESOLUTION 1920,1080', socket), ('localhost', 1),
@@ -321,7 +562,7 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.resolution == (1920, 1080)
 
     def test_framerate_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 FRAMERATE 30/2', socket), ('localhost', 1),
@@ -331,7 +572,7 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.framerate == 15
 
     def test_awb_handler_auto():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 AWB auto,1.0,1.0', socket), ('localhost', 1),
@@ -341,7 +582,7 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.awb_mode == 'auto'
 
     def test_awb_handler_manual():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 AWB off,1.5,1.3', socket), ('localhost', 1),
@@ -352,7 +593,7 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.awb_gains == (Fraction(3, 2), Fraction(13, 10))
 
     def test_agc_handler_auto():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 AGC auto', socket), ('localhost', 1),
@@ -362,7 +603,7 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.exposure_mode == 'auto'
 
     def test_agc_handler_manual():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 AGC off', socket), ('localhost', 1),
@@ -372,7 +613,7 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.exposure_mode == 'off'
 
     def test_exposure_handler_auto():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 EXPOSURE auto,1000.0', socket), ('localhost', 1),
@@ -382,7 +623,7 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.shutter_speed == 0
 
     def test_exposure_handler_manual():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 EXPOSURE off,1000.0', socket), ('localhost', 1),
@@ -392,7 +633,7 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.shutter_speed == 1000000
 
     def test_metering_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 METERING spot', socket), ('localhost', 1),
@@ -402,7 +643,7 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.meter_mode == 'spot'
 
     def test_iso_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 ISO 400', socket), ('localhost', 1),
@@ -412,7 +653,7 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.iso == 400
 
     def test_brightness_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 BRIGHTNESS 50', socket), ('localhost', 1),
@@ -422,7 +663,7 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.brightness == 50
 
     def test_contrast_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 CONTRAST 25', socket), ('localhost', 1),
@@ -432,7 +673,7 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.contrast == 25
 
     def test_saturation_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 SATURATION 15', socket), ('localhost', 1),
@@ -442,7 +683,7 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.saturation == 15
 
     def test_ev_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 EV -6', socket), ('localhost', 1),
@@ -452,7 +693,7 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.exposure_compensation == -6
 
     def test_denoise_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 DENOISE 0', socket), ('localhost', 1),
@@ -463,7 +704,7 @@ with patch.dict('sys.modules', {
             assert not handler.server.camera.video_denoise
 
     def test_flip_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 FLIP 1,0', socket), ('localhost', 1),
@@ -473,8 +714,40 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.hflip == True
             assert handler.server.camera.vflip == False
 
+    def test_configure_handler():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            server = MagicMock(client_address=('localhost', 1), seqno=1)
+            server.camera.resolution = (1280, 720)
+            server.camera.exposure_speed = 20000
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 CONFIGURE 1280,720,30,off,3/2,13/10,off,off,,100,,,,,,1,0,',
+                        socket), ('localhost', 1), server)
+            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\n')
+            assert handler.server.seqno == 2
+            # The resolution is unchanged so the camera isn't reset
+            assert handler.server.camera.resolution == (1280, 720)
+            assert handler.server.camera.framerate == 30
+            assert handler.server.camera.awb_mode == 'off'
+            assert handler.server.camera.awb_gains == (Fraction(3, 2), Fraction(13, 10))
+            assert handler.server.camera.exposure_mode == 'off'
+            assert handler.server.camera.shutter_speed == 20000
+            assert handler.server.camera.iso == 100
+            assert handler.server.camera.hflip == True
+            assert handler.server.camera.vflip == False
+
+    def test_configure_handler_invalid():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 CONFIGURE 1280', socket), ('localhost', 1),
+                    MagicMock(client_address=('localhost', 1), seqno=1))
+            m.assert_called_once_with(
+                    socket, ('localhost', 1),
+                    b'2 ERROR\nWidth and height must be specified together')
+
     def test_image_stream_generator():
-        with patch('compoundpi.server.NetworkRepeater') as m, \
+        with patch('compoundpi.server.NetworkTransmission') as m, \
                 patch('compoundpi.server.time.time', return_value=100.0):
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 ACK', Mock()), ('localhost', 1),
@@ -493,14 +766,18 @@ with patch.dict('sys.modules', {
             assert handler.server.files[1].stream is streams[1]
 
     def test_capture_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m, \
+        with patch('compoundpi.server.NetworkTransmission') as m, \
                 patch('compoundpi.server.CompoundPiServerProtocol.image_stream_generator',
                         return_value=sentinel.iterator):
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 CAPTURE 1,1', socket), ('localhost', 1),
-                    MagicMock(client_address=('localhost', 1), seqno=1))
-            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\n')
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1,
+                        jobs=compoundpi.server.CompoundPiJobQueue()))
+            handler.server.jobs.close()
+            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\nJOB 1')
+            assert handler.server.jobs.status() == [(1, 'DONE', 1.0, '')]
             handler.server.camera.capture_sequence.assert_called_once_with(
                     sentinel.iterator, format='jpeg', use_video_port=True,
                     burst=False, quality=85)
@@ -508,17 +785,26 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.led == True
 
     def test_capture_handler_with_sync():
-        with patch('compoundpi.server.NetworkRepeater') as m, \
+        with patch('compoundpi.server.NetworkTransmission') as m, \
                 patch('compoundpi.server.time.time', return_value=1000.0), \
                 patch('compoundpi.server.time.sleep') as sleep, \
+                patch('compoundpi.server.monotonic',
+                        side_effect=[10.0, 59.998, 59.999, 60.0]) as mono, \
                 patch('compoundpi.server.CompoundPiServerProtocol.image_stream_generator',
-                        return_value=sentinel.iterator):
+                        return_value=sentinel.iterator) as gen:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 CAPTURE 1,0,95,1050.0', socket), ('localhost', 1),
-                    MagicMock(client_address=('localhost', 1), seqno=1))
-            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\n')
-            sleep.assert_called_once_with(50.0)
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1,
+                        jobs=compoundpi.server.CompoundPiJobQueue()))
+            handler.server.jobs.close()
+            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\nJOB 1')
+            # Sleep until shortly before the sync time, then spin
+            sleep.assert_called_once_with(
+                pytest.approx(50.0 - handler.sync_spin))
+            assert mono.call_count == 4
+            gen.assert_called_once_with(1, ANY, 1050.0)
             handler.server.camera.capture_sequence.assert_called_once_with(
                     sentinel.iterator, format='jpeg',
                     use_video_port=False, burst=True, quality=95)
@@ -526,7 +812,7 @@ with patch.dict('sys.modules', {
             assert handler.server.camera.led == True
 
     def test_capture_handler_past_sync():
-        with patch('compoundpi.server.NetworkRepeater') as m, \
+        with patch('compoundpi.server.NetworkTransmission') as m, \
                 patch('compoundpi.server.time.time', return_value=1000.0):
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
@@ -535,47 +821,173 @@ with patch.dict('sys.modules', {
             m.assert_called_once_with(
                 socket, ('localhost', 1), b'2 ERROR\nSync time in past')
 
+    def armed_server():
+        server = MagicMock(
+            client_address=('localhost', 1), seqno=1, files=[], armed=None,
+            jobs=compoundpi.server.CompoundPiJobQueue())
+        def capture_sequence(outputs, **kwargs):
+            for output in outputs:
+                output.write(b'foo')
+        server.camera.capture_sequence.side_effect = capture_sequence
+        return server
+
+    def wait_armed(server):
+        for i in range(100):
+            if server.armed.ready:
+                break
+            time.sleep(0.01)
+        assert server.armed.ready
+
+    def test_arm_fire_handler():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            server = armed_server()
+            exposure_mode = server.camera.exposure_mode
+            compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 ARM 2,1', socket), ('localhost', 1), server)
+            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\nJOB 1')
+            wait_armed(server)
+            assert server.camera.exposure_mode == 'off'
+            assert server.camera.awb_mode == 'off'
+            assert server.files == []
+            m.reset_mock()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'3 FIRE', socket), ('localhost', 1), server)
+            # The response is sent without waiting for the capture
+            m.assert_called_once_with(socket, ('localhost', 1), b'3 OK\nJOB 1')
+            server.jobs.close()
+            [(job_id, state, progress, message)] = server.jobs.status()
+            assert (job_id, state, progress) == (1, 'DONE', 1.0)
+            assert message.startswith('DELAY ')
+            # The delay is measured from the command's arrival, which is also
+            # reported as the first file's requested time
+            assert server.files[0].requested == handler.received
+            assert float(message.split(' ')[1]) == pytest.approx(
+                server.files[0].timestamp - handler.received, abs=1e-6)
+            assert server.files[1].requested is None
+            server.camera.capture_sequence.assert_called_once_with(
+                    ANY, format='jpeg', quality=85, use_video_port=True,
+                    burst=False)
+            assert [f.filetype for f in server.files] == ['IMAGE', 'IMAGE']
+            assert server.files[0].stream.getvalue() == b'foo'
+            assert server.camera.exposure_mode == exposure_mode
+            assert server.camera.led == True
+            assert server.armed is None
+
+    def test_arm_handler_already_armed():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 ARM', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1,
+                        armed=compoundpi.server.CompoundPiArmedCapture(1)))
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'2 ERROR\nCapture already armed')
+
+    def test_disarm_handler():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            server = armed_server()
+            compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 ARM', socket), ('localhost', 1), server)
+            wait_armed(server)
+            m.reset_mock()
+            compoundpi.server.CompoundPiServerProtocol(
+                    (b'3 ARM 0', socket), ('localhost', 1), server)
+            server.jobs.close()
+            m.assert_called_once_with(socket, ('localhost', 1), b'3 OK\n')
+            assert server.jobs.status() == [(1, 'DONE', 1.0, '')]
+            assert server.files == []
+            assert server.armed is None
+
+    def test_fire_handler_not_armed():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 FIRE', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1, armed=None))
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'2 ERROR\nCapture not armed')
+
     def test_record_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 RECORD 5,mjpeg', socket), ('localhost', 1),
                     MagicMock(
-                        client_address=('localhost', 1), seqno=1, files=[]))
-            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\n')
+                        client_address=('localhost', 1), seqno=1, files=[],
+                        jobs=compoundpi.server.CompoundPiJobQueue()))
+            handler.server.jobs.close()
+            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\nJOB 1')
             assert handler.server.seqno == 2
             assert handler.server.camera.led == True
             handler.server.camera.start_recording.assert_called_once_with(
                     handler.server.files[0].stream, format='mjpeg', quality=0,
                     bitrate=17000000, intra_period=None,
                     motion_output=None)
-            handler.server.camera.wait_recording.assert_called_once_with(5)
+            assert handler.server.camera.wait_recording.call_args_list == [
+                    call(1.0)] * 5
             handler.server.camera.stop_recording.assert_called_once_with()
             assert len(handler.server.files) == 1
             assert handler.server.files[0].filetype == 'VIDEO'
 
     def test_record_handler_with_motion():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 RECORD 5,h264,,,,1', socket), ('localhost', 1),
                     MagicMock(
-                        client_address=('localhost', 1), seqno=1, files=[]))
-            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\n')
+                        client_address=('localhost', 1), seqno=1, files=[],
+                        jobs=compoundpi.server.CompoundPiJobQueue()))
+            handler.server.jobs.close()
+            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\nJOB 1')
             assert handler.server.seqno == 2
             assert handler.server.camera.led == True
             handler.server.camera.start_recording.assert_called_once_with(
                     handler.server.files[0].stream, format='h264', quality=0,
                     bitrate=17000000, intra_period=None,
                     motion_output=handler.server.files[1].stream)
-            handler.server.camera.wait_recording.assert_called_once_with(5)
+            assert handler.server.camera.wait_recording.call_args_list == [
+                    call(1.0)] * 5
             handler.server.camera.stop_recording.assert_called_once_with()
             assert len(handler.server.files) == 2
             assert handler.server.files[0].filetype == 'VIDEO'
             assert handler.server.files[1].filetype == 'MOTION'
 
+    def test_record_handler_with_sync():
+        with patch('compoundpi.server.NetworkTransmission') as m, \
+                patch('compoundpi.server.time.time', return_value=1000.0) as now, \
+                patch('compoundpi.server.time.sleep') as sleep, \
+                patch('compoundpi.server.monotonic',
+                        side_effect=[10.0, 59.999, 60.0]):
+            def start_recording(output, **kwargs):
+                # The camera writes the first frame a little after the sync
+                now.return_value = 1050.002
+                output.write(b'foo')
+            socket = Mock()
+            server = MagicMock(
+                client_address=('localhost', 1), seqno=1, files=[],
+                jobs=compoundpi.server.CompoundPiJobQueue())
+            server.camera.start_recording.side_effect = start_recording
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 RECORD 1,h264,,,,1,1050.0', socket), ('localhost', 1),
+                    server)
+            handler.server.jobs.close()
+            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\nJOB 1')
+            sleep.assert_called_once_with(
+                pytest.approx(50.0 - handler.sync_spin))
+            files = handler.server.files
+            assert [f.filetype for f in files] == ['VIDEO', 'MOTION']
+            assert files[0].stream.getvalue() == b'foo'
+            assert files[0].timestamp == 1050.002
+            assert files[0].requested == 1050.0
+            assert files[1].timestamp == 1050.002
+            assert files[1].requested == 1050.0
+
     def test_record_handler_wrong_codec():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 RECORD 5,mjpeg,,,,1', socket), ('localhost', 1),
@@ -585,30 +997,475 @@ with patch.dict('sys.modules', {
                 socket, ('localhost', 1),
                 b'2 ERROR\nFormat must be h264 for motion output')
 
+    def test_record_handler_segmented():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 RECORD 5,h264,,,,1,,2', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1, files=[],
+                        jobs=compoundpi.server.CompoundPiJobQueue()))
+            handler.server.jobs.close()
+            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\nJOB 1')
+            files = handler.server.files
+            assert [f.filetype for f in files] == [
+                    'VIDEO', 'MOTION', 'VIDEO', 'MOTION', 'VIDEO', 'MOTION']
+            assert files[0].timestamp == files[1].timestamp
+            handler.server.camera.start_recording.assert_called_once_with(
+                    files[0].stream, format='h264', quality=0,
+                    bitrate=17000000, intra_period=None,
+                    motion_output=files[1].stream)
+            assert handler.server.camera.split_recording.call_args_list == [
+                    call(files[2].stream, motion_output=files[3].stream),
+                    call(files[4].stream, motion_output=files[5].stream),
+                    ]
+            assert handler.server.camera.wait_recording.call_args_list == [
+                    call(1.0)] * 5
+            handler.server.camera.stop_recording.assert_called_once_with()
+
+    def test_record_handler_segmented_wrong_codec():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 RECORD 5,mjpeg,,,,,,2', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1))
+            m.assert_called_once_with(
+                socket, ('localhost', 1),
+                b'2 ERROR\nFormat must be h264 for segmented recording')
+
+    def test_buffer_handler():
+        with patch('compoundpi.server.NetworkTransmission') as m, \
+                patch.object(compoundpi.server.picamera, 'PiCameraCircularIO') as c:
+            socket = Mock()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 BUFFER 10', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1, files=[],
+                        buffer=None, buffer_length=0.0))
+            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\n')
+            c.assert_called_once_with(
+                    handler.server.camera, seconds=10.0, bitrate=17000000,
+                    splitter_port=2)
+            handler.server.camera.start_recording.assert_called_once_with(
+                    c.return_value, format='h264', quality=0,
+                    bitrate=17000000, intra_period=None, splitter_port=2)
+            assert not handler.server.camera.stop_recording.called
+            assert handler.server.buffer == c.return_value
+            assert handler.server.buffer_length == 10.0
+
+    def test_buffer_handler_stop():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 BUFFER 0', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1, files=[],
+                        buffer=Mock(), buffer_length=10.0))
+            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\n')
+            handler.server.camera.stop_recording.assert_called_once_with(
+                    splitter_port=2)
+            assert not handler.server.camera.start_recording.called
+            assert handler.server.buffer is None
+            assert handler.server.buffer_length == 0.0
+
+    class FakeCircularIO(io.BytesIO):
+        # Mimics the frames and lock of PiCameraCircularIO; each frame is
+        # preceded by a header
+        def __init__(self, count):
+            super(FakeCircularIO, self).__init__()
+            self.lock = threading.Lock()
+            self.frames = []
+            for index in range(count):
+                self.add_frame(index)
+
+        def add_frame(self, index):
+            header = compoundpi.server.picamera.PiVideoFrameType.sps_header
+            self.seek(0, io.SEEK_END)
+            self.frames.append(Mock(
+                index=index, frame_type=header, timestamp=None,
+                position=self.tell(), frame_size=2))
+            self.write(b'HH')
+            self.frames.append(Mock(
+                index=index, frame_type='frame', timestamp=index * 2000000,
+                position=self.tell(), frame_size=3))
+            self.write(chr(ord('a') + index).encode('ascii') * 3)
+
+    def test_trigger_handler():
+        with patch('compoundpi.server.NetworkTransmission') as m, \
+                patch('compoundpi.server.time.time', return_value=1000.0):
+            socket = Mock()
+            buf = FakeCircularIO(3)
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 TRIGGER 3', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1, files=[],
+                        buffer=buf, buffer_length=10.0))
+            # The response doesn't wait for the video to be saved
+            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\n')
+            assert handler.server.files == []
+            fn, args = (
+                handler.server.saves.submit.call_args[0][0],
+                handler.server.saves.submit.call_args[0][1:])
+            assert not handler.server.transfers.submit.called
+            # Frames buffered after the trigger arrived are excluded
+            buf.add_frame(3)
+            # The encoder's write position in the buffer is preserved
+            buf.seek(5)
+            fn(Mock(), *args)
+            assert buf.tell() == 5
+            assert len(handler.server.files) == 1
+            assert handler.server.files[0].filetype == 'VIDEO'
+            assert handler.server.files[0].timestamp == 998.0
+            assert handler.server.files[0].stream.getvalue() == b'HHbbbHHccc'
+
+    def test_trigger_handler_whole_buffer():
+        with patch('compoundpi.server.NetworkTransmission') as m, \
+                patch('compoundpi.server.time.time', return_value=1000.0):
+            socket = Mock()
+            buf = FakeCircularIO(3)
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 TRIGGER', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1, files=[],
+                        buffer=buf, buffer_length=10.0,
+                        saves=compoundpi.server.CompoundPiSaveQueue()))
+            handler.server.saves.close()
+            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\n')
+            assert len(handler.server.files) == 1
+            assert handler.server.files[0].timestamp == 996.0
+            assert handler.server.files[0].stream.getvalue() == (
+                b'HHaaaHHbbbHHccc')
+
+    def test_trigger_handler_empty():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 TRIGGER', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1, files=[],
+                        buffer=FakeCircularIO(0), buffer_length=10.0))
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'2 ERROR\nBuffer is empty')
+            assert not handler.server.saves.submit.called
+
+    def test_trigger_handler_not_buffering():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 TRIGGER', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1, files=[],
+                        buffer=None, buffer_length=0.0))
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'2 ERROR\nNot buffering')
+            assert handler.server.files == []
+
     def test_send_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m, \
+        with patch('compoundpi.server.NetworkTransmission') as m, \
                 patch('compoundpi.server.socket.socket') as s:
-            send_file = Mock()
+            sent = []
             send_sock = Mock()
+            send_sock.sendall.side_effect = lambda data: sent.append(bytes(data))
             s.return_value = send_sock
-            send_sock.makefile.return_value = send_file
             socket = Mock()
             f = compoundpi.server.CompoundPiFile('IMAGE')
             f.stream.write(b'\x10' * 10)
             handler = compoundpi.server.CompoundPiServerProtocol(
                     (b'2 SEND 0,5647', socket), ('localhost', 1),
-                    MagicMock(client_address=('localhost', 1), seqno=1, files=[f]))
-            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\n')
+                    MagicMock(client_address=('localhost', 1), seqno=1, files=[f],
+                        transfers=compoundpi.server.CompoundPiTransferPool(1)))
+            handler.server.transfers.close()
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'2 OK\nTRANSFER 1')
             send_sock.connect.assert_called_once_with(('localhost', 5647))
-            send_file.write.assert_has_calls([
-                call(b'\x00\x00\x00\x0A'),
-                call(b'\x10' * 10),
-                ])
-            send_file.close.assert_called_once_with()
+            assert sent == [b'\x00\x00\x00\x00\x00\x00\x00\x0A', b'\x10' * 10]
+            send_sock.close.assert_called_once_with()
+            # Ensure the stream's buffer was released after sending
+            f.stream.write(b'\x10')
+            assert f.size == 11
+
+    def test_send_handler_spooled(tmpdir):
+        with patch('compoundpi.server.NetworkTransmission') as m, \
+                patch('compoundpi.server.socket.socket') as s:
+            sent = []
+            send_sock = Mock()
+            send_sock.sendall.side_effect = lambda data: sent.append(bytes(data))
+            send_sock.sendfile.side_effect = lambda source, offset, count: (
+                source.seek(offset), sent.append(source.read(count)))
+            s.return_value = send_sock
+            socket = Mock()
+            f = compoundpi.server.CompoundPiFile('IMAGE')
+            f.stream.write(b'\x10' * 10)
+            f.spool(str(tmpdir))
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 SEND 0,5647', socket), ('localhost', 1),
+                    MagicMock(client_address=('localhost', 1), seqno=1, files=[f],
+                        transfers=compoundpi.server.CompoundPiTransferPool(1)))
+            handler.server.transfers.close()
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'2 OK\nTRANSFER 1')
+            assert sent == [b'\x00\x00\x00\x00\x00\x00\x00\x0A', b'\x10' * 10]
             send_sock.close.assert_called_once_with()
+            f.close()
+
+    def test_send_handler_range(tmpdir):
+        with patch('compoundpi.server.NetworkTransmission') as m, \
+                patch('compoundpi.server.socket.socket') as s:
+            sent = []
+            send_sock = Mock()
+            send_sock.sendall.side_effect = lambda data: sent.append(bytes(data))
+            send_sock.sendfile.side_effect = lambda source, offset, count: (
+                source.seek(offset), sent.append(source.read(count)))
+            s.return_value = send_sock
+            socket = Mock()
+            f = compoundpi.server.CompoundPiFile('IMAGE')
+            f.stream.write(b'foo bar baz')
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 SEND 0,5647,4,3', socket), ('localhost', 1),
+                    MagicMock(client_address=('localhost', 1), seqno=1, files=[f],
+                        transfers=compoundpi.server.CompoundPiTransferPool(1)))
+            handler.server.transfers.close()
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'2 OK\nTRANSFER 1')
+            assert sent == [b'\x00\x00\x00\x00\x00\x00\x00\x03', b'bar']
+            m.reset_mock()
+            del sent[:]
+            f.spool(str(tmpdir))
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'3 SEND 0,5647,8,', socket), ('localhost', 1),
+                    MagicMock(client_address=('localhost', 1), seqno=2, files=[f],
+                        transfers=compoundpi.server.CompoundPiTransferPool(1)))
+            handler.server.transfers.close()
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'3 OK\nTRANSFER 1')
+            assert sent == [b'\x00\x00\x00\x00\x00\x00\x00\x03', b'baz']
+            f.close()
+
+    def test_send_handler_empty(tmpdir):
+        with patch('compoundpi.server.NetworkTransmission') as m, \
+                patch('compoundpi.server.socket.socket') as s:
+            sent = []
+            send_sock = Mock()
+            send_sock.sendall.side_effect = lambda data: sent.append(bytes(data))
+            s.return_value = send_sock
+            socket = Mock()
+            f = compoundpi.server.CompoundPiFile('IMAGE')
+            f.stream.write(b'foo bar baz')
+            f.spool(str(tmpdir))
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 SEND 0,5647,4,0', socket), ('localhost', 1),
+                    MagicMock(client_address=('localhost', 1), seqno=1, files=[f],
+                        transfers=compoundpi.server.CompoundPiTransferPool(1)))
+            handler.server.transfers.close()
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'2 OK\nTRANSFER 1')
+            # A zero length must not be passed to sendfile, which would send
+            # the rest of the file
+            assert sent == [b'\x00' * 8]
+            assert not send_sock.sendfile.called
+            f.close()
+
+    def test_send_handler_bad_offset():
+        with patch('compoundpi.server.NetworkTransmission') as m, \
+                patch('compoundpi.server.socket.socket') as s:
+            socket = Mock()
+            f = compoundpi.server.CompoundPiFile('IMAGE')
+            f.stream.write(b'foo')
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 SEND 0,5647,4', socket), ('localhost', 1),
+                    MagicMock(client_address=('localhost', 1), seqno=1, files=[f],
+                        transfers=compoundpi.server.CompoundPiTransferPool(1)))
+            m.assert_called_once_with(
+                socket, ('localhost', 1),
+                b'2 ERROR\nInvalid offset 4 for file 0')
+            assert not s.called
+
+    def test_sendall_handler(tmpdir):
+        with patch('compoundpi.server.NetworkTransmission') as m, \
+                patch('compoundpi.server.socket.socket') as s:
+            sent = []
+            send_sock = Mock()
+            send_sock.sendall.side_effect = lambda data: sent.append(bytes(data))
+            send_sock.sendfile.side_effect = lambda source, offset, count: (
+                source.seek(offset), sent.append(source.read(count)))
+            s.return_value = send_sock
+            socket = Mock()
+            file1 = compoundpi.server.CompoundPiFile('IMAGE', 100.0)
+            file1.stream.write(b'foo')
+            file2 = compoundpi.server.CompoundPiFile('VIDEO', 200.0)
+            file2.stream.write(b'bar baz')
+            file2.spool(str(tmpdir))
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 SENDALL 5647', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1,
+                        files=[file1, file2],
+                        transfers=compoundpi.server.CompoundPiTransferPool(1)))
+            handler.server.transfers.close()
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'2 OK\nTRANSFER 1')
+            send_sock.connect.assert_called_once_with(('localhost', 5647))
+            assert sent == [
+                struct.pack(b'>LQ', 2, 10),
+                struct.pack(b'>L8sdQ', 0, b'IMAGE   ', 100.0, 3),
+                b'foo',
+                struct.pack(b'>L8sdQ', 1, b'VIDEO   ', 200.0, 7),
+                b'bar baz',
+                ]
+            send_sock.close.assert_called_once_with()
+            file2.close()
+
+    def test_sendall_handler_range():
+        with patch('compoundpi.server.NetworkTransmission') as m, \
+                patch('compoundpi.server.socket.socket') as s:
+            sent = []
+            send_sock = Mock()
+            send_sock.sendall.side_effect = lambda data: sent.append(bytes(data))
+            s.return_value = send_sock
+            socket = Mock()
+            files = []
+            for i in range(3):
+                f = compoundpi.server.CompoundPiFile('IMAGE', 100.0 + i)
+                f.stream.write(b'foo')
+                files.append(f)
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 SENDALL 5647,1,1', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1, files=files,
+                        transfers=compoundpi.server.CompoundPiTransferPool(1)))
+            handler.server.transfers.close()
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'2 OK\nTRANSFER 1')
+            assert sent == [
+                struct.pack(b'>LQ', 1, 3),
+                struct.pack(b'>L8sdQ', 1, b'IMAGE   ', 101.0, 3),
+                b'foo',
+                ]
+
+    def test_sendall_handler_bad_start():
+        with patch('compoundpi.server.NetworkTransmission') as m, \
+                patch('compoundpi.server.socket.socket') as s:
+            socket = Mock()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 SENDALL 5647,2', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1, files=[]))
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'2 ERROR\nInvalid start 2')
+            assert not s.called
+
+    def test_transfer_pool():
+        pool = compoundpi.server.CompoundPiTransferPool(1, history=2)
+        def fail(update):
+            update(0.5)
+            raise IOError('foo')
+        assert pool.submit(lambda update: None) == 1
+        assert pool.submit(fail) == 2
+        assert pool.wait(5)
+        assert pool.pending == 0
+        assert pool.status() == [
+            (1, 'DONE', 1.0, ''), (2, 'FAILED', 0.5, 'foo')]
+        assert pool.status(2) == [(2, 'FAILED', 0.5, 'foo')]
+        pool.submit(lambda update: None)
+        pool.close()
+        assert [t[0] for t in pool.status()] == [2, 3]
+        with pytest.raises(ValueError):
+            pool.status(1)
+
+    def test_transfers_handler():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            pool = compoundpi.server.CompoundPiTransferPool(1)
+            def fail(update):
+                raise IOError('Connection refused')
+            pool.submit(lambda update: None)
+            pool.submit(fail)
+            pool.close()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 TRANSFERS', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1,
+                        transfers=pool))
+            m.assert_called_once_with(
+                socket, ('localhost', 1),
+                b'2 OK\n1,DONE,\n2,FAILED,Connection refused')
+            m.reset_mock()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'3 TRANSFERS 1', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=2,
+                        transfers=pool))
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'3 OK\n1,DONE,')
+
+    def test_jobs_handler():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            jobs = compoundpi.server.CompoundPiJobQueue()
+            def fail(update):
+                update(0.25)
+                raise IOError('Out of resources')
+            jobs.submit(lambda update: None)
+            jobs.submit(fail)
+            jobs.close()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 JOBS', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1, jobs=jobs))
+            m.assert_called_once_with(
+                socket, ('localhost', 1),
+                b'2 OK\n1,DONE,1.000,\n2,FAILED,0.250,Out of resources')
+            m.reset_mock()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'3 JOBS 2', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=2, jobs=jobs))
+            m.assert_called_once_with(
+                socket, ('localhost', 1),
+                b'3 OK\n2,FAILED,0.250,Out of resources')
+            m.reset_mock()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'4 JOBS 3', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=3, jobs=jobs))
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'4 ERROR\nUnknown job 3')
+
+    def test_clear_handler_pending():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            file1 = compoundpi.server.CompoundPiFile('IMAGE', 100.0)
+            transfers = Mock(pending=1)
+            transfers.wait.return_value = False
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 CLEAR', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1,
+                        files=[file1], transfers=transfers))
+            m.assert_called_once_with(
+                socket, ('localhost', 1),
+                b'2 ERROR\nCannot clear files with 1 transfers pending')
+            assert handler.server.files == [file1]
+            transfers.wait.assert_called_once_with(0)
+
+    def test_worker_pool_pending():
+        pool = compoundpi.server.CompoundPiTransferPool(1)
+        running = pool.running_state
+        pool._set_state(1, 'QUEUED', 0.0)
+        pool._set_state(2, running, 0.5)
+        pool._set_state(3, 'DONE', 1.0)
+        assert pool.pending == 2
+        assert not pool.wait(0)
+        # A running task which has reported full progress is only finishing
+        # up and isn't counted
+        pool._set_state(1, running, 1.0)
+        pool._set_state(2, 'DONE', 1.0)
+        assert pool.pending == 0
+        assert pool.wait(0)
 
     def test_list_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             file1 = compoundpi.server.CompoundPiFile('IMAGE', 100.0)
             file1.stream.write(b'\x10' * 10)
@@ -626,8 +1483,74 @@ with patch.dict('sys.modules', {
                 b'VIDEO,1,200.000000,20')
             assert handler.server.seqno == 2
 
+    def test_list_handler_requested():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            file1 = compoundpi.server.CompoundPiFile('IMAGE', 100.0001, 100.0)
+            file1.stream.write(b'\x10' * 10)
+            file2 = compoundpi.server.CompoundPiFile('IMAGE', 100.5)
+            file2.stream.write(b'\x10' * 20)
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 LIST', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1,
+                        files=[file1, file2]))
+            m.assert_called_once_with(
+                socket, ('localhost', 1),
+                b'2 OK\n'
+                b'IMAGE,0,100.000100,10,100.000000\n'
+                b'IMAGE,1,100.500000,20')
+
+    def test_image_stream_generator_sync():
+        with patch('compoundpi.server.time.time', return_value=99.0) as now:
+            handler = compoundpi.server.CompoundPiServerProtocol.__new__(
+                    compoundpi.server.CompoundPiServerProtocol)
+            handler.server = Mock(files=[])
+            for stream in handler.image_stream_generator(2, None, 99.999):
+                # The first file's timestamp is the time the camera wrote the
+                # first frame, not the time the output was requested
+                now.return_value = 100.0
+                stream.write(b'foo')
+        assert handler.server.files[0].timestamp == 100.0
+        assert handler.server.files[0].requested == 99.999
+        assert handler.server.files[0].stream.getvalue() == b'foo'
+        assert handler.server.files[1].requested is None
+        assert handler.server.files[1].stream.getvalue() == b'foo'
+
+    def test_time_handler():
+        with patch('compoundpi.server.NetworkTransmission') as m, \
+                patch('compoundpi.server.time.time') as now:
+            now.side_effect = [1000.0, 1000.5]
+            socket = Mock()
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 TIME', socket), ('localhost', 1),
+                    MagicMock(client_address=('localhost', 1), seqno=1))
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'2 OK\n1000.000000,1000.500000')
+            assert handler.server.seqno == 2
+
+    def test_time_handler_retransmit():
+        with patch('compoundpi.server.NetworkTransmission') as m, \
+                patch('compoundpi.server.time.time') as now:
+            now.side_effect = [1000.0, 1000.5, 1002.0, 1002.5]
+            socket = Mock()
+            server = MagicMock(
+                client_address=('localhost', 1), seqno=1,
+                responses=compoundpi.server.CompoundPiResponseCache())
+            compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 TIME', socket), ('localhost', 1), server)
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'2 OK\n1000.000000,1000.500000')
+            m.reset_mock()
+            # A retransmission is answered with fresh timestamps rather than
+            # a replay of the original response
+            compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 TIME', socket), ('localhost', 1), server)
+            m.assert_called_once_with(
+                socket, ('localhost', 1), b'2 OK\n1002.000000,1002.500000')
+
     def test_clear_handler():
-        with patch('compoundpi.server.NetworkRepeater') as m:
+        with patch('compoundpi.server.NetworkTransmission') as m:
             socket = Mock()
             file1 = compoundpi.server.CompoundPiFile('IMAGE', 100.0)
             file2 = compoundpi.server.CompoundPiFile('VIDEO', 200.0)
@@ -640,3 +1563,76 @@ with patch.dict('sys.modules', {
             assert handler.server.seqno == 2
             assert handler.server.files == []
 
+    def test_clear_handler_count():
+        with patch('compoundpi.server.NetworkTransmission') as m:
+            socket = Mock()
+            file1 = compoundpi.server.CompoundPiFile('VIDEO', 100.0)
+            file2 = compoundpi.server.CompoundPiFile('VIDEO', 200.0)
+            handler = compoundpi.server.CompoundPiServerProtocol(
+                    (b'2 CLEAR 1', socket), ('localhost', 1),
+                    MagicMock(
+                        client_address=('localhost', 1), seqno=1,
+                        files=[file1, file2]))
+            m.assert_called_once_with(socket, ('localhost', 1), b'2 OK\n')
+            assert handler.server.files == [file2]
+
+
+    def test_file_spool(tmpdir):
+        f = compoundpi.server.CompoundPiFile('IMAGE', 100.0)
+        f.stream.write(b'\x10' * 10)
+        assert not f.spooled
+        assert f.size == 10
+        f.spool(str(tmpdir))
+        assert f.spooled
+        assert os.path.dirname(f.path) == str(tmpdir)
+        assert f.size == 10
+        assert f.stream.read() == b'\x10' * 10
+        path = f.path
+        f.close()
+        assert not os.path.exists(path)
+
+    def test_file_size_position(tmpdir):
+        f = compoundpi.server.CompoundPiFile('IMAGE', 100.0)
+        f.stream.write(b'\x10' * 10)
+        f.stream.seek(5)
+        # Reading the size must not disturb the stream's position
+        assert f.size == 10
+        assert f.stream.tell() == 5
+        assert f.spool(str(tmpdir))
+        assert f.size == 10
+        with io.open(f.path, 'rb') as spooled:
+            assert spooled.read() == b'\x10' * 10
+        f.close()
+        # Closed files can no longer be spooled
+        assert not f.spool(str(tmpdir))
+
+    def test_file_store_unlimited(tmpdir):
+        store = compoundpi.server.CompoundPiFileStore(0, str(tmpdir))
+        for i in range(3):
+            f = compoundpi.server.CompoundPiFile('IMAGE', 100.0)
+            f.stream.write(b'\x10' * 10)
+            store.append(f)
+        assert len(store) == 3
+        assert store.ram_size == 30
+        assert not any(f.spooled for f in store)
+        assert tmpdir.listdir() == []
+
+    def test_file_store_eviction(tmpdir):
+        store = compoundpi.server.CompoundPiFileStore(25, str(tmpdir))
+        files = []
+        for i in range(3):
+            f = compoundpi.server.CompoundPiFile('IMAGE', 100.0)
+            f.stream.write(b'\x10' * 10)
+            files.append(f)
+        store.append(files[0])
+        store.append(files[1])
+        # Retrieving the first file makes the second least recently used
+        assert store[0] is files[0]
+        store.append(files[2])
+        assert [f.spooled for f in store] == [False, True, False]
+        assert store.ram_size == 20
+        assert len(tmpdir.listdir()) == 1
+        assert store[1].stream.read() == b'\x10' * 10
+        del store[:]
+        assert len(store) == 0
+        assert tmpdir.listdir() == []